@@ -1,16 +1,33 @@
+import heapq
 import io
+import json
 import os
 import logging
-from typing import Callable
+import multiprocessing
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Callable, TYPE_CHECKING
 
 import chess
 import chess.pgn
 
-from gui_generation_status import GenerationStatus
 from settings import Settings
 from workerEngineReduce import WorkerPlay
+from explorer import Explorer, RateLimit
+from position_graph import PositionGraph, PositionStore, graph_fingerprint
+from frontier import Frontier, FrontierOrder, Budget, MemoryBudget, LineNode
+from uci_engine import EnginePool, EngineCache, CachedEngine
+from status_queue import QueueStatus, drain
+from generation_worker import CancelToken, Cancelled
+from metrics import Metrics
+from journal import ChapterJournal, journal_fingerprint
+from polyglot_book import PolyglotBook
 import chess.engine
 
+if TYPE_CHECKING: #the status widgets need dearpygui, which worker processes and tests can do without
+    from gui_generation_status import GenerationStatus
+
 
 log_level = logging.DEBUG
 logging.basicConfig(level=log_level)
@@ -19,12 +36,44 @@ logging.getLogger("chess.pgn").setLevel(logging.CRITICAL)
 working_dir = os.getcwd()
 
 
+def valid_continuations(moveSelection, continuations, likelihood):
+    validContinuations = []
+    for move in continuations:
+        continuationLikelihood = float(move['playrate']) * float(likelihood)
+        if (continuationLikelihood >= (float(moveSelection.depth_likelihood))) and (move['total_games'] > moveSelection.continuation_games): #we eliminate continuations that don't meet depth likelihood or minimum games
+            move = dict(move, cumulativeLikelihood=continuationLikelihood) #we copy the move because position stats are shared between lines
+            validContinuations.append(move)
+    return validContinuations
+
+
+def has_good_reply(moveSelection, move, totalGames, potency):
+    #our reply is only kept when the continuation is played enough and our move has reliable games, otherwise the engine may finish the line
+    return (move['playrate'] > moveSelection.min_play_rate) and (totalGames > moveSelection.min_games) and (potency != 0)
+
+
+def chapter_path(chapter, openingName, extension='.pgn'):
+    return f"{working_dir}/Chapter_{chapter}_{openingName}{extension}"
+
+
+def line_pgn(rootPgn, rootBoard, moves):
+    #pgn text is only produced for printing, from the continuations and replies played after the opening pgn
+    pgn = rootPgn
+    moveNumber = rootBoard.fullmove_number
+    for continuation, reply in moves:
+        if rootBoard.turn == chess.WHITE: #we are black, so the move number goes before the opponent's continuation
+            pgn += " " + str(moveNumber) + ". " + continuation + " " + reply
+        else:
+            pgn += " " + continuation + " " + str(moveNumber + 1) + ". " + reply
+        moveNumber += 1
+    return pgn
+
+
 class Rooter:
-    def __init__(self, settings, status, engine, pgn):
+    def __init__(self, settings, status, engine, explorer, pgn):
         self.pgn = pgn
-        self._calculate_pgns(settings, status, engine)
+        self._calculate_pgns(settings, status, engine, explorer)
 
-    def _calculate_pgns(self, settings, status, engine):
+    def _calculate_pgns(self, settings, status, engine, explorer):
         try:
             game = chess.pgn.read_game(io.StringIO(self.pgn)) #reads the PGN submitted by the user
         except:
@@ -49,7 +98,7 @@ class Rooter:
 
         for move in moves: #we iterate through each move in the PGN/UCI generated
             if board.turn != perspective: #if it's not our move we check the likelihood the move in the PGN was played
-                workerPlay = WorkerPlay(settings, status, engine, board.fen()) #we are calling the API each time
+                workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board) #we are calling the API each time
                 move_stats, chance = workerPlay.find_opponent_move(move) #we look for the PGN move in the API response, and return the odds of it being played
                 self.likelihood *= chance #we are creating a cumulative likelihood from each played move in the PGN
                 self.likelihood_path.append((move_stats['san'], chance)) #we are creating a list of PGN moves with the chance of each of them being played 0-1
@@ -59,62 +108,44 @@ class Rooter:
         
         #now we have the likelihood path and cumulative likelihood of each opponent move in the PGN, so pgn can go to leafer
         
-        pgnPlus = self.pgn, self.likelihood, self.likelihood_path
-        
-
-        pgnsreturned.append(pgnPlus)
-        logging.debug(f"sent from rooter: {pgnsreturned}")
+        #we keep the win rate at the end of the pgn in case the line is never expanded
+        workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board)
+        lineWinRate, totalLineGames, _ = workerPlay.find_potency()
+        self.board = board.copy(stack=False)
+        self.node = LineNode(None, None, None, 1, self.likelihood, lineWinRate or 0, totalLineGames, board)
+        self.node.prefix = self.likelihood_path
+        logging.debug(f"sent from rooter: {self.likelihood_path}")
          
 
 class Leafer:
-    def __init__(self, settings, status, engine, pgn, cumulative, likelyPath):
-        self.pgn = pgn
-        self.cumulative = cumulative
-        self.likelyPath = likelyPath
-        self._calculate_pgns(settings, status, engine)
+    def __init__(self, settings, status, engine, explorer, graph, node):
+        self.node = node
+        self._calculate_pgns(settings, status, engine, explorer, graph)
 
-    def _calculate_pgns(self, settings, status, engine):
+    def _calculate_pgns(self, settings, status, engine, explorer, graph):
         moveSelection = settings.moveSelection
-        
-        try:
-            game = chess.pgn.read_game(io.StringIO(self.pgn)) #reads the PGN submitted by the user
-        except:
-            self.status.error(f"Invalid PGN {self.pgn}")
-            raise Exception(f'Invalid PGN {self.pgn}') #error if user submitted PGN is invalid
+        board = self.node.board #the line's board is only needed until it is expanded
+        self.node.board = None
 
-        board = game.board()
-        moves = list(game.mainline_moves()) #we create a list of pgn moves in UCI
-        logging.debug(moves)
-        
-        if len(moves) % 2 == 0: #if even moves in pgn, we are black. if odd, white.
-            perspective = chess.BLACK
+        if board.turn == chess.WHITE: #if it's white to play after our move, we are black. if black, white.
             self.perspective_str = 'Black'
         else:
-            perspective = chess.WHITE
             self.perspective_str = 'White'
         
 
-        self.likelihood = self.cumulative #likelihood of oppoonent playing moves starts at 100%
-        self.likelihood_path = self.likelyPath
+        self.likelihood = self.node.cumulative #likelihood of oppoonent playing moves starts at 100%
         validContinuations = [] 
         pgnList = []
+        self.finalLines = []
 
-        for move in moves: #we iterate through each move in the PGN/UCI generated 
-            board.push(move) #play each move in the PGN
-            
         #we find all continuations
-        self.workerPlay = WorkerPlay(settings, status, engine, board.fen()) #we call the api to get the stats in the position
+        node = graph.expand(board) #move orders transposing to this position share its node
+        self.workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board) #we call the api to get the stats in the position
         continuations = self.workerPlay.find_move_tree() #list all continuations
         #logging.debug(continuations)       
         
         
-        for move in continuations:
-            continuationLikelihood = float(move['playrate']) * float(self.likelihood)
-            if (continuationLikelihood >= (float(moveSelection.depth_likelihood))) and (move['total_games'] > moveSelection.continuation_games): #we eliminate continuations that don't meet depth likelihood or minimum games
-                move ['cumulativeLikelihood'] = (continuationLikelihood)
-                validContinuations.append(move)
-                #print (float(move['playrate']),float(self.likelihood),float(settings.moveSelection.depth_likelihood))
-                #logging.debug(continuationLikelihood)
+        validContinuations = valid_continuations(moveSelection, continuations, self.likelihood)
         logging.debug (f'valid continuations: {validContinuations}')
         
         
@@ -123,12 +154,10 @@ class Leafer:
         for move in validContinuations:
             board.push_san(move['san']) #we play each valid continuation
             
-            self.likelihood_path.append((move['san'], move['playrate'])) #we add the continuation to the likelihood path
-            
                                     
-            #we look for the best move for us to play
-            self.workerPlay = WorkerPlay(settings, status, engine, board.fen())
-            _, self.best_move, self.potency, self.potency_range, self.total_games = self.workerPlay.pick_candidate() #list best candidate move, win rate,
+            #we look for the best move for us to play, only once per position
+            child = graph.child(node, move['san'], board)
+            _, self.best_move, self.potency, self.potency_range, self.total_games = graph.candidate(child, board) #list best candidate move, win rate,
             print_playrate = '{:+.2%}'.format(move['playrate'])
             print_cumulativelikelihood = '{:+.2%}'.format(move['cumulativeLikelihood'])
             print_winrate = "{:+.2%}".format(self.potency)
@@ -137,84 +166,69 @@ class Leafer:
             
             #we check our response playrate and minimum played games meet threshold. if so we pass the pgn. if not we add pgn to final list
             
-            if (move['playrate'] > moveSelection.min_play_rate) and (self.total_games > moveSelection.min_games) and (self.potency != 0):
+            if has_good_reply(moveSelection, move, self.total_games, self.potency):
                 
-                #we add the pgn of the continuation and our best move to a list
-                if self.perspective_str == 'Black':
-                    newpgn = self.pgn + " " + str(board.fullmove_number) + ". " + str(move['san']) #we add opponent's continuations first
-                    newpgn = newpgn + " " + str(self.best_move) #then our best response
-                    pgnPlus = [newpgn, move ['cumulativeLikelihood'], self.likelihood_path[:]]
-                    #need to return a pgn as well as moves + chance + cumulative likelihood
-                else:
-                    newpgn = self.pgn + " " + move['san'] #we add opponent's continuations first
-                    newpgn = newpgn + " " + str(board.fullmove_number) + ". " + str(self.best_move) #then our best response
-                    pgnPlus = [newpgn, move ['cumulativeLikelihood'], self.likelihood_path[:]]          
-                logging.debug(f"full new pgn after our move is {newpgn}")        
+                #we add the continuation and our best move on top of this line
+                nextBoard = board.copy(stack=False)
+                nextBoard.push_san(self.best_move)
+                pgnPlus = LineNode(self.node, move['san'], self.best_move, move['playrate'], move['cumulativeLikelihood'], self.potency, self.total_games, nextBoard)
+                #need to return the line's moves as well as moves + chance + cumulative likelihood, and our win rate in case the line is never expanded
+                logging.debug(f"full new line after our move {self.best_move} is at {nextBoard.fen()}")        
                 
-                #we make a list of pgns that we want to feed back into the algorithm, along with cumulative winrates
+                #we make a list of lines that we want to feed back into the algorithm, along with cumulative winrates
                 pgnList.append(pgnPlus)
-                #logging.debug(pgnList)
-                del self.likelihood_path [-1] #we remove the continuation from the likelihood path                         
                 board.pop() #we go back a move to undo the continuation
             else:
                 if settings.engine.enabled and settings.engine.finish: #if we want engine to finish lines where no good move data exists
                     
                     #we ask the engine the best move
-                    depth = settings.engine.depth
-                    status.info2(f"Running engine for '{board.fen()}' at depth {depth}, this can take a while")
-                    PlayResult = engine.play(board, chess.engine.Limit(depth=depth)) #we get the engine to finish the line
-                    board.push(PlayResult.move)
-                    logging.debug(f"engine finished {PlayResult.move}")
-                    board.pop() #we go back a move to undo the engine
-                    
-                    engineMove = board.san(PlayResult.move)
-                    
-                    #we add the pgn of the continuation and our best move to a list
-                    if self.perspective_str == 'Black':
-                        newpgn = self.pgn + " " + str(board.fullmove_number) + ". " + str(move['san']) #we add opponent's continuations first
-                        newpgn = newpgn + " " + str(engineMove) #then our best response
-                        pgnPlus = [newpgn, move ['cumulativeLikelihood'], self.likelihood_path[:]]
-                        #need to return a pgn as well as moves + chance + cumulative likelihood
+                    engineMove = graph.engine_move(child, board) #we get the engine to finish the line
+                    logging.debug(f"engine finished {engineMove}")
+
+                    #engine moves have no reliable games, so in case the line is never expanded we estimate our win rate from the opponent's move
+                    self.workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board)
+                    lineWinRate, totalLineGames, draws = self.workerPlay.find_potency()
+                    if moveSelection.draws_are_half:
+                        lineWinRate = 1 - lineWinRate + (0.5 * draws)
                     else:
-                        newpgn = self.pgn + " " + move['san'] #we add opponent's continuations first
-                        newpgn = newpgn + " " + str(board.fullmove_number) + ". " + str(engineMove) #then our best response
-                        pgnPlus = [newpgn, move ['cumulativeLikelihood'], self.likelihood_path[:]]          
-                    logging.debug(f"full new pgn after our move is {newpgn}")        
+                        lineWinRate = 1 - lineWinRate - draws
+                    
+                    #we add the continuation and the engine move on top of this line
+                    nextBoard = board.copy(stack=False)
+                    nextBoard.push(engineMove)
+                    pgnPlus = LineNode(self.node, move['san'], board.san(engineMove), move['playrate'], move['cumulativeLikelihood'], lineWinRate, totalLineGames, nextBoard)
+                    logging.debug(f"full new line after engine move {engineMove} is at {nextBoard.fen()}")        
                     
-                    #we make a list of pgns that we want to feed back into the algorithm, along with cumulative winrates
+                    #we make a list of lines that we want to feed back into the algorithm, along with cumulative winrates
                     pgnList.append(pgnPlus)
-                    #logging.debug(pgnList)
-                    del self.likelihood_path [-1] #we remove the continuation from the likelihood path                         
                     board.pop() #we go back a move to undo the continuation
 
                 else:
-                    logging.debug(f"we find no good reply to {self.pgn} {move['san']}")
+                    logging.debug(f"we find no good reply to {move['san']} at {board.fen()}")
                     board.pop() #we go back a move to undo the continuation
-                    del self.likelihood_path [-1] #we remove the continuation from the likelihood path    
                     #we find potency and other stats
-                    self.workerPlay = WorkerPlay(settings, status, engine, board.fen()) #we call the api to get the stats in the final position
+                    self.workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board) #we call the api to get the stats in the final position
                     lineWinRate, totalLineGames, throwawayDraws = self.workerPlay.find_potency() #we get the win rate and games played in the final position            
-                    logging.debug (f'saving no reply line {self.pgn} {self.likelihood} {self.likelihood_path} {lineWinRate} {totalLineGames}')
-                    line = (self.pgn, self.likelihood, self.likelihood_path,lineWinRate, totalLineGames)
-                    finalLine.append(line) #we add line to final line list                                 
+                    logging.debug (f'saving no reply line {board.fen()} {self.likelihood} {lineWinRate} {totalLineGames}')
+                    line = (self.node, lineWinRate, totalLineGames)
+                    self.finalLines.append(line) #we add line to final line list                                 
                 
                 
-        global pgnsreturned #we make a globally accessible variable for the new pgns returned for each continuation
-        pgnsreturned = pgnList #we define the variable as the completely made list of continuations and responses and send it to be extended to second list
+        self.pgnList = pgnList #the completely made list of continuations and responses, to be pushed to the frontier
 
         #if there are no valid continuations we save the line to a file
         if not validContinuations:
             
-            logging.debug (f'no valid continuations to {self.pgn}')
+            logging.debug (f'no valid continuations at {board.fen()}')
             
             #we find potency and other stats
-            self.workerPlay = WorkerPlay(settings, status, engine, board.fen()) #we call the api to get the stats in the final position
+            self.workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board) #we call the api to get the stats in the final position
             lineWinRate, totalLineGames, throwawayDraws = self.workerPlay.find_potency() #we get the win rate and games played in the final position            
             
 
             if (totalLineGames == 0) and (lineWinRate == None): #if the line ends in mate there are no games played from the position so we need to populate games number from last move
                 board.pop()
-                self.workerPlay = WorkerPlay(settings, status, engine, board.fen()) #we call the api to get the stats in the final position
+                self.workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board) #we call the api to get the stats in the final position
                 throwawayWinRate, totalLineGames, throwawayDraws = self.workerPlay.find_potency() #we get the games played in the pre Mate position
                 lineWinRate = 1 #we make line win rate 1
                 logging.debug(f'line ends in mate')
@@ -222,7 +236,7 @@ class Leafer:
             else:
                 if (totalLineGames < moveSelection.min_games) : #if our response is an engine 'novelty' there is no reliable lineWinRate or total games
                     board.pop() #we go back to opponent's move
-                    self.workerPlay = WorkerPlay(settings, status, engine, board.fen())
+                    self.workerPlay = WorkerPlay(settings, status, engine, explorer, board.fen(), board)
                     lineWinRate, totalLineGames, draws = self.workerPlay.find_potency()
 
 
@@ -235,43 +249,136 @@ class Leafer:
                         logging.debug(f"total games on previous move: {totalLineGames}, draws aren't wins and our move is engine 'almost novelty' so win rate based on prev move is {lineWinRate}")                  
                     
 
-            line = (self.pgn, self.likelihood, self.likelihood_path, lineWinRate, totalLineGames)
-            finalLine.append(line) #we add line to final line list 
+            line = (self.node, lineWinRate, totalLineGames)
+            self.finalLines.append(line) #we add line to final line list 
 
 
 class Printer:
     def __init__(self, settings, filepath):
         self.settings = settings
         self.filepath = filepath
-        with open(self.filepath, 'w') as f:
-            f.write('')
+        self.lines = 0
+        self.file = open(self.filepath, 'w', buffering=1024 * 1024) #one buffered handle for the whole chapter
         logging.info(f"Created new file at: {self.filepath}")
 
     def print(self, pgn, cumulative, likelyPath, winRate, Games, lineNumber, openingName):
-        with open(self.filepath, 'a') as file:
-            pgnEvent = '[Event "' + openingName + " Line " + str(lineNumber) + '"]' #we name the event whatever you put in config
-            # annotation = "{likelihoods to get here:" + str(self.likelihood_path) + ". Cumulative likelihood" + str("{:+.2%}".format(self.likelihood)) + " }" #we create annotation with opponent move likelihoods and our win rate
-            
-            file.write('\n' + '\n' + '\n' + pgnEvent + '\n' ) #write name of pgn
-            file.write ('\n' + pgn) #write pgn
-            
-            file.write('\n' + "{Move playrates:") #start annotations
-            
-            for move, chance in likelyPath:
-                moveAnnotation = str("{:+.2%}".format(chance)) + '\t' + move
-                file.write ('\n' + moveAnnotation)
-            
-            
-            #we write them in as annotations
-            if self.settings.moveSelection.draws_are_half:
-                lineAnnotations = "Line cumulative playrate: " + str("{:+.2%}".format(cumulative)) + '\n' + "Line winrate (draws are half): " + str("{:+.2%}".format(winRate)) + ' over ' + str(Games) + ' games'
+        pgnEvent = '[Event "' + openingName + " Line " + str(lineNumber) + '"]' #we name the event whatever you put in config
+        # annotation = "{likelihoods to get here:" + str(self.likelihood_path) + ". Cumulative likelihood" + str("{:+.2%}".format(self.likelihood)) + " }" #we create annotation with opponent move likelihoods and our win rate
+
+        text = ['\n' + '\n' + '\n' + pgnEvent + '\n'] #write name of pgn
+        text.append('\n' + pgn) #write pgn
+
+        text.append('\n' + "{Move playrates:") #start annotations
+
+        for move, chance in likelyPath:
+            moveAnnotation = str("{:+.2%}".format(chance)) + '\t' + move
+            text.append('\n' + moveAnnotation)
+
+
+        #we write them in as annotations
+        if self.settings.moveSelection.draws_are_half:
+            lineAnnotations = "Line cumulative playrate: " + str("{:+.2%}".format(cumulative)) + '\n' + "Line winrate (draws are half): " + str("{:+.2%}".format(winRate)) + ' over ' + str(Games) + ' games'
+        else:
+            lineAnnotations = "Line cumulative playrate: " + str("{:+.2%}".format(cumulative)) + '\n' + "Line winrate (excluding draws): " + str("{:+.2%}".format(winRate)) + ' over ' + str(Games) + ' games'
+        text.append('\n' + lineAnnotations)
+
+
+        text.append("}") #end annotations
+        self.file.write(''.join(text)) #one write per line
+        self.lines += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        logging.info(f"Wrote {self.lines} lines to {self.filepath}")
+
+
+class ChapterWriter:
+    """
+    Takes final lines as soon as they are known, and writes the chapter sorted by consecutive move probabilities.
+    Sorted runs are spilled to temporary files and merged at the end, so a large chapter is never held in memory at once.
+    """
+
+    def __init__(self, settings, filepath, openingName, openingPgn, rootBoard):
+        self.settings = settings
+        self.filepath = filepath
+        self.openingName = openingName
+        self.openingPgn = openingPgn
+        self.rootBoard = rootBoard
+        self.longToShort = bool(settings.book.order.LONG_TO_SHORT)
+        self.runSize = settings.book.sort_run_lines
+        self.buffer = []
+        self.runs = []
+        self.partial = None
+        if settings.book.stream_lines: #lines are readable in arrival order while the search is still running
+            self.partial = Printer(settings, filepath[:-len('.pgn')] + '_partial.pgn')
+
+    def add(self, node, winRate, games):
+        #now the line is final we materialize its pgn text and likelihood path
+        likelyPath = node.likelihood_path()
+        line = (line_pgn(self.openingPgn, self.rootBoard, node.moves()), node.cumulative, likelyPath, winRate, games)
+        self.buffer.append(([v for _, v in likelyPath], line)) #we sort the lines by consecutive move probabilities
+        if self.partial:
+            self.partial.print(*line, self.partial.lines + 1, self.openingName)
+        if len(self.buffer) >= self.runSize:
+            self._spill()
+
+    def flush(self):
+        if self.partial:
+            self.partial.flush()
+
+    def _sorted_buffer(self):
+        lines = sorted(self.buffer, key=lambda keyed: keyed[0])
+        if self.longToShort:
+            lines.reverse() #we make the longest (main lines) first
+        self.buffer = []
+        return lines
+
+    def spill(self):
+        if self.buffer:
+            self._spill()
+
+    def _spill(self):
+        #an anonymous temporary file is deleted when it is closed, also when the run is stopped or fails
+        run = tempfile.TemporaryFile('w+', encoding='utf-8', buffering=1024 * 1024)
+        for keyed in self._sorted_buffer():
+            run.write(json.dumps(keyed) + '\n')
+        run.seek(0)
+        self.runs.append(run)
+        logging.debug(f"spilled sorted run {len(self.runs)}")
+
+    def _read_run(self, run):
+        for text in run:
+            yield json.loads(text)
+
+    def finish(self):
+        if self.runs:
+            if self.buffer:
+                self._spill()
+            #every run is already in output order, merging later runs first on ties keeps the order of a single stable sort
+            runs = [self._read_run(run) for run in self.runs]
+            if self.longToShort:
+                lines = heapq.merge(*reversed(runs), key=lambda keyed: keyed[0], reverse=True)
             else:
-                lineAnnotations = "Line cumulative playrate: " + str("{:+.2%}".format(cumulative)) + '\n' + "Line winrate (excluding draws): " + str("{:+.2%}".format(winRate)) + ' over ' + str(Games) + ' games'
-            file.write('\n' + lineAnnotations)
+                lines = heapq.merge(*runs, key=lambda keyed: keyed[0])
+        else:
+            lines = self._sorted_buffer()
 
-            
-            file.write("}") #end annotations
-        logging.info(f"Wrote data to {self.filepath}")
+        #we print the final list of lines
+        printer = Printer(self.settings, self.filepath)
+        lineNumber = 1
+        for _, (pgn, cumulative, likelyPath, winRate, Games) in lines:
+            printer.print(pgn, cumulative, likelyPath, winRate, Games, lineNumber, self.openingName)
+            lineNumber += 1
+        printer.close()
+
+        for run in self.runs:
+            run.close()
+        if self.partial:
+            self.partial.close()
+            os.remove(self.partial.filepath) #the sorted chapter replaces the lines written while searching
 
 
 class Grower:
@@ -279,112 +386,365 @@ class Grower:
     settings = None
     status = None
     engine = None
-
-    # todo: this method needs to be synchronised, and main logic should run in a separate thread
-    def run(self, settings: Settings, status: GenerationStatus, callback: Callable):
-        if self.is_running:
-            logging.info("Repertoire generation is already running")
-            return
-
-        self.is_running = True
+    explorer = None
+    graph = None
+    store = None
+    budget = None
+    memory = None
+    cancelToken = None
+    metrics = None
+    _lock = threading.Lock()
+
+    # runs on the caller's thread, the gui calls it through GenerationWorker so generation runs in the background
+    def run(self, settings: Settings, status: 'GenerationStatus', callback: Callable, cancelToken: CancelToken = None):
+        with self._lock:
+            if self.is_running:
+                logging.info("Repertoire generation is already running")
+                return
+            self.is_running = True
         self.settings = settings
         self.status = status
-        self.start_engine()
+        self.cancelToken = cancelToken or CancelToken()
+        self.metrics = Metrics()
 
         try:
-            for chapter, opening in enumerate(settings.book.get_books(), 1):
-                status.info(f"Generating book #{chapter} '{opening.name}' for PGN '{opening.pgn}'")
-                self.iterator(chapter, opening.name, opening.pgn)
+            books = settings.book.get_books()
+            if settings.book.chapter_workers > 1 and len(books) > 1:
+                self.run_parallel(books)
+            else:
+                self.start(settings, status)
+                for chapter, opening in enumerate(books, 1):
+                    status.info(f"Generating book #{chapter} '{opening.name}' for PGN '{opening.pgn}'")
+                    self.iterator(chapter, opening.name, opening.pgn)
+            #every book is written, so the next run starts over instead of resuming
+            for chapter, opening in enumerate(books, 1):
+                self.remove_journal(chapter, opening.name)
             callback()
+        except Cancelled:
+            logging.info("Repertoire generation was stopped")
+            status.info("Generation stopped", "Books finished before the stop were written" +
+                        (", generating again resumes the others" if settings.book.resume else ""))
         except Exception as e:
             logging.error(e)
         finally:
             self.stop()
+            if settings.book.run_report:
+                self.write_report()
+
+    def start(self, settings: Settings, status, rateLimit: RateLimit = None):
+        self.settings = settings
+        self.status = status
+        if self.metrics is None:
+            self.metrics = Metrics()
+        self.start_engine()
+        if settings.search.incremental:
+            self.store = PositionStore(settings.search.graph_path, graph_fingerprint(settings), settings.explorer.cache_ttl_days)
+        else:
+            self.store = None
+        self.explorer = Explorer(settings, status, rateLimit, self.cancelToken, self.metrics)
+        self.graph = PositionGraph(settings, status, self.engine, self.explorer, self.metrics, self.store)
+        self.budget = Budget(settings.search, self.explorer, self.engine)
+        self.memory = MemoryBudget(settings.search)
+
+    def run_parallel(self, books):
+        # chapters are independent, so each runs in its own process with its own slice of the engine processes
+        # they share the explorer cache file and one rate limit, and report progress back through a queue
+        workers = min(self.settings.book.chapter_workers, len(books))
+        #forking spares every worker re-importing numpy and scipy, but forking a process with other threads running can deadlock,
+        #so when the GUI runs us on its generation thread the workers are spawned
+        context = multiprocessing.get_context(None if threading.current_thread() is threading.main_thread() else 'spawn')
+        rateLimit = RateLimit(context)
+        workerToken = CancelToken(context.Event()) #worker processes can't see our token, so we pass a stop on to them
+        updates = context.Queue()
+        progress = {}
+        logging.info(f"Generating {len(books)} books on {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_start_chapter_worker, initargs=(rateLimit, updates, workerToken)) as executor:
+            chapters = {executor.submit(_grow_chapter, self.settings, chapter, opening.name, opening.pgn, working_dir, workers): chapter
+                        for chapter, opening in enumerate(books, 1)}
+            pending = set(chapters)
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=0.25)
+                    if self.cancelToken.cancelled:
+                        workerToken.cancel()
+                    self.show_progress(drain(updates), progress, len(books) - len(pending), len(books))
+                    for future in done:
+                        #a failed chapter fails the run, like it does when chapters run one by one
+                        for chapter, report in future.result().items(): #each worker sends back the metrics of its chapter
+                            self.metrics.merge(chapter, report)
+            except Exception:
+                executor.shutdown(cancel_futures=True)
+                raise
+        self.show_progress(drain(updates), progress, len(books), len(books))
+
+    def show_progress(self, updates, progress, finished, total):
+        for chapter, kind, line1, line2 in updates:
+            if kind == 'error':
+                self.status.error(f"Book #{chapter}: {line1}", line2)
+                return
+            if kind == 'metrics':
+                self.status.metrics(f"Book #{chapter}: {line2}")
+                continue
+            progress[chapter] = line2 if kind == 'info2' else line1
+        if updates:
+            self.status.info(f"Generating {total} books in parallel, {finished} finished",
+                             "\n".join(f"#{chapter}: {progress[chapter]}" for chapter in sorted(progress)))
 
     def stop(self):
         if self.engine:
             self.engine.quit()
+            self.engine = None #a Grower run again starts its own engine
+        if self.graph:
+            logging.info(self.graph.stats())
+            self.graph = None
+        if self.explorer:
+            logging.info(self.explorer.stats())
+            self.explorer.close()
+            self.explorer = None
+        if self.store:
+            self.store.close()
+            self.store = None
         self.is_running = False
 
+    def write_report(self):
+        # the run report is for finding regressions and sizing the explorer and engine budgets, so it notes the settings behind them
+        settings = self.settings
+        path = f"{working_dir}/run_report.json"
+        self.metrics.write(path, {'settings': {
+            'depth_likelihood': settings.moveSelection.depth_likelihood,
+            'explorer_source': settings.explorer.source.value,
+            'explorer_concurrency': settings.explorer.concurrency,
+            'engine': settings.engine.enabled,
+            'engine_depth': settings.engine.depth,
+            'engine_processes': settings.engine.processes,
+            'chapter_workers': settings.book.chapter_workers,
+        }})
+        logging.info(f"Wrote run report to {path}")
+
     def start_engine(self):
         if not self.settings.engine.enabled:
             self.engine = None
             return
 
-        engine = chess.engine.SimpleEngine.popen_uci(self.settings.engine.path)
-        engine.configure({"Hash": self.settings.engine.hash})
-        engine.configure({"Threads": self.settings.engine.threads})
+        engineSettings = self.settings.engine
+        with self.metrics.time('engine.start'):
+            self.engine = EnginePool(engineSettings.path, engineSettings.processes, engineSettings.threads, engineSettings.hash,
+                                     self.cancelToken, self.metrics)
         logging.getLogger('chess.engine').setLevel(logging.INFO)
-        self.engine = engine
-
-    def iterator(self, chapter, openingName, openingPgn):
-        global finalLine
-        finalLine = []
-        global pgnsreturned #we make a globally accessible variable for the new pgns returned by Rooter
-        pgnsreturned = []
-
-        Rooter(self.settings, self.status, self.engine, openingPgn)
-         
-        secondList = []
-        secondList.extend(pgnsreturned) #we create list of pgns and cumulative probabilities returned by starter, calling the api each move 
-        print ("second list",secondList)
-
-        
-        # #we iterate through these with leafer, calling the api only for new moves.
-        i = 0
-        while i < len(secondList):
-            for pgn, cumulative, likelyPath in secondList:
-                Leafer(self.settings, self.status, self.engine, pgn, cumulative, likelyPath)
-                secondList.extend(pgnsreturned)
-                i += 1
-                # logging.debug("iterative",secondList)
-           
-        #print ("final line list: ", finalLine)
-        
-
-        #we remove duplicate lines
-        uniqueFinalLine = []
-        for line in finalLine:
-            if line not in uniqueFinalLine:
-                uniqueFinalLine.append(line)
-        # logging.debug(f"unique lines with subsets {uniqueFinalLine}")     
-        
-        printerFinalLine = [] #we prepare a list ready for printing
-        
-        # we remove lines that are subsets of other lines because no valid repsonse was found
-        for line in uniqueFinalLine:
-            uniqueFinalLinestring = str(uniqueFinalLine)
-            lineString = str(line[0]) + " "
-            lineCount = uniqueFinalLinestring.count(lineString)
-            if lineCount == 0:
-                printerFinalLine.append(line) #we add line to go to print
-            else:
-                logging.debug(f"duplicate line {line}")
-            logging.debug(f"final line count { lineCount+1 } for line {lineString}")
+        if engineSettings.cache_enabled:
+            # with several threads the search is not deterministic and the hash size changes what a fixed depth finds,
+            # so evaluations are only reused by the same engine with the same Threads and Hash
+            identity = f"{self.engine.id.get('name', engineSettings.path)} Threads={engineSettings.threads} Hash={engineSettings.hash}"
+            self.engine = CachedEngine(self.engine, EngineCache(engineSettings.cache_path), identity)
+
+    def prefetch(self, batch):
+        with self.metrics.time('prefetch'):
+            self._prefetch(batch)
+
+    def _prefetch(self, batch):
+        # we fetch every leaf of the batch concurrently, then every position after their valid continuations
+        self.explorer.prefetch([node.board.fen() for node in batch])
+
+        continuations = []
+        for node in batch:
+            board = node.board
+            workerPlay = WorkerPlay(self.settings, self.status, self.engine, self.explorer, board.fen(), board)
+            for move in valid_continuations(self.settings.moveSelection, workerPlay.find_move_tree(), node.cumulative):
+                board.push_san(move['san'])
+                continuations.append((board.copy(stack=False), move))
+                board.pop()
+        self.explorer.prefetch([board.fen() for board, _ in continuations])
 
-        logging.debug(f'we sort the lines by consecutive move probabilities')
+        if self.engine and self.settings.engine.processes > 1:
+            self.search_ahead(continuations)
 
-        def extract_key(printerFinalLine):
-            return [v for _, v in printerFinalLine[2]]
+    def search_ahead(self, continuations):
+        # with several engine processes we search the replies to every continuation of the batch at once, leafer then finds them in the graph
+        candidates = {}
+        for board, move in continuations:
+            node = self.graph.node(board)
+            if node.candidate is None:
+                candidates[node.key] = (node, board)
+        self.graph.search_ahead('candidate', list(candidates.values()))
 
-        printerFinalLine = sorted(printerFinalLine, key=extract_key)
-        
-        for line in printerFinalLine:
-            logging.debug (line[0])
-        
-        logging.debug (f'we reverse the sort to make long to short')
-        if self.settings.book.order.LONG_TO_SHORT:
-            printerFinalLine.reverse() #we make the longest (main lines) first
-        
-        for line in printerFinalLine:
-            logging.debug (line[0])
-        
-        #we print the final list of lines
-        logging.debug(f'number of final lines {len(printerFinalLine)}')
-        logging.debug(f'final line sorted {printerFinalLine}')
-        printer = Printer(self.settings, f"{working_dir}/Chapter_{chapter}_{openingName}.pgn")
+        if not self.settings.engine.finish:
+            return
+        engineMoves = {}
+        for board, move in continuations:
+            node = self.graph.node(board)
+            _, _, potency, _, totalGames = node.candidate
+            if node.engineMove is None and not has_good_reply(self.settings.moveSelection, move, totalGames, potency):
+                engineMoves[node.key] = (node, board)
+        self.graph.search_ahead('engineMove', list(engineMoves.values()))
+
+    def open_journal(self, chapter, openingName, openingPgn):
+        if not self.settings.book.resume:
+            return None
+        return ChapterJournal(chapter_path(chapter, openingName, '.journal'),
+                              journal_fingerprint(self.settings, openingPgn),
+                              self.settings.book.checkpoint_seconds)
+
+    def remove_journal(self, chapter, openingName):
+        path = chapter_path(chapter, openingName, '.journal')
+        if os.path.exists(path):
+            os.remove(path)
 
-        lineNumber = 1        
-        for pgn, cumulative, likelyPath, winRate, Games in printerFinalLine:
-            printer.print(pgn, cumulative, likelyPath, winRate, Games, lineNumber, openingName)
-            lineNumber += 1
+    def iterator(self, chapter, openingName, openingPgn):
+        journal = self.open_journal(chapter, openingName, openingPgn)
+        if journal and journal.done and os.path.exists(chapter_path(chapter, openingName)):
+            logging.info(f"Chapter {chapter} was finished by an interrupted run, keeping it")
+            self.status.info(f"Book #{chapter} '{openingName}' was finished before the last run stopped, keeping it")
+            journal.close()
+            return
+        try:
+            self.grow_chapter(chapter, openingName, openingPgn, journal)
+        finally:
+            if journal:
+                journal.close()
+
+    def grow_chapter(self, chapter, openingName, openingPgn, journal):
+        metrics = self.metrics
+        metrics.start_chapter(chapter, openingName)
+        root = None
+        if journal:
+            #a resumed chapter takes the opening likelihoods from the journal, so it makes no explorer calls for them
+            rootBoard = chess.pgn.read_game(io.StringIO(openingPgn)).end().board().copy(stack=False)
+            root = journal.replay_root(rootBoard)
+        if root is None:
+            with metrics.time('rooter'):
+                rooter = Rooter(self.settings, self.status, self.engine, self.explorer, openingPgn)
+            root, rootBoard = rooter.node, rooter.board
+            if journal:
+                journal.record_root(root)
+        writer = ChapterWriter(self.settings, chapter_path(chapter, openingName), openingName, openingPgn, rootBoard)
+        book = None
+        if self.settings.book.polyglot:
+            book = PolyglotBook(chapter_path(chapter, openingName, '.bin'))
+            book.add_opening(chess.pgn.read_game(io.StringIO(openingPgn)), root)
+
+        #we expand lines from the frontier with leafer, calling the api only for new moves, until no line has valid continuations
+        #with a budget we expand the most likely lines first, so we have the best partial repertoire when it runs out
+        search = self.settings.search
+        order = FrontierOrder.PRIORITY if self.budget.is_limited() else search.frontier_order
+        frontier = Frontier(order, search.batch_size, self.memory.is_limited())
+        self.memory.peak = 0 #peaks are per chapter
+        frontier.push(root, root.cumulative)
+        unexpanded = []
+        while frontier:
+            batch = frontier.next_batch()
+            if not self.budget.exhausted():
+                self.prefetch([node for node in batch if not (journal and journal.has(node))]) #journaled lines need no explorer stats
+            for index, node in enumerate(batch):
+                self.cancelToken.check()
+                board = node.board #leafer lets go of the line's board, the book still needs it
+                #lines expanded before the last run stopped are replayed from the journal, in the order they were expanded
+                leafer = journal.replay(node) if journal else None
+                if leafer is not None:
+                    metrics.count('lines.replayed')
+                elif self.budget.exhausted():
+                    unexpanded = batch[index:] + frontier.drain()
+                    break
+                else:
+                    with metrics.time('leafer'): #includes picking candidates and engine searches not done ahead
+                        leafer = Leafer(self.settings, self.status, self.engine, self.explorer, self.graph, node)
+                    metrics.count('lines.expanded')
+                    if journal:
+                        journal.record(node, leafer)
+                if leafer.pgnList:
+                    if book:
+                        with metrics.time('polyglot.add'):
+                            book.add_expansion(board, leafer.pgnList)
+                    #lines ending here are subsets of the continuations, so we drop them
+                    for child in leafer.pgnList:
+                        frontier.push(child, child.cumulative)
+                else:
+                    #a line with no continuations can't be a subset of another, so its final lines are written straight away
+                    with metrics.time('final_lines.add'):
+                        finalLines = dict.fromkeys(leafer.finalLines) #we remove duplicate lines
+                        for finalNode, winRate, games in finalLines:
+                            writer.add(finalNode, winRate, games)
+                    metrics.count('lines.final', len(finalLines))
+                    metrics.count('lines.duplicates', len(leafer.finalLines) - len(finalLines))
+            writer.flush()
+            self.explorer.clear_prefetched()
+            if journal:
+                journal.checkpoint()
+            if self.memory.exceeded():
+                #queued and finished lines are what grows without bound on deep runs, so they move to disk
+                with metrics.time('memory.spill'):
+                    spilled = frontier.spill()
+                    writer.spill()
+                    if book:
+                        book.spill()
+                    self.explorer.memo.shrink()
+                metrics.count('memory.spilled_lines', spilled)
+            metrics.peak('memory.peak_rss_mb', round(self.memory.peak / 1024 / 1024, 1))
+            self.status.info2(f"Chapter {chapter}: {frontier.progress()}")
+            self.status.metrics(metrics.summary(chapter))
+        logging.info(f"Chapter {chapter} search done: {frontier.progress()}")
+
+        if unexpanded:
+            #lines we have no budget left to expand end with our last move
+            logging.info(f"Budget {self.budget.exhausted()}, chapter {chapter} keeps {len(unexpanded)} lines unexpanded")
+            self.status.info(f"Budget {self.budget.exhausted()}, writing partial book #{chapter} '{openingName}'")
+            with metrics.time('final_lines.add'):
+                for node in unexpanded:
+                    node.board = None
+                    writer.add(node, node.winRate, node.games)
+            metrics.count('lines.unexpanded', len(unexpanded))
+
+        with metrics.time('final_lines.sort'):
+            writer.finish()
+        self.memory.sample()
+        metrics.peak('memory.peak_rss_mb', round(self.memory.peak / 1024 / 1024, 1))
+        logging.info(f"Chapter {chapter} peak memory {self.memory.peak / 1024 / 1024:.0f} MB")
+        if book:
+            with metrics.time('polyglot.write'):
+                book.write()
+        if journal:
+            journal.finish()
+        metrics.finish_chapter()
+        self.status.metrics(metrics.summary(chapter))
+
+
+_chapterRateLimit = None
+_chapterUpdates = None
+_chapterCancelToken = None
+
+
+def _start_chapter_worker(rateLimit, updates, cancelToken):
+    global _chapterRateLimit, _chapterUpdates, _chapterCancelToken
+    _chapterRateLimit = rateLimit
+    _chapterUpdates = updates
+    _chapterCancelToken = cancelToken
+
+
+def split_engine(engineSettings, workers: int):
+    # the books at once share the engine settings, so together they run no more processes, threads and hash than those
+    if engineSettings.processes >= workers:
+        engineSettings.processes //= workers
+        return
+    share = engineSettings.processes / workers #fewer processes than books, so each book gets one with part of the threads and hash
+    engineSettings.processes = 1
+    engineSettings.threads = max(1, int(engineSettings.threads * share))
+    engineSettings.hash = max(16, int(engineSettings.hash * share)) #the smallest hash the settings allow
+
+
+def _grow_chapter(settings, chapter, openingName, openingPgn, directory, workers):
+    #runs one chapter in a worker process, the gui status is only reachable through the update queue
+    global working_dir
+    working_dir = directory
+    split_engine(settings.engine, workers)
+    status = QueueStatus(_chapterUpdates, chapter)
+    grower = Grower()
+    grower.is_running = True
+    grower.cancelToken = _chapterCancelToken
+    try:
+        grower.start(settings, status, _chapterRateLimit)
+        status.info(f"Generating book #{chapter} '{openingName}' for PGN '{openingPgn}'")
+        grower.iterator(chapter, openingName, openingPgn)
+    finally:
+        grower.stop()
+    #what the worker recorded outside the chapter, like starting its engines, adds to the run's chapter 0
+    return grower.metrics.chapter_reports()
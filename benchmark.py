@@ -0,0 +1,490 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+import chess
+import chess.engine
+import chess.polyglot
+
+import BookBuilder
+from BookBuilder import Grower, Rooter, Leafer, ChapterWriter
+from explorer import normalize_fen
+from explorer_replay import Recording, Replayer, ReplayAdapter
+from frontier import LineNode
+from generation_worker import CancelToken
+from position_graph import PositionGraph
+from settings import Settings
+from uci_engine import TimedEngine
+from workerEngineReduce import WorkerPlay
+
+BASELINE_PATH = 'benchmark_baseline.json'
+
+
+class SyntheticTree:
+    """
+    Made up explorer answers for any position, so benchmarks control the size and branching of the tree they search.
+    Every position has `branching` moves, the most played move gets `share` of the games and each next one `share` of the rest,
+    and the games in a position fall by `decay` with every half move.
+    """
+
+    def __init__(self, branching: int, share: float = 0.5, decay: float = 0.7, games: int = 1000000, seed: int = 0, latency: float = 0):
+        self.branching = branching
+        self.share = share
+        self.decay = decay
+        self.games = games
+        self.seed = seed
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def position(self, fen: str) -> dict:
+        board = chess.Board(fen)
+        rng = random.Random(f"{self.seed} {normalize_fen(fen)}") #the same position always gets the same answer
+        legal = sorted(board.legal_moves, key=chess.Move.uci)
+        rng.shuffle(legal)
+        games = self.games * self.decay ** board.ply()
+        moves = []
+        remaining = games
+        for move in legal[:self.branching]:
+            total = int(remaining * self.share * rng.uniform(0.8, 1.2))
+            remaining -= total
+            if total <= 0:
+                break
+            white = int(total * rng.uniform(0.3, 0.5))
+            black = int(total * rng.uniform(0.3, 0.5))
+            # the explorer gives castling moves as king takes rook, which is what WorkerPlay looks for
+            uci = board.uci(move, chess960=True) if board.is_castling(move) else move.uci()
+            moves.append({'uci': uci, 'san': board.san(move), 'white': white, 'black': black, 'draws': total - white - black})
+        unlisted = int(remaining) // 3 #games with moves outside the top ones still count for the position
+        return {
+            'white': sum(move['white'] for move in moves) + unlisted,
+            'black': sum(move['black'] for move in moves) + unlisted,
+            'draws': sum(move['draws'] for move in moves) + unlisted,
+            'moves': moves
+        }
+
+    def respond(self, url: str):
+        # answers like Replayer.respond, so ReplayAdapter serves it to the explorer session
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+        return 200, self.position(parse_qs(urlsplit(url).query)['fen'][0])
+
+
+class StubEngine:
+    """
+    Deterministic stand-in for a UCI engine, every move gets a made up evaluation from the zobrist hash of its position.
+    A search costs one hash and a move generation, so benchmarks time BookBuilder rather than the engine.
+    """
+
+    def _lines(self, board: chess.Board, moves):
+        key = chess.polyglot.zobrist_hash(board)
+        lines = [((key ^ (move.from_square * 64 + move.to_square) * 2654435761) % 201 - 100, move) for move in moves] #centipawns for the side to move
+        lines.sort(key=lambda line: (-line[0], line[1].uci()))
+        return lines
+
+    def _info(self, board: chess.Board, limit: chess.engine.Limit, cp: int, move: chess.Move) -> dict:
+        return {'score': chess.engine.PovScore(chess.engine.Cp(cp), board.turn), 'pv': [move], 'depth': limit.depth}
+
+    def play(self, board: chess.Board, limit: chess.engine.Limit, **kwargs) -> chess.engine.PlayResult:
+        _, move = self._lines(board, board.legal_moves)[0]
+        return chess.engine.PlayResult(move, None)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, multipv: int = None, root_moves=None, **kwargs):
+        moves = list(root_moves or board.legal_moves)
+        if not moves:
+            return [] if multipv else {'score': chess.engine.PovScore(chess.engine.Cp(0), board.turn), 'depth': limit.depth}
+        lines = [self._info(board, limit, cp, move) for cp, move in self._lines(board, moves)[:multipv or 1]]
+        return lines if multipv else lines[0]
+
+    def quit(self):
+        pass
+
+
+class NullStatus:
+    # benchmarks have no GUI to report to, and queueing every update would add to the memory we measure
+    def info(self, line1: str = "", line2: str = ""):
+        pass
+
+    def info2(self, line2):
+        pass
+
+    def error(self, line1: str = "", line2: str = ""):
+        logging.error(f"{line1} {line2}")
+
+    def metrics(self, line3):
+        pass
+
+
+class BenchmarkGrower(Grower):
+    """
+    Grower answering the explorer from a synthetic tree or a recording, with the stub engine when the engine is enabled
+    """
+
+    def __init__(self, responder):
+        self.responder = responder
+        self.cancelToken = CancelToken()
+        self.nodes = 0
+        self.explorerCalls = 0
+        self.engineCalls = 0
+
+    def start_engine(self):
+        self.engine = TimedEngine(StubEngine(), self.metrics) if self.settings.engine.enabled else None
+
+    def start(self, settings, status, rateLimit=None):
+        super().start(settings, status, rateLimit)
+        self.explorer.session.mount(settings.explorer.url, ReplayAdapter(self.responder))
+
+    def stop(self):
+        # the graph, explorer and engine are gone after stopping, so we take their counts first
+        if self.graph:
+            self.nodes = sum(node.expansions for node in self.graph.nodes.values())
+        if self.explorer:
+            self.explorerCalls = self.explorer.calls
+        if self.engine:
+            self.engineCalls = self.engine.calls
+        super().stop()
+
+
+def benchmark_settings(depth: float, engine: bool = False, multipv: bool = False, runLines: int = 100000, memoryLimit: int = 0) -> Settings:
+    settings = Settings()
+    settings.moveSelection.depth_likelihood = depth
+    settings.explorer.cache_enabled = False #every run starts cold, so explorer calls are comparable
+    settings.explorer.record_enabled = False
+    settings.search.incremental = False #a kept position graph would answer the next repeat without any work
+    settings.engine.enabled = engine
+    settings.engine.multipv = multipv
+    settings.engine.processes = 1
+    settings.engine.cache_enabled = False
+    settings.book.sort_run_lines = runLines
+    settings.search.memory_limit_mb = memoryLimit
+    return settings
+
+
+def counts(nodes: int, explorerCalls: int, engineCalls: int) -> dict:
+    return {'nodes': nodes, 'explorer_calls': explorerCalls, 'engine_calls': engineCalls}
+
+
+class Scenario:
+    """
+    One benchmark, setup builds what it needs outside the timing and run does the timed work and returns its counts
+    """
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+
+    def setup(self):
+        return None
+
+    def run(self, state) -> dict:
+        raise NotImplementedError
+
+    def cleanup(self, state):
+        pass
+
+
+class GenerationScenario(Scenario):
+    # a whole chapter through Grower.iterator: rooter, prefetching, leafer, candidates, engine finishing and the sorted chapter file
+    def __init__(self, name, description, pgn, responder, **settings):
+        super().__init__(name, description)
+        self.pgn = pgn
+        self.responder = responder
+        self.settings = settings
+
+    def run(self, state) -> dict:
+        grower = BenchmarkGrower(self.responder())
+        grower.is_running = True
+        try:
+            grower.start(benchmark_settings(**self.settings), NullStatus())
+            grower.iterator(1, self.name, self.pgn)
+        finally:
+            grower.stop()
+            grower.remove_journal(1, self.name) #the next repeat starts over instead of resuming
+        return counts(grower.nodes, grower.explorerCalls, grower.engineCalls)
+
+
+class ExpandedScenario(Scenario):
+    # scenarios over the lines a breadth first run expands, with their explorer answers already in the position memo
+    def __init__(self, name, description, pgn, responder, lines, **settings):
+        super().__init__(name, description)
+        self.pgn = pgn
+        self.responder = responder
+        self.lines = lines
+        self.settings = settings
+
+    def setup(self):
+        grower = BenchmarkGrower(self.responder())
+        grower.is_running = True
+        grower.start(benchmark_settings(**self.settings), NullStatus())
+        rooter = Rooter(grower.settings, grower.status, grower.engine, grower.explorer, self.pgn)
+        boards = []
+        frontier = deque([rooter.node])
+        while frontier and len(boards) < self.lines:
+            node = frontier.popleft()
+            boards.append((node.board.copy(stack=False), node.cumulative))
+            frontier.extend(Leafer(grower.settings, grower.status, grower.engine, grower.explorer, grower.graph, node).pgnList)
+        return grower, boards
+
+    def cleanup(self, state):
+        grower, _ = state
+        grower.stop()
+
+    def counted(self, grower, run):
+        calls = grower.explorer.calls
+        engineCalls = grower.engine.calls if grower.engine else 0
+        nodes = run()
+        return counts(nodes, grower.explorer.calls - calls, (grower.engine.calls if grower.engine else 0) - engineCalls)
+
+
+class LeaferScenario(ExpandedScenario):
+    # leafer on every line again with a fresh position graph, so each candidate is picked again
+    def run(self, state) -> dict:
+        grower, boards = state
+
+        def expand():
+            graph = PositionGraph(grower.settings, grower.status, grower.engine, grower.explorer)
+            for board, cumulative in boards:
+                node = LineNode(None, None, None, 1, cumulative, 0, 0, board.copy(stack=False))
+                Leafer(grower.settings, grower.status, grower.engine, grower.explorer, graph, node)
+            return len(boards)
+        return self.counted(grower, expand)
+
+
+class CandidateScenario(ExpandedScenario):
+    # pick_candidate for our move after every continuation of every line
+    def setup(self):
+        grower, boards = super().setup()
+        positions = []
+        for board, _ in boards:
+            for move in WorkerPlay(grower.settings, grower.status, grower.engine, grower.explorer, board.fen(), board).find_move_tree():
+                board.push_san(move['san'])
+                positions.append((board.copy(stack=False), board.fen()))
+                board.pop()
+        for board, fen in positions: #answers for these positions are in the memo before timing
+            WorkerPlay(grower.settings, grower.status, grower.engine, grower.explorer, fen, board)
+        return grower, positions
+
+    def run(self, state) -> dict:
+        grower, positions = state
+
+        def pick():
+            for board, fen in positions:
+                WorkerPlay(grower.settings, grower.status, grower.engine, grower.explorer, fen, board).pick_candidate()
+            return len(positions)
+        return self.counted(grower, pick)
+
+
+class FinalLinesScenario(Scenario):
+    # dropping duplicate final lines, then sorting and printing them like Grower.iterator does, optionally through spilled runs
+    def __init__(self, name, description, branching, depth, runLines):
+        super().__init__(name, description)
+        self.branching = branching
+        self.depth = depth
+        self.runLines = runLines
+
+    def setup(self):
+        settings = benchmark_settings(0.01, runLines=self.runLines)
+        rng = random.Random(0)
+        root = LineNode(None, None, None, 1, 1, 0.5, 100, None)
+        root.prefix = []
+        frontier = [(root, chess.Board())]
+        for _ in range(self.depth):
+            children = []
+            for parent, board in frontier:
+                legal = sorted(board.legal_moves, key=chess.Move.uci)
+                for continuation in rng.sample(legal, min(self.branching, len(legal))):
+                    continuationSan = board.san(continuation)
+                    board.push(continuation)
+                    replies = sorted(board.legal_moves, key=chess.Move.uci)
+                    if replies:
+                        reply = rng.choice(replies)
+                        replySan = board.san(reply)
+                        board.push(reply)
+                        playrate = rng.uniform(0.01, 0.9)
+                        children.append((LineNode(parent, continuationSan, replySan, playrate, parent.cumulative * playrate,
+                                                  rng.random(), rng.randint(20, 10000), None), board.copy(stack=False)))
+                        board.pop()
+                    board.pop()
+            frontier = children
+        # leafer gives a line once per continuation without a good reply, so final lines come with duplicates
+        finalLines = [(node, node.winRate, node.games) for node, _ in frontier for _ in range(2)]
+        return settings, finalLines
+
+    def run(self, state) -> dict:
+        settings, finalLines = state
+        directory = tempfile.mkdtemp(prefix='bookbuilder_benchmark_')
+        try:
+            writer = ChapterWriter(settings, os.path.join(directory, f"Chapter_1_{self.name}.pgn"), self.name, '', chess.Board())
+            for finalNode, winRate, games in dict.fromkeys(finalLines):
+                writer.add(finalNode, winRate, games)
+            writer.finish()
+            return counts(len(finalLines) // 2, 0, 0)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def scenarios(recording: str = None, pgn: str = '1. e4'):
+    """
+    Every benchmark, on the synthetic tree unless a recording of a real run is given
+    """
+    if recording:
+        responder = lambda: Replayer(Recording(recording))
+        tree = f"recording {os.path.basename(recording)}"
+    else:
+        responder = lambda: SyntheticTree(branching=4)
+        tree = "synthetic tree, 4 moves per position"
+    wide = lambda: SyntheticTree(branching=8, share=0.35)
+    slow = lambda: SyntheticTree(branching=4, latency=0.002)
+    return [
+        GenerationScenario('generate-small', f"Grower.iterator, depth 1%, {tree}", pgn, responder, depth=0.01),
+        GenerationScenario('generate-large', f"Grower.iterator, depth 0.2%, {tree}", pgn, responder, depth=0.002),
+        GenerationScenario('generate-large-bounded', f"Grower.iterator, depth 0.2%, {tree}, lines moved to disk after every batch",
+                           pgn, responder, depth=0.002, memoryLimit=1),
+        GenerationScenario('generate-wide', "Grower.iterator, depth 0.5%, synthetic tree, 8 moves per position", pgn, wide, depth=0.005),
+        GenerationScenario('generate-latency', "Grower.iterator, depth 1%, synthetic tree, 2ms per explorer request", pgn, slow, depth=0.01),
+        GenerationScenario('generate-engine', f"Grower.iterator with the stub engine, depth 1%, {tree}", pgn, responder, depth=0.01, engine=True),
+        GenerationScenario('generate-multipv', f"Grower.iterator with the stub engine and MultiPV, depth 1%, {tree}", pgn, responder,
+                           depth=0.01, engine=True, multipv=True),
+        LeaferScenario('leafer', f"Leafer on up to 500 lines, explorer answers memoized, {tree}", pgn, responder, 500, depth=0.002),
+        CandidateScenario('pick-candidate', f"pick_candidate after the continuations of up to 300 lines, {tree}", pgn, responder, 300, depth=0.002),
+        CandidateScenario('pick-candidate-engine', f"pick_candidate with the stub engine after the continuations of up to 300 lines, {tree}",
+                          pgn, responder, 300, depth=0.002, engine=True),
+        FinalLinesScenario('final-lines', "dedup, sort and print 20736 final lines", 12, 4, 100000),
+        FinalLinesScenario('final-lines-spill', "dedup, sort and print 20736 final lines through sorted runs of 2000", 12, 4, 2000),
+    ]
+
+
+def measure(scenario: Scenario, repeat: int, memory: bool) -> dict:
+    """
+    Median wall time over the repeats, and the peak memory traced in one more run, since tracing slows the run down
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        state = scenario.setup()
+        try:
+            started = time.perf_counter()
+            result = scenario.run(state)
+            times.append(time.perf_counter() - started)
+        finally:
+            scenario.cleanup(state)
+    result['wall_seconds'] = round(statistics.median(times), 4)
+
+    if memory:
+        state = scenario.setup()
+        tracemalloc.start()
+        try:
+            scenario.run(state)
+            result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        finally:
+            tracemalloc.stop()
+            scenario.cleanup(state)
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Lines describing how the results differ from the baseline. Counts are deterministic, so a changed count starts with 'CHANGED'.
+    Wall times and traced memory vary from run to run on the same code, so growth past the tolerance starts with 'SLOWER' or 'MORE MEMORY'.
+    """
+    report = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            report.append(f"{name}: not in the baseline")
+            continue
+        changed = [f"{key} {base[key]} -> {result[key]}" for key in ('nodes', 'explorer_calls', 'engine_calls') if result[key] != base.get(key)]
+        if changed:
+            # the counts are deterministic, so a change means the search itself expands different lines
+            report.append(f"CHANGED {name}: {', '.join(changed)}")
+        for key, label in (('wall_seconds', 'SLOWER'), ('peak_mb', 'MORE MEMORY')):
+            if key not in result or not base.get(key):
+                continue
+            ratio = result[key] / base[key] - 1
+            if ratio > tolerance:
+                report.append(f"{label} {name}: {key} {base[key]} -> {result[key]} ({ratio:+.0%})")
+            else:
+                report.append(f"{name}: {key} {base[key]} -> {result[key]} ({ratio:+.0%})")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark book generation and its hot paths against synthetic or recorded explorer trees, "
+                                                 "and compare with a stored baseline")
+    parser.add_argument('--only', nargs='*', default=[], help="scenario names to run, all of them by default")
+    parser.add_argument('--list', action='store_true', help="list the scenarios and exit")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per scenario, the median counts")
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced run measuring peak memory")
+    parser.add_argument('--recording', help="explorer recording made with 'Record responses', used instead of the synthetic tree")
+    parser.add_argument('--pgn', default='1. e4', help="opening the generation scenarios start from")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline results to compare with")
+    parser.add_argument('--update-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown or memory growth over the baseline that is reported")
+    parser.add_argument('--strict', action='store_true', help="also exit with 1 when a scenario is slower or uses more memory than the tolerance allows")
+    parser.add_argument('--output', help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO) #debug logging of every line would be most of what we time
+    selected = [scenario for scenario in scenarios(args.recording, args.pgn) if not args.only or scenario.name in args.only]
+    if args.list:
+        for scenario in selected:
+            print(f"{scenario.name:24} {scenario.description}")
+        return 0
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix='bookbuilder_benchmark_')
+    BookBuilder.working_dir = directory #chapters written by the generation scenarios go here
+    try:
+        print(f"{'scenario':24} {'wall s':>9} {'nodes':>7} {'explorer':>9} {'engine':>7} {'peak MB':>8}")
+        for scenario in selected:
+            result = measure(scenario, max(1, args.repeat), not args.no_memory)
+            results[scenario.name] = result
+            print(f"{scenario.name:24} {result['wall_seconds']:9.3f} {result['nodes']:7} {result['explorer_calls']:9} "
+                  f"{result['engine_calls']:7} {result.get('peak_mb', '-'):>8}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    regressions = []
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.setdefault('scenarios', {}).update(results)
+        baseline['machine'] = f"{platform.platform()}, {platform.processor() or platform.machine()}, Python {platform.python_version()}"
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2)
+        print(f"Stored the results as the baseline in {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        print(f"\nCompared with {args.baseline} ({baseline.get('machine', 'unknown machine')}), tolerance {args.tolerance:.0%}:")
+        for line in compare(results, baseline.get('scenarios', {}), args.tolerance):
+            print(line)
+            # timings are only noise on a busy or different machine, so by default only changed counts fail
+            if line.startswith(('SLOWER', 'MORE MEMORY', 'CHANGED') if args.strict else 'CHANGED'):
+                regressions.append(line)
+    else:
+        print(f"No baseline at {args.baseline}, store one with --update-baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,378 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from generation_worker import CancelToken
+from metrics import Histogram, Metrics
+from settings import EXPLORER_URL, ExplorerSource
+
+
+def normalize_fen(fen: str) -> str:
+    # explorer stats only depend on the position, so we drop the halfmove clock and fullmove number
+    return ' '.join(fen.split(' ')[:4])
+
+
+class RateLimit:
+    """
+    Lichess rate limit pause and network call count, shared by every explorer of a run, across processes when chapters run in parallel
+    """
+
+    def __init__(self, context=multiprocessing):
+        self._pausedUntil = context.Value('d', 0.0)
+        self._calls = context.Value('i', 0)
+
+    @property
+    def calls(self) -> int:
+        return self._calls.value
+
+    def count(self):
+        with self._calls.get_lock():
+            self._calls.value += 1
+
+    def wait(self, cancelToken: CancelToken) -> float:
+        seconds = self._pausedUntil.value - time.time()
+        cancelToken.wait(seconds)
+        return max(0.0, seconds)
+
+    def pause(self, seconds: float):
+        with self._pausedUntil.get_lock():
+            self._pausedUntil.value = max(self._pausedUntil.value, time.time() + seconds)
+
+
+class ExplorerCache:
+    """
+    Persistent SQLite cache of opening explorer responses, keyed by normalized FEN and database settings fingerprint
+    """
+
+    def __init__(self, path: str, ttl_days: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # parallel chapters share the file, so writers wait on each other instead of failing
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "fen TEXT NOT NULL, "
+            "fingerprint TEXT NOT NULL, "
+            "response TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "accessed REAL NOT NULL, "
+            "PRIMARY KEY (fen, fingerprint))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._connection.commit()
+        self._expire()
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        logging.info(f"Opened explorer cache at {path} with {self._entries} entries")
+
+    def get(self, fen: str, fingerprint: str):
+        key = normalize_fen(fen)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created FROM responses WHERE fen = ? AND fingerprint = ?",
+                (key, fingerprint)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE responses SET accessed = ? WHERE fen = ? AND fingerprint = ?", (now, key, fingerprint))
+            self._connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, fen: str, fingerprint: str, response: dict):
+        key = normalize_fen(fen)
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT OR REPLACE INTO responses (fen, fingerprint, response, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, fingerprint, json.dumps(response), now, now))
+            self._entries += cursor.rowcount
+            if self._entries > self.max_entries:
+                self._evict()
+            self._connection.commit()
+
+    def _expire(self):
+        cursor = self._connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self.evictions += cursor.rowcount
+        self._connection.commit()
+
+    def _evict(self):
+        # we evict the least recently used tenth in one go, so we don't pay for a delete on every insert
+        excess = self._entries - self.max_entries + max(1, self.max_entries // 10)
+        cursor = self._connection.execute(
+            "DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY accessed LIMIT ?)", (excess,))
+        self.evictions += cursor.rowcount
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f"explorer cache: {self.hits} hits, {self.misses} misses ({'{:.2%}'.format(hit_rate)} hit rate), {self.evictions} evicted, {self._entries} entries"
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class PositionMemo:
+    """
+    Bounded in-memory LRU of parsed position stats, shared by every WorkerPlay during one generation run
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __contains__(self, fen: str) -> bool:
+        return normalize_fen(fen) in self._entries
+
+    def get(self, fen: str):
+        key = normalize_fen(fen)
+        with self._lock:
+            stats = self._entries.get(key)
+            if stats is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return stats
+
+    def put(self, fen: str, stats: dict):
+        key = normalize_fen(fen)
+        with self._lock:
+            self._entries[key] = stats
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def shrink(self):
+        # when memory runs short we keep the most recently used half, the others are read from the explorer cache again
+        with self._lock:
+            for _ in range(len(self._entries) // 2):
+                self._entries.popitem(last=False)
+
+    def stats(self) -> str:
+        return f"position memo: {self.hits} lookups saved, {self.misses} misses, {len(self._entries)} positions held"
+
+
+class Explorer:
+    """
+    Gets opening explorer stats for positions, from the persistent cache when possible and from Lichess otherwise
+    """
+
+    def __init__(self, settings, status, rateLimit: RateLimit = None, cancelToken: CancelToken = None, metrics: Metrics = None):
+        self.settings = settings
+        self.status = status
+        self.rateLimit = rateLimit or RateLimit()
+        self.cancelToken = cancelToken or CancelToken()
+        self.metrics = metrics or Metrics()
+        self.calls = 0
+        self.retries = 0
+        self.latencies = Histogram() #bucketed, so long runs don't keep every request time
+        self._lock = threading.Lock() #prefetching fetches on several threads
+        self.session = self._create_session()
+        self.memo = PositionMemo(settings.explorer.memo_max_entries)
+        self._prefetched = {}
+        self.local = None
+        if settings.explorer.source == ExplorerSource.LOCAL:
+            from local_explorer import LocalExplorerIndex #imported here, the index module uses normalize_fen from this one
+            self.local = LocalExplorerIndex(settings.explorer.local_index_path)
+        self.replayer = None
+        self.recording = None
+        if settings.explorer.source == ExplorerSource.REPLAY:
+            # replayed responses come through the session like real ones, so retries and rate limit pauses still run
+            from explorer_replay import Recording, Replayer, ReplayAdapter
+            self.replayer = Replayer(Recording(settings.explorer.recording_path),
+                                     settings.explorer.replay_latency,
+                                     settings.explorer.replay_rate_limit_every)
+            self.session.mount(settings.explorer.url, ReplayAdapter(self.replayer))
+        elif settings.explorer.record_enabled:
+            from explorer_replay import Recording
+            self.recording = Recording(settings.explorer.recording_path)
+        self.cache = None
+        if settings.explorer.cache_enabled and not self.local and not self.replayer:
+            self.cache = ExplorerCache(settings.explorer.cache_path,
+                                       settings.explorer.cache_ttl_days,
+                                       settings.explorer.cache_max_entries)
+
+    def _create_session(self):
+        # one pooled keep-alive session for all requests, so we only pay for the TCP and TLS handshakes once
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self.settings.explorer.concurrency))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Accept': 'application/json'})
+        return session
+
+    # generate the Lichess API URL from config file
+    def url(self, fen: str) -> str:
+        db = self.settings.database
+        variant = db.variant.value
+        speeds = [speed.value for speed in db.speeds]
+        ratings = [rating.value for rating in db.ratings]
+        moves = db.moves
+        recentGames = 0
+        topGames = 0
+        play = ""
+
+        url = self.settings.explorer.url + '?'
+        url += f'variant={variant}&'
+        url += f'speeds={",".join(speeds)}&'
+        url += f'ratings={",".join(ratings)}&'
+        url += f'recentGames={recentGames}&'
+        url += f'topGames={topGames}&'
+        url += f'moves={moves}&'
+        url += f'play={play}&'
+        url += f'fen={fen}'
+        return url
+
+    def get(self, fen: str) -> dict:
+        if self.local: #a local index lookup is cheaper than the cache
+            with self.metrics.time('explorer.local_lookup'):
+                return self.local.get(fen, self.settings.database)
+
+        response = self._prefetched.pop(normalize_fen(fen), None)
+        if response is not None:
+            return response
+
+        fingerprint = self.settings.database.fingerprint()
+        if self.cache:
+            response = self.cache.get(fen, self.cache_fingerprint(fingerprint))
+            if response is not None:
+                self.metrics.count('explorer.cache_hits')
+
+        if response is None:
+            response = self.fetch(fen)
+            if self.cache and 'moves' in response: #we never cache error responses
+                self.cache.put(fen, self.cache_fingerprint(fingerprint), response)
+        if self.recording is not None and 'moves' in response: #cached responses are recorded too, so a replay has every position of the run
+            self.recording.record(fen, fingerprint, response)
+        return response
+
+    def cache_fingerprint(self, fingerprint: str) -> str:
+        # responses of another explorer, like a stand-in serving a recording, are cached apart from the Lichess ones
+        url = self.settings.explorer.url
+        return fingerprint if url == EXPLORER_URL else f"{fingerprint};url={url}"
+
+    def prefetch(self, fens):
+        if self.local:
+            return
+        # we fetch all positions of a frontier generation concurrently, lines are then still built one by one in order
+        pending = []
+        keys = set()
+        for fen in fens:
+            key = normalize_fen(fen)
+            if key not in keys and key not in self._prefetched and fen not in self.memo:
+                keys.add(key)
+                pending.append(fen)
+        if len(pending) > 1:
+            self.status.info2(f"Looking for moves at {len(pending)} positions")
+            asyncio.run(self._prefetch(pending))
+
+    async def _prefetch(self, fens):
+        semaphore = asyncio.Semaphore(self.settings.explorer.concurrency)
+
+        async def load(fen):
+            async with semaphore:
+                return await asyncio.to_thread(self.get, fen)
+
+        responses = await asyncio.gather(*[load(fen) for fen in fens])
+        for fen, response in zip(fens, responses):
+            self._prefetched[normalize_fen(fen)] = response
+
+    def fetch(self, fen: str) -> dict:
+        url = self.url(fen)
+        timeout = (self.settings.explorer.connect_timeout, self.settings.explorer.read_timeout)
+        #logging.debug(f"url of position {url}") #uncomment for debugging
+        attempt = 0
+        while True:
+            # concurrent requests share one rate limit, so a 429 pauses all of them
+            self.cancelToken.check()
+            waited = self.rateLimit.wait(self.cancelToken)
+            if waited:
+                self.metrics.record('explorer.rate_limit_wait', waited)
+            self.rateLimit.count()
+            with self._lock:
+                self.calls += 1
+            started = time.perf_counter()
+            try:
+                r = self.session.get(url, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                attempt = self._backoff(attempt, f"{type(e).__name__} for FEN {fen}")
+                continue
+            latency = time.perf_counter() - started
+            with self._lock:
+                self.latencies.add(latency)
+            self.metrics.record('explorer.request', latency)
+
+            if r.status_code == 429:
+                pause = self.settings.explorer.rate_limit_pause
+                self.metrics.count('explorer.rate_limited')
+                self.status.info2(f"Hit Lichess API rate limit, waiting for {pause:g} seconds")
+                print(f'Rate limited - waiting {pause:g}s...')
+                self.rateLimit.pause(pause)
+            elif r.status_code >= 500:
+                attempt = self._backoff(attempt, f"HTTP {r.status_code} for FEN {fen}")
+            else:
+                return r.json()
+
+    def _backoff(self, attempt: int, reason: str) -> int:
+        # transient errors are retried with exponential backoff and full jitter, so concurrent requests spread out
+        if attempt >= self.settings.explorer.max_retries:
+            raise Exception(f"Opening explorer request failed after {attempt} retries: {reason}")
+        with self._lock:
+            self.retries += 1
+        self.metrics.count('explorer.retries')
+        delay = random.uniform(0, min(60, 2 ** attempt))
+        logging.warning(f"{reason}, retrying in {delay:.1f}s")
+        self.cancelToken.wait(delay)
+        return attempt + 1
+
+    def latency(self) -> str:
+        with self._lock:
+            if not self.latencies.count:
+                return "no requests"
+            report = self.latencies.report()
+        return f"mean {report['mean_ms']:.0f}ms, p95 at most {report['p95_ms_at_most']:.0f}ms, max {report['max_seconds'] * 1000:.0f}ms"
+
+    def stats(self) -> str:
+        stats = f"explorer: {self.calls} network calls ({self.retries} retries, latency {self.latency()}), {self.memo.stats()}"
+        if self.cache:
+            stats += f", {self.cache.stats()}"
+        if self.local:
+            stats += f", {self.local.stats()}"
+        if self.replayer:
+            stats += f", {self.replayer.stats()}"
+        return stats
+
+    def clear_prefetched(self):
+        # positions the graph already had answers for are never asked for, so what a batch did not use is let go after it
+        self._prefetched.clear()
+
+    def close(self):
+        self._prefetched.clear()
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+        if self.local:
+            self.local.close()
+        if self.recording is not None:
+            self.recording.close()
@@ -0,0 +1,170 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+from requests.adapters import BaseAdapter
+
+from explorer import normalize_fen
+from settings import explorer_fingerprint
+
+EMPTY_RESPONSE = {'white': 0, 'black': 0, 'draws': 0, 'moves': []}
+
+
+class Recording:
+    """
+    Explorer responses captured during a run, one JSON line per position and database settings fingerprint
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.responses = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.responses[(entry['fen'], entry['fingerprint'])] = entry['response']
+        self._file = None
+
+    def __len__(self) -> int:
+        return len(self.responses)
+
+    def get(self, fen: str, fingerprint: str):
+        return self.responses.get((normalize_fen(fen), fingerprint))
+
+    def record(self, fen: str, fingerprint: str, response: dict):
+        key = (normalize_fen(fen), fingerprint)
+        with self._lock:
+            if key in self.responses:
+                return
+            self.responses[key] = response
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(json.dumps({'fen': key[0], 'fingerprint': fingerprint, 'response': response}) + '\n')
+            self._file.flush() #a run that is stopped or crashes keeps what it recorded
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+class Replayer:
+    """
+    Answers explorer URLs from a recording, with optional latency and a 429 every so many requests like a rate limited explorer
+    """
+
+    def __init__(self, recording: Recording, latency: float = 0, rateLimitEvery: int = 0):
+        self.recording = recording
+        self.latency = latency
+        self.rateLimitEvery = rateLimitEvery
+        self.requests = 0
+        self.misses = 0
+        self.rateLimited = 0
+        self._lock = threading.Lock()
+
+    def respond(self, url: str):
+        # returns the status code and json body the explorer would give for the url
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self.rateLimitEvery and self.requests % self.rateLimitEvery == 0:
+                self.rateLimited += 1
+                return 429, {'error': 'Too many requests'}
+
+        query = parse_qs(urlsplit(url).query, keep_blank_values=True)
+        value = lambda name: query.get(name, [''])[0]
+        speeds = [speed for speed in value('speeds').split(',') if speed]
+        ratings = [rating for rating in value('ratings').split(',') if rating]
+        fingerprint = explorer_fingerprint(value('variant'), speeds, ratings, value('moves'))
+        response = self.recording.get(value('fen'), fingerprint)
+        if response is None:
+            # the explorer answers positions nobody played with an empty response, so the run still completes
+            with self._lock:
+                self.misses += 1
+            logging.warning(f"No recorded response for FEN {value('fen')}")
+            return 200, EMPTY_RESPONSE
+        return 200, response
+
+    def stats(self) -> str:
+        return f"replay: {self.requests} requests, {self.misses} not recorded, {self.rateLimited} rate limited"
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    requests transport that answers from a Replayer in process, so the explorer retry and rate limit handling still runs
+    """
+
+    def __init__(self, replayer: Replayer):
+        super().__init__()
+        self.replayer = replayer
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        status, body = self.replayer.respond(request.url)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def serve(recordingPath: str, host: str, port: int, latency: float, rateLimitEvery: int):
+    """
+    Stand-in explorer HTTP server, point the explorer URL setting at it to replay a recording over the network
+    """
+    replayer = Replayer(Recording(recordingPath), latency, rateLimitEvery)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, body = replayer.respond(self.path)
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logging.info(f"Replaying {len(replayer.recording)} responses on http://{host}:{server.server_port}/lichess")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(replayer.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded opening explorer responses, for timing runs offline")
+    parser.add_argument('recording', help="recording made with 'Record responses' under 'Explorer settings'")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to every response")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="answer every nth request with a 429, 0 never does")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(args.recording, args.host, args.port, args.latency, args.rate_limit_every)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import time
+from collections import deque
+from enum import Enum
+
+import chess
+import psutil
+
+MAX_RUNS = 16 #sorted runs of spilled lines kept open before the smallest are merged
+
+
+class LineNode:
+    """
+    One line of the repertoire, stored as the opponent continuation and our reply on top of its parent line.
+    Likelihood paths and moves are only materialized when needed, so memory grows with the number of lines, not their depth.
+    """
+    __slots__ = ('parent', 'continuation', 'reply', 'playrate', 'cumulative', 'winRate', 'games', 'board', 'prefix', 'lineId')
+
+    def __init__(self, parent, continuation, reply, playrate, cumulative, winRate, games, board):
+        self.parent = parent
+        self.continuation = continuation #san of the opponent move
+        self.reply = reply #san of our move
+        self.playrate = playrate #chance of the opponent playing the continuation
+        self.cumulative = cumulative #chance of the opponent playing every continuation in the line
+        self.winRate = winRate #win rate of our reply, in case the line is never expanded
+        self.games = games
+        self.board = board #only held while the line waits on the frontier
+        self.prefix = None #likelihood path of the opening pgn, only set on the root line
+        self.lineId = None #the line's number in the chapter journal, when runs can be resumed
+
+    def likelihood_path(self) -> list:
+        path = []
+        node = self
+        while node.parent is not None:
+            path.append((node.continuation, node.playrate))
+            node = node.parent
+        path.reverse()
+        return node.prefix + path
+
+    def moves(self) -> list:
+        moves = []
+        node = self
+        while node.parent is not None:
+            moves.append((node.continuation, node.reply))
+            node = node.parent
+        moves.reverse()
+        return moves
+
+
+class FrontierOrder(Enum):
+    FIFO = "Breadth first"
+    PRIORITY = "Most likely lines first"
+
+
+class Frontier:
+    """
+    Work queue of lines waiting to be expanded by Leafer, every line pushed is handed out exactly once.
+    When memory runs short, spill moves the queued lines past the next batch to temporary files. They are read back when their
+    turn comes, in the same order as if they had stayed in memory: a disk queue after the memory one when breadth first, and
+    sorted runs merged with the memory heap when most likely first.
+    """
+
+    def __init__(self, order: FrontierOrder, batch_size: int, bounded: bool = False):
+        self.order = order
+        self.batch_size = batch_size
+        self.bounded = bounded #with a memory limit, breadth first hands out batches instead of whole generations
+        self.pushed = 0
+        self.expanded = 0
+        self.max_depth = 0
+        self.spilled = 0 #lines on disk
+        self.started = time.perf_counter()
+        self._queue = deque() if order == FrontierOrder.FIFO else []
+        self._root = None #spilled lines store their moves from the chapter's root line, which stays in memory
+        self._disk = None #breadth first: lines pushed after a spill, behind the ones in memory
+        self._read = 0
+        self._runs = {} #most likely first: run number -> [sorted run file, lines left in it]
+        self._heads = [] #heap of the next line of every run
+        self._nextRun = 0
+
+    def __len__(self) -> int:
+        return len(self._queue) + self.spilled
+
+    def push(self, line, likelihood: float):
+        if self.order == FrontierOrder.FIFO:
+            if self.spilled:
+                self._write(self._disk, self._record(line)) #lines in memory come first, so ours goes behind those on disk
+                self.spilled += 1
+            else:
+                self._queue.append(line)
+        else:
+            # the push counter breaks likelihood ties in insertion order, so runs are deterministic
+            heapq.heappush(self._queue, (-likelihood, self.pushed, line))
+        self.pushed += 1
+        self.max_depth = max(self.max_depth, len(self))
+
+    def pop(self):
+        self.expanded += 1
+        if self.order == FrontierOrder.FIFO:
+            if not self._queue:
+                self._load()
+            return self._queue.popleft()
+        if self._heads and (not self._queue or self._heads[0][:2] < self._queue[0][:2]):
+            _, _, run, record = heapq.heappop(self._heads)
+            self._runs[run][1] -= 1
+            self.spilled -= 1
+            self._next_head(run)
+            return self._restore(record)
+        return heapq.heappop(self._queue)[2]
+
+    def drain(self) -> list:
+        # lines left when the search stops early, most likely first in priority order
+        lines = [self.pop() for _ in range(len(self))]
+        self.expanded -= len(lines)
+        return lines
+
+    def next_batch(self) -> list:
+        # breadth first hands out a whole generation, most likely first the top lines up to the batch size
+        if self.order == FrontierOrder.FIFO and not self.bounded:
+            size = len(self._queue) or min(self.spilled, self.batch_size)
+        else:
+            size = min(len(self), self.batch_size)
+        return [self.pop() for _ in range(size)]
+
+    def spill(self) -> int:
+        """
+        Moves the queued lines past the next batch to disk, returns how many
+        """
+        if len(self._queue) <= 2 * self.batch_size: #spilling a few lines frees nothing worth the writes
+            return 0
+        if self.order == FrontierOrder.FIFO:
+            if self.spilled: #what is in memory is already only the head of the queue
+                return 0
+            lines = [self._queue.pop() for _ in range(len(self._queue) - self.batch_size)]
+            lines.reverse()
+            if self._disk is None:
+                self._disk = tempfile.TemporaryFile()
+            for line in lines:
+                self._write(self._disk, self._record(line))
+        else:
+            queued = sorted(self._queue, key=lambda entry: entry[:2])
+            self._queue = queued[:self.batch_size] #a sorted list is a heap
+            lines = queued[self.batch_size:]
+            self._add_run([(negative, pushed, self._record(line)) for negative, pushed, line in lines])
+            if len(self._runs) > MAX_RUNS:
+                self._merge_runs()
+        self.spilled += len(lines)
+        return len(lines)
+
+    def _record(self, line) -> list:
+        steps = []
+        node = line
+        while node.parent is not None:
+            steps.append((node.continuation, node.reply, node.playrate))
+            node = node.parent
+        steps.reverse()
+        self._root = node
+        board = line.board #leafer takes back the last moves of the board, so they are kept as moves
+        return [steps, line.cumulative, line.winRate, line.games, board.root().fen(), [move.uci() for move in board.move_stack], board.chess960, line.lineId]
+
+    def _restore(self, record):
+        #the line gets its own copies of the lines before it, they only need the moves and playrates for printing
+        steps, cumulative, winRate, games, fen, moves, chess960, lineId = record
+        node = self._root
+        for continuation, reply, playrate in steps[:-1]:
+            node = LineNode(node, continuation, reply, playrate, None, None, None, None)
+        continuation, reply, playrate = steps[-1]
+        board = chess.Board(fen, chess960=chess960)
+        for move in moves:
+            board.push_uci(move)
+        line = LineNode(node, continuation, reply, playrate, cumulative, winRate, games, board)
+        line.lineId = lineId
+        return line
+
+    def _write(self, file, record):
+        file.seek(0, os.SEEK_END)
+        file.write(json.dumps(record).encode('utf-8') + b'\n')
+
+    def _load(self):
+        # breadth first reads the next batch of lines back from disk
+        self._disk.seek(self._read)
+        for _ in range(min(self.spilled, self.batch_size)):
+            self._queue.append(self._restore(json.loads(self._disk.readline())))
+        self._read = self._disk.tell()
+        self.spilled -= len(self._queue)
+        if not self.spilled: #every spilled line is back, so the file starts over
+            self._disk.seek(0)
+            self._disk.truncate()
+            self._read = 0
+
+    def _add_run(self, entries):
+        run = self._nextRun
+        self._nextRun += 1
+        file = tempfile.TemporaryFile()
+        count = 0
+        for entry in entries:
+            self._write(file, entry)
+            count += 1
+        file.seek(0)
+        self._runs[run] = [file, count] #lines left in the run, counting its head
+        self._next_head(run)
+
+    def _next_head(self, run):
+        file, left = self._runs[run]
+        if left:
+            negative, pushed, record = json.loads(file.readline())
+            heapq.heappush(self._heads, (negative, pushed, run, record))
+        else:
+            file.close()
+            del self._runs[run]
+
+    def _merge_runs(self):
+        # merging the smallest runs keeps the files open bounded, while every line is rewritten only a few times
+        smallest = set(sorted(self._runs, key=lambda run: self._runs[run][1])[:MAX_RUNS // 2])
+        heads = [head for head in self._heads if head[2] in smallest]
+        self._heads = [head for head in self._heads if head[2] not in smallest]
+        heapq.heapify(self._heads)
+        runs = []
+        files = []
+        for negative, pushed, run, record in heads:
+            file, left = self._runs.pop(run)
+            rest = (json.loads(text) for text in itertools.islice(file, left - 1))
+            runs.append(itertools.chain([(negative, pushed, record)], rest))
+            files.append(file)
+        self._add_run(heapq.merge(*runs, key=lambda entry: (entry[0], entry[1])))
+        for file in files:
+            file.close()
+
+    def rate(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.expanded / elapsed if elapsed > 0 else 0
+
+    def progress(self) -> str:
+        spilled = f", {self.spilled} on disk" if self.spilled else ""
+        return f"{self.expanded} lines expanded ({self.rate():.1f}/s), {len(self)} queued{spilled}, {self.max_depth} max queued"
+
+
+class Budget:
+    """
+    Limits on explorer calls, engine time and wall time for a run, zero means no limit
+    """
+
+    def __init__(self, search, explorer, engine):
+        self.max_explorer_calls = search.max_explorer_calls
+        self.max_engine_seconds = search.max_engine_seconds
+        self.max_seconds = search.max_minutes * 60
+        self.explorer = explorer
+        self.engine = engine
+        self.started = time.perf_counter()
+
+    def is_limited(self) -> bool:
+        return bool(self.max_explorer_calls or self.max_engine_seconds or self.max_seconds)
+
+    def exhausted(self):
+        # explorer calls are counted across parallel chapters, they share one rate limit
+        calls = self.explorer.rateLimit.calls
+        if self.max_explorer_calls and calls >= self.max_explorer_calls:
+            return f"used {calls} of {self.max_explorer_calls} explorer calls"
+        if self.max_engine_seconds and self.engine and self.engine.seconds >= self.max_engine_seconds:
+            return f"used {self.engine.seconds:.0f} of {self.max_engine_seconds} engine seconds"
+        elapsed = time.perf_counter() - self.started
+        if self.max_seconds and elapsed >= self.max_seconds:
+            return f"ran for {elapsed / 60:.1f} of {self.max_seconds / 60:.0f} minutes"
+        return None
+
+
+class MemoryBudget:
+    """
+    Resident memory of the process against the memory limit, zero means no limit. Sampled after every batch, which also keeps the peak
+    """
+
+    def __init__(self, search):
+        self.limit = search.memory_limit_mb * 1024 * 1024
+        self.peak = 0
+        self._process = psutil.Process()
+
+    def is_limited(self) -> bool:
+        return bool(self.limit)
+
+    def sample(self) -> int:
+        rss = self._process.memory_info().rss
+        self.peak = max(self.peak, rss)
+        return rss
+
+    def exceeded(self) -> bool:
+        rss = self.sample()
+        return bool(self.limit) and rss > self.limit
@@ -0,0 +1,75 @@
+import copy
+import queue
+import threading
+
+from status_queue import QueueStatus
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a generation run once it has been asked to stop
+    """
+
+
+class CancelToken:
+    """
+    Cooperative stop flag, checked between line expansions, engine searches and explorer requests
+    """
+
+    def __init__(self, event=None):
+        self._event = event or threading.Event() #a multiprocessing event when the run has worker processes
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled("Generation was stopped")
+
+    def wait(self, seconds: float):
+        # sleeps like time.sleep, but wakes up as soon as the run is stopped
+        if seconds > 0 and self._event.wait(seconds):
+            self.check()
+
+
+class GenerationWorker:
+    """
+    Runs Grower on a background thread, so the GUI keeps drawing frames while books are generated.
+    Status updates from the run are queued, and the GUI frame loop shows them.
+    """
+
+    def __init__(self, grower):
+        self.grower = grower
+        self.updates = queue.Queue()
+        self.status = QueueStatus(self.updates)
+        self.token = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, settings, callback) -> bool:
+        with self._lock:
+            if self.is_running():
+                return False
+            self.token = CancelToken()
+            # the run gets its own copy, the settings stay editable in the GUI and edits apply to the next run
+            self._thread = threading.Thread(target=self.grower.run,
+                                            args=(copy.deepcopy(settings), self.status, callback, self.token),
+                                            name="generation",
+                                            daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self, wait: bool = False):
+        with self._lock:
+            if self.token:
+                self.token.cancel()
+            thread = self._thread
+        if wait and thread:
+            thread.join()
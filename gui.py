@@ -6,9 +6,13 @@ import dearpygui.dearpygui as dpg
 import psutil
 
 from BookBuilder import Grower
+from generation_worker import GenerationWorker
+from status_queue import drain
 from gui_generation_status import GenerationStatus
 from gui_themes import set_imgui_light_theme
-from settings import Settings, Speed, Rating, Book, Order, Variant
+from frontier import FrontierOrder
+from scoring import IntervalMethod
+from settings import Settings, Speed, Rating, Book, Order, Variant, ExplorerSource
 
 WINDOW_WIDTH = 980
 WINDOW_HEIGHT = 720
@@ -16,6 +20,8 @@ WINDOW_HEIGHT = 720
 SETTINGS_GROUP_XOFFSET = 180
 
 PRIMARY_WINDOW_TAG = "primary_window"
+GENERATE_BUTTON_TAG = "generate_button"
+STOP_BUTTON_TAG = "stop_button"
 
 BLOG_LINK = "https://www.alexcrompton.com/blog/automatically-creating-a-practical-opening-repertoire-or-why-your-chess-openings-suck"
 SOURCE_CODE_LINK = "https://github.com/raccrompton/BookBuilder"
@@ -25,6 +31,9 @@ class Gui:
     def __init__(self, settings: Settings, grower: Grower):
         self.settings = settings
         self.grower = grower
+        self.worker = GenerationWorker(grower)
+        self.status = None
+        self._running = False
 
     def create(self):
         dpg.create_context()
@@ -42,11 +51,31 @@ class Gui:
         dpg.set_exit_callback(callback=self._shutdown_callback)
         dpg.setup_dearpygui()
         dpg.show_viewport()
-        dpg.start_dearpygui()
+        # we draw frames ourselves, so we can show the status updates queued by the generation thread in between
+        while dpg.is_dearpygui_running():
+            self._show_generation_updates()
+            dpg.render_dearpygui_frame()
         dpg.destroy_context()
 
     def _shutdown_callback(self):
-        self.grower.stop()
+        self.worker.stop(wait=True)
+
+    def _show_generation_updates(self):
+        for _, kind, line1, line2 in drain(self.worker.updates):
+            if kind == 'info':
+                self.status.info(line1, line2)
+            elif kind == 'info2':
+                self.status.info2(line2)
+            elif kind == 'metrics':
+                self.status.metrics(line2)
+            else:
+                self.status.error(line1, line2)
+
+        running = self.worker.is_running()
+        if running != self._running:
+            self._running = running
+            dpg.configure_item(GENERATE_BUTTON_TAG, enabled=not running)
+            dpg.configure_item(STOP_BUTTON_TAG, enabled=running)
 
     def _create_primary_window(self):
         with dpg.window(tag=PRIMARY_WINDOW_TAG):
@@ -56,6 +85,8 @@ class Gui:
             self._book_settings()
             self._database_settings()
             self._move_selection_settings()
+            self._explorer_settings()
+            self._search_settings()
             self._engine_settings()
 
     def _menu_bar(self):
@@ -79,6 +110,8 @@ class Gui:
         dpg.add_text("An automatic practical chess opening repertoire builder using Lichess opening explorer API")
         dpg.add_text("Customize your settings and then press the button below to begin generating your repertoire")
         status = GenerationStatus()
+        self.status = status
+        self._running = False
 
         def get_invalid_books() -> List[Book]:
             invalid_books = list()
@@ -99,6 +132,17 @@ class Gui:
                                  "Correct it under 'Engine settings' or unselect 'Use engine' and retry")
                     return
 
+            # validate local explorer index path
+            if s.explorer.source == ExplorerSource.LOCAL and not os.path.exists(s.explorer.local_index_path):
+                status.error(f"Local explorer index '{s.explorer.local_index_path}' does not exist\n",
+                             "Build it with 'python local_explorer.py' or choose the Lichess opening explorer under 'Explorer settings'")
+                return
+
+            if s.explorer.source == ExplorerSource.REPLAY and not os.path.exists(s.explorer.recording_path):
+                status.error(f"Explorer recording '{s.explorer.recording_path}' does not exist\n",
+                             "Record a run with 'Record responses' or choose another explorer source under 'Explorer settings'")
+                return
+
             # validate books from free-text input are valid
             invalid_books = get_invalid_books()
             if len(invalid_books) > 0:
@@ -107,15 +151,20 @@ class Gui:
                 return
 
             def finish_callback():
-                dpg.enable_item(button_tag)
-                status.info("Finished generating your repertoire",
-                            "You will find your PGNs in the same folder where BookBuilder is located")
+                # called on the generation thread, so the message goes through the update queue
+                self.worker.status.info("Finished generating your repertoire",
+                                        "You will find your PGNs in the same folder where BookBuilder is located")
 
-            status.info("PGN generation started")
-            dpg.disable_item(button_tag)
-            self.grower.run(self.settings, status, finish_callback)
+            if self.worker.start(self.settings, finish_callback):
+                status.info("PGN generation started")
 
-        dpg.add_button(label="Generate PGN", width=120, height=30, before=status._line1, callback=start_generation)
+        def stop_generation():
+            status.info("Stopping PGN generation", "Waiting for the running engine search or explorer request to finish")
+            self.worker.stop()
+
+        with dpg.group(horizontal=True, before=status._line1):
+            dpg.add_button(tag=GENERATE_BUTTON_TAG, label="Generate PGN", width=120, height=30, callback=start_generation)
+            dpg.add_button(tag=STOP_BUTTON_TAG, label="Stop", width=120, height=30, enabled=False, callback=stop_generation)
 
     def _book_settings(self):
         s = self.settings.book
@@ -143,6 +192,55 @@ class Gui:
                                        default_value=s.books_string,
                                        callback=s.books_string_callback)
 
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Write lines while searching")
+                    _help("Select this to write each line to a '_partial.pgn' file as soon as it is final, so you can look at a chapter while it is being generated\n"
+                          "The partial file is replaced by the sorted chapter once the chapter is done")
+                    dpg.add_checkbox(default_value=s.stream_lines, callback=s.stream_lines_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Write run report")
+                    _help("Select this to write 'run_report.json' next to the chapters when a run ends\n"
+                          "It has counters and timings for explorer requests, rate limit pauses, leafer, candidate picking, engine searches and writing lines, per chapter")
+                    dpg.add_checkbox(default_value=s.run_report, callback=s.run_report_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Resume interrupted runs")
+                    _help("Select this to keep a journal of every line expanded next to each chapter\n"
+                          "If a run crashes or is stopped, generating the same books with the same settings again continues where it was,\n"
+                          "without asking the explorer or the engine about lines already done. The journals are removed once every book is written")
+                    dpg.add_checkbox(default_value=s.resume, callback=s.resume_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Checkpoint every (s)")
+                    _help("How often the journal is synced to disk. It is written after every batch of lines,\n"
+                          "so only a crash of the whole machine loses up to this many seconds of work")
+                    dpg.add_input_int(
+                        min_value=1,
+                        min_clamped=True,
+                        default_value=s.checkpoint_seconds,
+                        callback=s.checkpoint_seconds_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Write Polyglot book")
+                    _help("Select this to also write each chapter as a Polyglot opening book, 'Chapter_N_name.bin'\n"
+                          "Bots and trainers can look our moves up in it by position. Our moves are weighted by their win rate,\n"
+                          "the opponent's moves by how often they are played")
+                    dpg.add_checkbox(default_value=s.polyglot, callback=s.polyglot_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Books at once")
+                    _help("How many books to generate at the same time, each in its own process\n"
+                          "They share the opening explorer cache and rate limit, and split the engine processes between them\n"
+                          "With fewer engine processes than books, each book runs one process with its share of the engine threads and hash")
+                    dpg.add_input_int(
+                        min_value=1,
+                        max_value=psutil.cpu_count(logical=True),
+                        min_clamped=True,
+                        max_clamped=True,
+                        default_value=s.chapter_workers,
+                        callback=s.chapter_workers_callback)
+
     def _database_settings(self):
         s = self.settings.database
         with dpg.group():
@@ -222,6 +320,13 @@ class Gui:
                         default_value=s.alpha * 100,
                         callback=s.alpha_callback)
 
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Confidence interval")
+                    _help("How the bounds of a move's winrate are calculated\n"
+                          "Normal approximation is the original method, Wilson score and Bayesian intervals behave better for moves with few games or extreme winrates")
+                    dpg.add_combo(items=[str(m.value) for m in IntervalMethod], default_value=s.interval_method.value,
+                                  callback=s.interval_method_callback)
+
                 with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
                     dpg.add_text("Minimum play rate %")
                     _help(
@@ -264,6 +369,186 @@ class Gui:
                         "When not selected draws will count as as losses")
                     dpg.add_checkbox(default_value=s.draws_are_half, callback=s.draws_are_half_callback)
 
+    def _explorer_settings(self):
+        s = self.settings.explorer
+        with dpg.group():
+            with dpg.collapsing_header(label="Explorer settings", default_open=False):
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Explorer source")
+                    _help("Where position stats come from\n"
+                          "A local index is built from PGN game dumps with 'python local_explorer.py', and needs no network requests")
+                    dpg.add_combo(items=[str(source.value) for source in ExplorerSource], default_value=s.source.value,
+                                  callback=s.source_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Local index path")
+                    _help("Index file built by 'python local_explorer.py', used when the explorer source is the local index")
+                    dpg.add_input_text(default_value=s.local_index_path, width=300, callback=s.local_index_path_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Explorer URL")
+                    _help("Opening explorer the Lichess source asks, leave it empty for the Lichess one\n"
+                          "Point it at 'python explorer_replay.py' to replay a recording over HTTP\n"
+                          "Responses of other explorers are cached apart from the Lichess ones")
+                    dpg.add_input_text(default_value=s.url, width=300, callback=s.url_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Record responses")
+                    _help("Select this to save every explorer response of a run to the recording file\n"
+                          "Choose 'Recorded responses' as the explorer source to replay them later, for timing runs offline")
+                    dpg.add_checkbox(default_value=s.record_enabled, callback=s.record_enabled_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Recording path")
+                    _help("File that explorer responses are recorded to and replayed from")
+                    dpg.add_input_text(default_value=s.recording_path, width=300, callback=s.recording_path_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Replay latency")
+                    _help("Seconds added to every replayed response, to time runs as if the explorer was remote")
+                    dpg.add_input_float(min_value=0, min_clamped=True, format='%.3f', step=0.01,
+                                        default_value=s.replay_latency, callback=s.replay_latency_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Replay rate limit")
+                    _help("Answer every this many replayed requests with a rate limit error, 0 for never\n"
+                          f"Each one pauses requests for {s.rate_limit_pause:g} seconds, like the Lichess rate limit does")
+                    dpg.add_input_int(min_value=0, min_clamped=True,
+                                      default_value=s.replay_rate_limit_every, callback=s.replay_rate_limit_every_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Cache responses")
+                    _help("Select this to keep opening explorer responses on disk, so rerunning a book doesn't download the same positions again\n"
+                          f"The cache is stored in '{s.cache_path}' in the same folder where BookBuilder is located")
+                    dpg.add_checkbox(default_value=s.cache_enabled, callback=s.cache_enabled_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Cache days")
+                    _help("How many days a cached response is used before it is downloaded again")
+                    dpg.add_input_int(
+                        min_value=1,
+                        min_clamped=True,
+                        default_value=s.cache_ttl_days,
+                        callback=s.cache_ttl_days_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Cache size")
+                    _help("Maximum number of positions kept in the cache, the least recently used ones are removed first")
+                    dpg.add_input_int(
+                        min_value=1,
+                        min_clamped=True,
+                        step=1000,
+                        step_fast=10000,
+                        default_value=s.cache_max_entries,
+                        callback=s.cache_max_entries_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Concurrent requests")
+                    _help("How many positions are requested from the opening explorer at the same time\n"
+                          "Higher numbers are faster but hit the Lichess API rate limit sooner")
+                    dpg.add_input_int(
+                        min_value=1,
+                        max_value=16,
+                        min_clamped=True,
+                        max_clamped=True,
+                        default_value=s.concurrency,
+                        callback=s.concurrency_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Request timeout")
+                    _help("Seconds to wait for an opening explorer response before retrying the request")
+                    dpg.add_input_int(
+                        min_value=1,
+                        min_clamped=True,
+                        default_value=int(s.read_timeout),
+                        callback=s.read_timeout_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Request retries")
+                    _help("How many times a request failing with a network or server error is retried before generation stops")
+                    dpg.add_input_int(
+                        min_value=0,
+                        min_clamped=True,
+                        default_value=s.max_retries,
+                        callback=s.max_retries_callback)
+
+    def _search_settings(self):
+        s = self.settings.search
+        with dpg.group():
+            with dpg.collapsing_header(label="Search settings", default_open=False):
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Expansion order")
+                    _help("Choose whether lines are expanded one move deeper at a time, or the most likely lines first\n"
+                          "Both orders build the same repertoire when the search runs to the end")
+                    dpg.add_combo(items=[str(o.value) for o in FrontierOrder], default_value=s.frontier_order.value,
+                                  callback=s.frontier_order_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Batch size")
+                    _help("How many of the most likely lines are expanded together when expanding the most likely lines first\n"
+                          "Their positions are requested from the opening explorer at the same time")
+                    dpg.add_input_int(
+                        min_value=1,
+                        min_clamped=True,
+                        default_value=s.batch_size,
+                        callback=s.batch_size_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Explorer call budget")
+                    _help("Stop expanding lines after this many opening explorer requests, 0 for no limit\n"
+                          "With any budget the most likely lines are expanded first, and the repertoire built so far is written when it runs out")
+                    dpg.add_input_int(
+                        min_value=0,
+                        min_clamped=True,
+                        step=100,
+                        step_fast=1000,
+                        default_value=s.max_explorer_calls,
+                        callback=s.max_explorer_calls_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Engine seconds budget")
+                    _help("Stop expanding lines after the engine has searched for this many seconds, 0 for no limit")
+                    dpg.add_input_int(
+                        min_value=0,
+                        min_clamped=True,
+                        step=60,
+                        step_fast=600,
+                        default_value=s.max_engine_seconds,
+                        callback=s.max_engine_seconds_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Minutes budget")
+                    _help("Stop expanding lines after generation has run for this many minutes, 0 for no limit")
+                    dpg.add_input_int(
+                        min_value=0,
+                        min_clamped=True,
+                        step=10,
+                        step_fast=60,
+                        default_value=s.max_minutes,
+                        callback=s.max_minutes_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Keep position graph")
+                    _help("Select this to keep our move picks and engine moves of every position on disk between runs\n"
+                          "Lowering the depth likelihood or continuation games then only costs candidate picks and engine time for the new lines,\n"
+                          "explorer stats of the old lines come from the explorer cache\n"
+                          "Picks expire after the explorer cache days\n"
+                          f"The graph is stored in '{s.graph_path}' in the same folder where BookBuilder is located")
+                    dpg.add_checkbox(default_value=s.incremental, callback=s.incremental_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Memory limit (MB)")
+                    _help("When BookBuilder uses more memory than this, lines waiting to be expanded and finished lines move to temporary files\n"
+                          "Very deep runs then finish instead of running out of memory, a little slower. 0 for no limit\n"
+                          "The engine's hash is not counted, and with several books at once every book gets this much")
+                    dpg.add_input_int(
+                        min_value=0,
+                        min_clamped=True,
+                        step=256,
+                        step_fast=1024,
+                        default_value=s.memory_limit_mb,
+                        callback=s.memory_limit_mb_callback)
+
     def _engine_settings(self):
         s = self.settings.engine
         with dpg.group():
@@ -353,6 +638,26 @@ class Gui:
                         default_value=s.hash,
                         callback=s.hash_callback)
 
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Engine processes")
+                    _help("How many engine processes to run, each evaluating a different position at the same time\n"
+                          "Threads and hash above are per process, so divide them between the processes\n\n"
+                          f"Your processor has {logical_cores} logical cores")
+                    dpg.add_input_int(
+                        min_value=1,
+                        max_value=logical_cores,
+                        min_clamped=True,
+                        max_clamped=True,
+                        default_value=s.processes,
+                        callback=s.processes_callback)
+
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Single MultiPV search")
+                    _help("Select to check our candidate moves with one MultiPV search from the position, instead of a search after each candidate\n"
+                          "Candidates outside the MultiPV lines get a search restricted to that move\n"
+                          "This cuts engine time per position several times over, evaluations can differ slightly from separate searches")
+                    dpg.add_checkbox(default_value=s.multipv, callback=s.multipv_callback)
+
                 with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
                     dpg.add_text("Soundness limit")
                     _help(
@@ -386,6 +691,13 @@ class Gui:
                         "With ignore loss limit of 300 centipawns (3.0) we will select move A, as 3.2 exceeds 3.0")
                     dpg.add_input_int(default_value=s.ignore_loss_limit, callback=s.ignore_loss_limit_callback)
 
+                with dpg.group(horizontal=True, xoffset=SETTINGS_GROUP_XOFFSET):
+                    dpg.add_text("Cache evaluations")
+                    _help("Keep engine evaluations on disk, so positions searched before are not searched again\n"
+                          "A deeper cached evaluation is also used for a shallower depth\n"
+                          f"Evaluations are stored in '{s.cache_path}'")
+                    dpg.add_checkbox(default_value=s.cache_enabled, callback=s.cache_enabled_callback)
+
 
 def _menu_link(label: str, url: str):
     dpg.add_menu_item(label=label, callback=lambda: webbrowser.open(url))
@@ -8,6 +8,7 @@ class GenerationStatus:
     def __init__(self):
         self._line1 = dpg.add_text()
         self._line2 = dpg.add_text()
+        self._line3 = dpg.add_text()
 
     def info(self, line1: str = "", line2: str = ""):
         self._set_color(self.black)
@@ -20,6 +21,10 @@ class GenerationStatus:
         self._set_color(self.red)
         self._set_text(line1, line2)
 
+    def metrics(self, line3):
+        # where the run spends its time, updated while it runs
+        dpg.set_value(self._line3, line3)
+
     def _set_color(self, color):
         dpg.configure_item(self._line1, color=color)
         dpg.configure_item(self._line2, color=color)
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import chess
+
+from frontier import LineNode
+
+
+def journal_fingerprint(settings, pgn: str) -> str:
+    """
+    Hash of the opening and every setting that changes which lines a chapter expands, a journal only resumes a chapter with the same one
+    """
+    moveSelection = settings.moveSelection
+    engine = settings.engine
+    search = settings.search
+    parts = [
+        pgn,
+        settings.book.order.value,
+        settings.database.fingerprint(),
+        sorted((name, value.value if hasattr(value, 'value') else value) for name, value in vars(moveSelection).items()),
+        (engine.enabled, engine.path, engine.finish, engine.depth, engine.multipv,
+         engine.soundness_limit, engine.move_loss_limit, engine.ignore_loss_limit) if engine.enabled else False,
+        (search.frontier_order.value, search.batch_size, search.max_explorer_calls, search.max_engine_seconds, search.max_minutes),
+    ]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+class Expansion:
+    """
+    A line expansion read back from a journal, with the continuations and final lines Leafer found for it
+    """
+
+    def __init__(self, pgnList: list, finalLines: list):
+        self.pgnList = pgnList
+        self.finalLines = finalLines
+
+
+class ChapterJournal:
+    """
+    Append-only journal of a chapter's line expansions, so a run that crashed or was stopped resumes where it was.
+    Every Leafer result is one JSON line. Replaying them rebuilds the frontier and the final lines in the same order
+    without calling the explorer or the engine again. The journal is flushed after every batch and synced to disk
+    every `interval` seconds.
+    """
+
+    def __init__(self, path: str, fingerprint: str, interval: float):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.root = None #root line fields of the interrupted run
+        self.expansions = {} #line id -> children and final lines recorded by the interrupted run
+        self.done = False
+        self.replayed = 0
+        self.nextId = 1
+        self._synced = time.monotonic()
+        resumed = os.path.exists(path) and self._load()
+        self._file = open(path, 'a' if resumed else 'w', encoding='utf-8')
+        if not resumed:
+            self._write({'type': 'start', 'fingerprint': fingerprint})
+
+    def _load(self) -> bool:
+        with open(self.path, encoding='utf-8') as file:
+            lines = file.readlines()
+        records = []
+        for text in lines:
+            try:
+                records.append(json.loads(text))
+            except ValueError:
+                break #a crash can cut the last line short, everything before it is whole
+        if not records or records[0].get('type') != 'start' or records[0].get('fingerprint') != self.fingerprint:
+            logging.info(f"Journal {self.path} is for other settings, the chapter starts over")
+            return False
+        for record in records[1:]:
+            if record['type'] == 'root':
+                self.root = record
+            elif record['type'] == 'expand':
+                self.expansions[record['line']] = record
+                self.nextId = max([self.nextId] + [child['id'] + 1 for child in record['children']])
+            elif record['type'] == 'done':
+                self.done = True
+        if len(records) < len(lines):
+            # we drop the cut line, so the records we append start on a line of their own
+            with open(self.path, 'w', encoding='utf-8') as file:
+                file.writelines(lines[:len(records)])
+        logging.info(f"Resuming from journal {self.path}: {len(self.expansions)} line expansions")
+        return True
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record) + '\n')
+
+    def has(self, node: LineNode) -> bool:
+        return node.lineId in self.expansions
+
+    def replay_root(self, rootBoard: chess.Board):
+        if self.root is None:
+            return None
+        root = self.root
+        node = LineNode(None, None, None, 1, root['likelihood'], root['winRate'], root['games'], rootBoard.copy(stack=False))
+        node.prefix = [tuple(step) for step in root['prefix']]
+        node.lineId = 0
+        return node
+
+    def record_root(self, node: LineNode):
+        node.lineId = 0
+        self._write({'type': 'root', 'likelihood': node.cumulative, 'winRate': node.winRate, 'games': node.games, 'prefix': node.prefix})
+
+    def replay(self, node: LineNode):
+        """
+        The expansion of the line from the interrupted run, or None when the line still has to go through Leafer
+        """
+        record = self.expansions.pop(node.lineId, None)
+        if record is None:
+            return None
+        board = node.board
+        node.board = None #like leafer, the line's board is only needed until it is expanded
+        pgnList = []
+        for child in record['children']:
+            nextBoard = board.copy(stack=False)
+            nextBoard.push_san(child['continuation'])
+            nextBoard.push_san(child['reply'])
+            line = LineNode(node, child['continuation'], child['reply'], child['playrate'], child['cumulative'], child['winRate'], child['games'], nextBoard)
+            line.lineId = child['id']
+            pgnList.append(line)
+        self.replayed += 1
+        return Expansion(pgnList, [(node, winRate, games) for winRate, games in record['final']])
+
+    def record(self, node: LineNode, leafer):
+        children = []
+        for child in leafer.pgnList:
+            child.lineId = self.nextId
+            self.nextId += 1
+            children.append({'id': child.lineId, 'continuation': child.continuation, 'reply': child.reply, 'playrate': child.playrate,
+                             'cumulative': child.cumulative, 'winRate': child.winRate, 'games': child.games})
+        final = [[winRate, games] for _, winRate, games in leafer.finalLines]
+        self._write({'type': 'expand', 'line': node.lineId, 'children': children, 'final': final})
+
+    def checkpoint(self):
+        # flushing after every batch keeps the expansions when the process dies, syncing keeps them when the machine does
+        self._file.flush()
+        if time.monotonic() - self._synced >= self.interval:
+            os.fsync(self._file.fileno())
+            self._synced = time.monotonic()
+
+    def finish(self):
+        self._write({'type': 'done'})
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,296 @@
+import argparse
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+import chess.pgn
+
+from explorer import normalize_fen
+from settings import Variant, Speed, Rating
+
+try:
+    import zstandard
+except ImportError:  # only needed to read .pgn.zst dumps
+    zstandard = None
+
+# lichess rating buckets, a game counts for the highest bucket at or below the average rating of its players
+RATING_BUCKETS = [0, 1000, 1200, 1400, 1600, 1800, 2000, 2200, 2500]
+BATCH_GAMES = 2000
+
+
+def game_speed(timeControl: str):
+    # lichess classifies games by their estimated duration, base time plus 40 increments
+    if timeControl == '-':
+        return Speed.CORRESPONDENCE.value
+    try:
+        base, increment = (int(part) for part in timeControl.split('+'))
+    except ValueError:
+        return None
+    duration = base + 40 * increment
+    if duration < 30:
+        return Speed.ULTRA_BULLET.value
+    if duration < 180:
+        return Speed.BULLET.value
+    if duration < 480:
+        return Speed.BLITZ.value
+    if duration < 1500:
+        return Speed.RAPID.value
+    return Speed.CLASSICAL.value
+
+
+def game_rating(whiteElo: str, blackElo: str):
+    try:
+        average = (int(whiteElo) + int(blackElo)) / 2
+    except ValueError:
+        return None
+    return str(max(bucket for bucket in RATING_BUCKETS if bucket <= average))
+
+
+def game_variant(name: str):
+    key = name.replace(' ', '').replace('-', '').lower()
+    for variant in Variant:
+        if variant.value.lower() == key:
+            return variant.value
+    return None
+
+
+class _OpeningVisitor(chess.pgn.BaseVisitor):
+    """
+    Reads the headers and first moves of a game, the moves after the opening are never checked for legality
+    """
+
+    def __init__(self, maxPly: int, filters: dict):
+        self.maxPly = maxPly
+        self.filters = filters
+
+    def begin_game(self):
+        self.headers = chess.pgn.Headers()
+        self.moves = []
+        self.key = None
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def end_headers(self):
+        headers = self.headers
+        variant = game_variant(headers.get('Variant', 'Standard'))
+        speed = game_speed(headers.get('TimeControl', '?'))
+        rating = game_rating(headers.get('WhiteElo', '?'), headers.get('BlackElo', '?'))
+        if (variant is None or speed is None or rating is None or headers.get('Result') not in ('1-0', '0-1', '1/2-1/2')
+                or any(value not in self.filters[field] for field, value in (('variants', variant), ('speeds', speed), ('ratings', rating)) if self.filters[field])):
+            return chess.pgn.SKIP
+        self.key = (variant, speed, rating)
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def handle_error(self, error):
+        logging.debug(f"Skipping game with bad PGN: {error}")
+        self.key = None
+
+    def parse_san(self, board, san):
+        if len(self.moves) >= self.maxPly:
+            return chess.Move.null() #past the opening we only skip over the moves
+        return board.parse_san(san)
+
+    def visit_move(self, board, move):
+        if len(self.moves) < self.maxPly:
+            self.moves.append(move)
+
+    def result(self):
+        return self
+
+
+def _count_games(texts, maxPly: int, filters: dict):
+    # runs in a worker process, counting results per position and move for a batch of games
+    positions = defaultdict(lambda: [0, 0, 0])
+    moves = defaultdict(lambda: [0, 0, 0])
+    # games of a batch share their openings, so a move tree gives us each fen and san once instead of once per game
+    roots = {}
+    games = 0
+    for text in texts:
+        game = chess.pgn.read_game(io.StringIO(text), Visitor=lambda: _OpeningVisitor(maxPly, filters))
+        if game is None or game.key is None:
+            continue
+        games += 1
+        column = {'1-0': 0, '0-1': 1, '1/2-1/2': 2}[game.headers['Result']]
+        board = game.headers.board()
+        rootKey = (game.key[0], game.headers.get('FEN'))
+        node = roots.get(rootKey)
+        if node is None:
+            node = roots[rootKey] = (normalize_fen(board.fen()), {})
+        for move in game.moves:
+            fen, children = node
+            child = children.get(move)
+            if child is None:
+                # the explorer gives castling moves as king takes rook, which is what WorkerPlay looks for
+                uci = board.uci(move, chess960=True) if board.is_castling(move) else move.uci()
+                san = board.san(move)
+                board.push(move)
+                child = children[move] = (uci, san, (normalize_fen(board.fen()), {}))
+            else:
+                board.push(move)
+            uci, san, node = child
+            positions[(fen, *game.key)][column] += 1
+            moves[(fen, *game.key, uci, san)][column] += 1
+        positions[(node[0], *game.key)][column] += 1
+    return games, dict(positions), dict(moves)
+
+
+def read_games(path: str):
+    """
+    Yields the text of every game in a PGN or PGN.zst file
+    """
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise Exception("Reading .pgn.zst files needs the zstandard package, install it with 'pip install zstandard'")
+        handle = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8', errors='replace')
+    else:
+        handle = open(path, encoding='utf-8', errors='replace')
+    with handle:
+        lines = []
+        for line in handle:
+            if line.startswith('[Event ') and lines:
+                yield ''.join(lines)
+                lines = []
+            lines.append(line)
+        if lines:
+            yield ''.join(lines)
+
+
+def _batches(paths, size: int):
+    batch = []
+    for path in paths:
+        for text in read_games(path):
+            batch.append(text)
+            if len(batch) == size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class LocalExplorerIndex:
+    """
+    SQLite index of game results per position and move, split by variant, speed and rating bucket so one index serves any database settings
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lookups = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS positions ("
+            "fen TEXT NOT NULL, variant TEXT NOT NULL, speed TEXT NOT NULL, rating TEXT NOT NULL, "
+            "white INTEGER NOT NULL, black INTEGER NOT NULL, draws INTEGER NOT NULL, "
+            "PRIMARY KEY (fen, variant, speed, rating)) WITHOUT ROWID")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS moves ("
+            "fen TEXT NOT NULL, variant TEXT NOT NULL, speed TEXT NOT NULL, rating TEXT NOT NULL, uci TEXT NOT NULL, san TEXT NOT NULL, "
+            "white INTEGER NOT NULL, black INTEGER NOT NULL, draws INTEGER NOT NULL, "
+            "PRIMARY KEY (fen, variant, speed, rating, uci)) WITHOUT ROWID")
+        self._connection.commit()
+
+    def add(self, positions: dict, moves: dict):
+        with self._lock:
+            self._connection.executemany(
+                "INSERT INTO positions VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (fen, variant, speed, rating) DO UPDATE SET "
+                "white = white + excluded.white, black = black + excluded.black, draws = draws + excluded.draws",
+                [(*key, *counts) for key, counts in positions.items()])
+            self._connection.executemany(
+                "INSERT INTO moves VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (fen, variant, speed, rating, uci) DO UPDATE SET "
+                "white = white + excluded.white, black = black + excluded.black, draws = draws + excluded.draws",
+                [(*key, *counts) for key, counts in moves.items()])
+            self._connection.commit()
+
+    def get(self, fen: str, database) -> dict:
+        """
+        Explorer response for the position, in the shape WorkerPlay reads from the Lichess API
+        """
+        speeds = [speed.value for speed in database.speeds]
+        ratings = [rating.value for rating in database.ratings]
+        where = (f"fen = ? AND variant = ? AND speed IN ({','.join('?' * len(speeds))}) "
+                 f"AND rating IN ({','.join('?' * len(ratings))})")
+        parameters = (normalize_fen(fen), database.variant.value, *speeds, *ratings)
+        with self._lock:
+            self.lookups += 1
+            white, black, draws = self._connection.execute(
+                f"SELECT SUM(white), SUM(black), SUM(draws) FROM positions WHERE {where}", parameters).fetchone()
+            rows = self._connection.execute(
+                f"SELECT uci, san, SUM(white), SUM(black), SUM(draws) FROM moves WHERE {where} "
+                f"GROUP BY uci ORDER BY SUM(white) + SUM(black) + SUM(draws) DESC LIMIT ?", (*parameters, database.moves)).fetchall()
+        return {
+            'white': white or 0,
+            'black': black or 0,
+            'draws': draws or 0,
+            'moves': [{'uci': uci, 'san': san, 'white': w, 'black': b, 'draws': d} for uci, san, w, b, d in rows]
+        }
+
+    def stats(self) -> str:
+        return f"local explorer index: {self.lookups} lookups"
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def build_index(indexPath: str, paths, workers: int, maxPly: int, filters: dict):
+    """
+    Counts the openings of every game in the dumps on worker processes, and adds them to the index at indexPath
+    """
+    index = LocalExplorerIndex(indexPath)
+    started = time.perf_counter()
+    games = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # we keep a few batches per worker in flight, so reading the dump never waits on counting and memory stays bounded
+        pending = []
+        for batch in _batches(paths, BATCH_GAMES):
+            pending.append(executor.submit(_count_games, batch, maxPly, filters))
+            if len(pending) >= 2 * workers:
+                games += _add_counts(index, pending.pop(0).result())
+                logging.info(f"Indexed {games} games ({games / (time.perf_counter() - started):.0f}/s)")
+        for future in pending:
+            games += _add_counts(index, future.result())
+    index.close()
+    logging.info(f"Indexed {games} games into {indexPath} in {time.perf_counter() - started:.0f}s")
+    return games
+
+
+def _add_counts(index: LocalExplorerIndex, counts) -> int:
+    games, positions, moves = counts
+    index.add(positions, moves)
+    return games
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a local opening explorer index from PGN or PGN.zst game dumps, "
+                                                 "such as the ones from https://database.lichess.org")
+    parser.add_argument('index', help="index file to create or add to, e.g. explorer_index.sqlite")
+    parser.add_argument('pgn', nargs='+', help="PGN or PGN.zst files to read")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="processes counting games")
+    parser.add_argument('--max-ply', type=int, default=40, help="how many half moves of each game to index")
+    parser.add_argument('--variants', nargs='*', default=[], choices=[v.name for v in Variant], help="only index these variants")
+    parser.add_argument('--speeds', nargs='*', default=[], choices=[s.name for s in Speed], help="only index these speeds")
+    parser.add_argument('--ratings', nargs='*', default=[], choices=[r.name for r in Rating],
+                        help="only index these rating buckets, games below the lowest are always skipped when given")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    filters = {
+        'variants': {Variant[name].value for name in args.variants},
+        'speeds': {Speed[name].value for name in args.speeds},
+        'ratings': {Rating[name].value for name in args.ratings},
+    }
+    build_index(args.index, args.pgn, max(1, args.workers), args.max_ply, filters)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets in milliseconds, the last bucket takes everything slower
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+BUCKET_LABELS = [f"<={bound}ms" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+
+
+class Histogram:
+    """
+    Count, total and bucketed durations of one phase
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        milliseconds = seconds * 1000
+        bucket = 0
+        while bucket < len(BUCKETS_MS) and milliseconds > BUCKETS_MS[bucket]:
+            bucket += 1
+        self.buckets[bucket] += 1
+
+    def percentile(self, fraction: float) -> float:
+        # upper bound of the bucket holding the percentile, in seconds
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS_MS[bucket] / 1000 if bucket < len(BUCKETS_MS) else self.max
+        return 0.0
+
+    def merge(self, report: dict):
+        self.count += report['count']
+        self.seconds += report['seconds']
+        self.max = max(self.max, report['max_seconds'])
+        for label, count in report['buckets'].items():
+            self.buckets[BUCKET_LABELS.index(label)] += count
+
+    def report(self) -> dict:
+        return {
+            'count': self.count,
+            'seconds': round(self.seconds, 4),
+            'mean_ms': round(self.seconds / self.count * 1000, 3) if self.count else 0,
+            'p50_ms_at_most': round(self.percentile(0.5) * 1000, 3),
+            'p95_ms_at_most': round(self.percentile(0.95) * 1000, 3),
+            'max_seconds': round(self.max, 4),
+            'buckets': {label: count for label, count in zip(BUCKET_LABELS, self.buckets) if count},
+        }
+
+
+class ChapterMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self.seconds = 0.0
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(Histogram)
+        self.peaks = {} #highest value seen, like resident memory
+
+    def report(self) -> dict:
+        return {
+            'name': self.name,
+            'seconds': round(self.seconds or time.time() - self.started, 3),
+            'counters': dict(sorted(self.counters.items())),
+            'timers': {name: histogram.report() for name, histogram in sorted(self.timers.items())},
+            'peaks': dict(sorted(self.peaks.items())),
+        }
+
+
+class Metrics:
+    """
+    Counters and timing histograms for the phases of a run, kept per chapter.
+    Explorer, engine, leafer and final line phases record here while the run goes, and the run report is written from it at the end.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.chapter = 0 #what is recorded outside of a chapter, e.g. starting the engine, goes to chapter 0
+        self.chapters = {0: ChapterMetrics('run')}
+        self._lock = threading.Lock() #explorer requests and engine searches record from several threads
+
+    def start_chapter(self, chapter: int, name: str):
+        with self._lock:
+            self.chapter = chapter
+            self.chapters[chapter] = ChapterMetrics(name)
+
+    def finish_chapter(self):
+        with self._lock:
+            current = self.chapters[self.chapter]
+            current.seconds = time.time() - current.started
+            self.chapter = 0
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.chapters[self.chapter].counters[name] += amount
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.chapters[self.chapter].timers[name].add(seconds)
+
+    def peak(self, name: str, value: float):
+        with self._lock:
+            peaks = self.chapters[self.chapter].peaks
+            peaks[name] = max(peaks.get(name, value), value)
+
+    @contextmanager
+    def time(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def summary(self, chapter: int = None) -> str:
+        """
+        One line of where a chapter spent its time so far, for the generation status
+        """
+        with self._lock:
+            current = self.chapters.get(self.chapter if chapter is None else chapter)
+            if current is None:
+                return ""
+            parts = [f"{name} {histogram.count}x {histogram.seconds:.1f}s" for name, histogram in
+                     sorted(current.timers.items(), key=lambda item: item[1].seconds, reverse=True)[:5]]
+            if current.counters.get('explorer.rate_limited'):
+                parts.append(f"{current.counters['explorer.rate_limited']} rate limits")
+            if current.peaks.get('memory.peak_rss_mb'):
+                parts.append(f"peak memory {current.peaks['memory.peak_rss_mb']:.0f} MB")
+        return "Time spent: " + ", ".join(parts) if parts else ""
+
+    def chapter_report(self, chapter: int) -> dict:
+        with self._lock:
+            return self.chapters[chapter].report()
+
+    def chapter_reports(self) -> dict:
+        with self._lock:
+            return {chapter: metrics.report() for chapter, metrics in self.chapters.items()}
+
+    def merge(self, chapter: int, report: dict):
+        """
+        Adds a chapter report from a worker process, when chapters run in parallel
+        """
+        with self._lock:
+            merged = self.chapters.get(chapter)
+            if merged is None:
+                merged = self.chapters[chapter] = ChapterMetrics(report['name'])
+                merged.seconds = report['seconds']
+            for name, amount in report['counters'].items():
+                merged.counters[name] += amount
+            for name, timer in report['timers'].items():
+                merged.timers[name].merge(timer)
+            for name, value in report['peaks'].items():
+                merged.peaks[name] = max(merged.peaks.get(name, value), value)
+
+    def report(self, extra: dict = None) -> dict:
+        with self._lock:
+            chapters = {str(chapter): metrics.report() for chapter, metrics in sorted(self.chapters.items())}
+            # totals add every chapter up, phases of parallel chapters overlap so their seconds can exceed the run time
+            total = ChapterMetrics('total')
+            for metrics in self.chapters.values():
+                for name, amount in metrics.counters.items():
+                    total.counters[name] += amount
+                for name, histogram in metrics.timers.items():
+                    total.timers[name].merge(histogram.report())
+                for name, value in metrics.peaks.items(): #peaks of parallel chapters are per worker process
+                    total.peaks[name] = max(total.peaks.get(name, value), value)
+            total.seconds = time.time() - self.started
+        report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))}
+        report.update(extra or {})
+        report['total'] = total.report()
+        report['chapters'] = chapters
+        return report
+
+    def write(self, path: str, extra: dict = None):
+        with open(path, 'w') as file:
+            json.dump(self.report(extra), file, indent=2)
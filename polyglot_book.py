@@ -0,0 +1,91 @@
+import heapq
+import itertools
+import logging
+import struct
+import tempfile
+
+import chess
+import chess.polyglot
+
+ENTRY = struct.Struct('>QHHI') #zobrist key, move, weight and learn, big endian like every polyglot book
+MAX_WEIGHT = 0xFFFF
+
+
+def polyglot_move(board: chess.Board, move: chess.Move) -> int:
+    toSquare = move.to_square
+    if board.is_castling(move) and not board.chess960:
+        #polyglot books write castling as the king taking its own rook
+        toSquare = chess.square(7 if board.is_kingside_castling(move) else 0, chess.square_rank(move.from_square))
+    promotion = move.promotion - 1 if move.promotion else 0 #knight 1, bishop 2, rook 3, queen 4
+    return toSquare | (move.from_square << 6) | (promotion << 12)
+
+
+def weight(value: float) -> int:
+    # every move of the book is kept, so even a move with a tiny rate gets the smallest weight
+    return max(1, min(MAX_WEIGHT, round(value * MAX_WEIGHT)))
+
+
+class PolyglotBook:
+    """
+    Polyglot opening book of a chapter, so bots and trainers look repertoire moves up by zobrist key instead of parsing the pgn.
+    Our moves are weighted by their win rate and the opponent continuations by their playrate, both sides are in one book
+    as positions with the other side to move never share a key. Entries are sorted by key for binary search.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {} #(key, move) -> weight, transpositions add the same move once
+        self.runs = [] #entries moved to disk when memory runs short, each run sorted by key and move
+
+    def add(self, board: chess.Board, move: chess.Move, value: float):
+        entry = (chess.polyglot.zobrist_hash(board), polyglot_move(board, move))
+        self.entries[entry] = max(self.entries.get(entry, 0), weight(value))
+
+    def add_opening(self, game, root):
+        #the opening pgn is part of the repertoire, its opponent moves come with their playrate from rooter
+        board = game.board()
+        moves = list(game.mainline_moves())
+        chances = iter(chance for _, chance in root.prefix)
+        for index, move in enumerate(moves):
+            ours = (len(moves) - index) % 2 == 1 #the opening ends with our move
+            self.add(board, move, root.winRate if ours else next(chances, 1))
+            board.push(move)
+
+    def add_expansion(self, board: chess.Board, lines: list):
+        #board is the position the lines were expanded from, each line adds the opponent continuation and our reply to it
+        for line in lines:
+            nextBoard = board.copy(stack=False)
+            continuation = nextBoard.parse_san(line.continuation)
+            self.add(nextBoard, continuation, line.playrate)
+            nextBoard.push(continuation)
+            self.add(nextBoard, nextBoard.parse_san(line.reply), line.winRate)
+
+    def spill(self):
+        if not self.entries:
+            return
+        run = tempfile.TemporaryFile()
+        run.write(b''.join(ENTRY.pack(key, move, moveWeight, 0) for (key, move), moveWeight in sorted(self.entries.items())))
+        run.seek(0)
+        self.runs.append(run)
+        self.entries = {}
+
+    def _read_run(self, run):
+        for chunk in iter(lambda: run.read(ENTRY.size * 4096), b''):
+            for key, move, moveWeight, _ in ENTRY.iter_unpack(chunk):
+                yield (key, move), moveWeight
+
+    def write(self):
+        entries = heapq.merge(*[self._read_run(run) for run in self.runs], sorted(self.entries.items()), key=lambda item: item[0])
+        count = 0
+        with open(self.filepath, 'wb') as file:
+            for key, group in itertools.groupby(entries, key=lambda item: item[0][0]):
+                moves = {}
+                for (_, move), moveWeight in group: #a move in several runs keeps its highest weight
+                    moves[move] = max(moves.get(move, 0), moveWeight)
+                #entries of a key are sorted by weight, so a reader taking the first match gets the heaviest move
+                ordered = sorted(moves.items(), key=lambda item: (-item[1], item[0]))
+                file.write(b''.join(ENTRY.pack(key, move, moveWeight, 0) for move, moveWeight in ordered))
+                count += len(ordered)
+        for run in self.runs:
+            run.close()
+        logging.info(f"Wrote {count} book entries to {self.filepath}")
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import chess.engine
+import chess.polyglot
+
+from explorer import normalize_fen
+from metrics import Metrics
+from settings import ExplorerSource
+from workerEngineReduce import WorkerPlay
+
+
+def graph_fingerprint(settings) -> str:
+    """
+    Hash of the settings candidate picks and engine moves depend on.
+    The depth likelihood and continuation games only decide which lines are expanded, so relaxing them keeps the stored graph.
+    """
+    moveSelection = settings.moveSelection
+    explorer = settings.explorer
+    engine = settings.engine
+    parts = [
+        settings.database.fingerprint(),
+        (explorer.source.value, explorer.local_index_path if explorer.source == ExplorerSource.LOCAL else explorer.url), #where the stats come from
+        (moveSelection.alpha, moveSelection.min_play_rate, moveSelection.min_games, moveSelection.draws_are_half, moveSelection.interval_method.value),
+        #threads and hash change what a fixed depth search finds, like they do for the engine cache
+        (engine.path, engine.depth, engine.multipv, engine.soundness_limit, engine.move_loss_limit, engine.ignore_loss_limit,
+         engine.threads, engine.hash) if engine.enabled else False,
+    ]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _signed(key: int) -> int:
+    # zobrist hashes are unsigned 64 bit, sqlite integers are signed
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+class PositionNode:
+    def __init__(self, key: int):
+        self.key = key #zobrist hash of the position
+        self.children = {} #opponent move san -> key of the position after it
+        self.candidate = None #result of pick_candidate when it is our move in this position
+        self.engineMove = None #engine move finishing lines when there is no good human reply
+        self.expansions = 0 #how many move orders reached this position with our move played
+
+
+class PositionStore:
+    """
+    SQLite store of the position graph, our candidate picks and engine moves, kept between runs.
+    When a later run relaxes the depth likelihood or continuation games, the lines of the earlier run are walked again from the store,
+    so only positions the earlier run never reached cost candidate picks and engine searches. Explorer responses are not kept here,
+    they come from the explorer cache with its expiry and size limit. Picks expire with the explorer stats they were made from.
+    """
+
+    def __init__(self, path: str, fingerprint: str, ttl_days: float):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.loaded = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+        # parallel chapters share the file, so writers wait on each other instead of failing
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS nodes ("
+            "key INTEGER NOT NULL, fingerprint TEXT NOT NULL, candidate TEXT, engine_move TEXT, created REAL NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (key, fingerprint)) WITHOUT ROWID")
+        if 'created' not in [column[1] for column in self._connection.execute("PRAGMA table_info(nodes)")]:
+            #stores written before picks expired have no creation times, so their picks expire now
+            self._connection.execute("ALTER TABLE nodes ADD COLUMN created REAL NOT NULL DEFAULT 0")
+        self._connection.execute("DELETE FROM nodes WHERE created < ?", (time.time() - self.ttl,))
+        self._connection.commit()
+
+    def load(self, node: PositionNode):
+        with self._lock:
+            row = self._connection.execute("SELECT candidate, engine_move FROM nodes WHERE key = ? AND fingerprint = ? AND created >= ?",
+                                           (_signed(node.key), self.fingerprint, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return
+        candidate, engineMove = row
+        if candidate is not None:
+            # leafer never reads the scored moves of a candidate, so only the pick itself is stored
+            bestMove, potency, potencyRange, games = json.loads(candidate)
+            node.candidate = (None, bestMove, potency, tuple(potencyRange), games)
+            self.loaded += 1
+        if engineMove is not None:
+            node.engineMove = chess.Move.from_uci(engineMove)
+
+    def put_candidate(self, node: PositionNode):
+        _, bestMove, potency, potencyRange, games = node.candidate
+        candidate = json.dumps([bestMove, potency, list(potencyRange), games], default=lambda value: value.item()) #numpy numbers as python ones
+        self._put("candidate", node.key, candidate)
+
+    def put_engine_move(self, node: PositionNode):
+        self._put("engine_move", node.key, node.engineMove.uci())
+
+    def _put(self, column: str, key: int, value: str):
+        with self._lock:
+            self._connection.execute(
+                f"INSERT INTO nodes (key, fingerprint, {column}, created) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT (key, fingerprint) DO UPDATE SET {column} = excluded.{column}", #a position expires as a whole
+                (_signed(key), self.fingerprint, value, time.time()))
+            self._connection.commit()
+            self.stored += 1
+
+    def stats(self) -> str:
+        return f"position store: {self.loaded} candidates from earlier runs, {self.stored} searches stored"
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class PositionGraph:
+    """
+    DAG of the positions visited during a run, keyed by zobrist hash so transpositions share one node.
+    Lines are still built per move order, but the work for a position is only done once.
+    """
+
+    def __init__(self, settings, status, engine, explorer, metrics: Metrics = None, store: PositionStore = None):
+        self.settings = settings
+        self.status = status
+        self.engine = engine
+        self.explorer = explorer
+        self.metrics = metrics or Metrics()
+        self.store = store
+        # a recording has to hold every position the run visits, so picks of earlier runs are not reused while recording
+        self.reuse = store is not None and not settings.explorer.record_enabled
+        self.nodes = {}
+        self.transpositions = 0
+        self.saved = 0
+        self._searchedAhead = set() #searches done ahead of time don't count as saved when leafer picks them up
+
+    def node(self, board: chess.Board) -> PositionNode:
+        key = chess.polyglot.zobrist_hash(board)
+        node = self.nodes.get(key)
+        if node is None:
+            node = PositionNode(key)
+            if self.reuse:
+                self.store.load(node) #what earlier runs found for the position is reused like a transposition
+            self.nodes[key] = node
+        return node
+
+    def expand(self, board: chess.Board) -> PositionNode:
+        node = self.node(board)
+        node.expansions += 1
+        if node.expansions > 1:
+            self.transpositions += 1
+            logging.debug(f"transposition to {board.fen()}, reached by {node.expansions} move orders")
+        return node
+
+    def child(self, node: PositionNode, san: str, board: chess.Board) -> PositionNode:
+        child = self.node(board)
+        node.children[san] = child.key
+        return child
+
+    def candidate(self, node: PositionNode, board: chess.Board):
+        if node.candidate is None:
+            self._candidate(node, board)
+        elif not self._was_searched_ahead('candidate', node):
+            self.saved += 1
+        return node.candidate
+
+    def engine_move(self, node: PositionNode, board: chess.Board) -> chess.Move:
+        if node.engineMove is None:
+            self._engine_move(node, board)
+        elif not self._was_searched_ahead('engineMove', node):
+            self.saved += 1
+        return node.engineMove
+
+    def search_ahead(self, kind: str, jobs: list):
+        # every job is a (node, board) pair, searched on its own thread so the engine pool runs them side by side
+        search = self._candidate if kind == 'candidate' else self._engine_move
+        with ThreadPoolExecutor(max_workers=self.settings.engine.processes) as executor:
+            futures = [executor.submit(search, node, board) for node, board in jobs]
+            for future in futures:
+                future.result()
+        self._searchedAhead.update((kind, node.key) for node, _ in jobs)
+
+    def _was_searched_ahead(self, kind: str, node: PositionNode) -> bool:
+        if (kind, node.key) in self._searchedAhead:
+            self._searchedAhead.discard((kind, node.key))
+            return True
+        return False
+
+    def _candidate(self, node: PositionNode, board: chess.Board):
+        with self.metrics.time('pick_candidate'):
+            workerPlay = WorkerPlay(self.settings, self.status, self.engine, self.explorer, board.fen(), board)
+            node.candidate = workerPlay.pick_candidate()
+        if self.store is not None:
+            self.store.put_candidate(node)
+
+    def _engine_move(self, node: PositionNode, board: chess.Board):
+        depth = self.settings.engine.depth
+        self.status.info2(f"Running engine for '{board.fen()}' at depth {depth}, this can take a while")
+        with self.metrics.time('engine_move'):
+            PlayResult = self.engine.play(board, chess.engine.Limit(depth=depth)) #we get the engine to finish the line
+        node.engineMove = PlayResult.move
+        if self.store is not None:
+            self.store.put_engine_move(node)
+
+    def stats(self) -> str:
+        stats = f"position graph: {len(self.nodes)} positions, {self.transpositions} transpositions, {self.saved} candidate and engine searches saved"
+        if self.store is not None:
+            stats += f", {self.store.stats()}"
+        return stats
@@ -0,0 +1,86 @@
+from enum import Enum
+from functools import lru_cache
+
+import numpy as np
+import scipy.stats as st
+
+
+class IntervalMethod(Enum):
+    NORMAL = "Normal approximation"
+    WILSON = "Wilson score"
+    BAYES = "Bayesian (Jeffreys prior)"
+
+
+@lru_cache(maxsize=None)
+def z_score(alpha: float) -> float:
+    # the quantile only depends on alpha, so we compute it once per setting instead of once per move
+    return float(st.norm.ppf(1 - alpha / 2))
+
+
+def percentages(white, black, draws, draws_are_half: bool):
+    """
+    Win, loss and draw rates for arrays of game counts, positions without games get rates of 0
+    """
+    white = np.asarray(white, dtype=float)
+    black = np.asarray(black, dtype=float)
+    draws = np.asarray(draws, dtype=float)
+    n = white + black + draws
+    if draws_are_half:
+        white = white + 0.5 * draws
+        black = black + 0.5 * draws
+    with np.errstate(divide='ignore', invalid='ignore'):
+        white_perc = np.where(n > 0, white / n, 0.0)
+        black_perc = np.where(n > 0, black / n, 0.0)
+        draw_perc = np.where(n > 0, draws / n, 0.0)
+    return white_perc, black_perc, draw_perc, n
+
+
+def intervals(winRate, games, alpha: float, method: IntervalMethod = IntervalMethod.NORMAL):
+    """
+    Lower and upper bounds of the win rates at confidence 1 - alpha, floored at 0 like the original potency scores
+    """
+    p = np.asarray(winRate, dtype=float)
+    n = np.asarray(games, dtype=float)
+    z = z_score(alpha)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == IntervalMethod.WILSON:
+            denominator = 1 + z * z / n
+            centre = (p + z * z / (2 * n)) / denominator
+            margin = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+            lb, ub = centre - margin, centre + margin
+        elif method == IntervalMethod.BAYES:
+            # equal tailed credible interval of the beta posterior, draws counted as half wins when the setting says so
+            wins = p * n
+            lb = st.beta.ppf(alpha / 2, wins + 0.5, n - wins + 0.5)
+            ub = st.beta.ppf(1 - alpha / 2, wins + 0.5, n - wins + 0.5)
+        else:
+            margin = z * np.sqrt(p * (1 - p) / n)
+            lb, ub = p - margin, p + margin
+    lb = np.where(n > 0, np.maximum(0, lb), 0.0)
+    ub = np.where(n > 0, np.maximum(0, ub), 0.0)
+    return lb, ub
+
+
+def score_moves(white, black, draws, positionGames, whiteToMove, moveSelection):
+    """
+    Scores every move of a position, or of a whole frontier when positionGames and whiteToMove are arrays, in one call.
+    Moves without enough games or playrate get a value and bounds of 0.
+    """
+    white_perc, black_perc, draw_perc, total_games = percentages(white, black, draws, moveSelection.draws_are_half)
+    positionGames = np.asarray(positionGames, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        playrate = np.where(positionGames > 0, total_games / positionGames, 0.0)
+    winRate = np.where(whiteToMove, white_perc, black_perc)
+    lb_value, ub_value = intervals(winRate, total_games, moveSelection.alpha, moveSelection.interval_method)
+
+    reliable = (total_games > moveSelection.min_games) & (playrate > moveSelection.min_play_rate)
+    return {
+        'white_perc': white_perc,
+        'black_perc': black_perc,
+        'draw_perc': draw_perc,
+        'total_games': total_games,
+        'playrate': playrate,
+        'value': np.where(reliable, winRate, 0.0),
+        'lb_value': np.where(reliable, lb_value, 0.0),
+        'ub_value': np.where(reliable, ub_value, 0.0),
+    }
@@ -9,6 +9,16 @@ import chess
 import chess.pgn
 import psutil
 
+from frontier import FrontierOrder
+from scoring import IntervalMethod
+
+
+class SettingsSection:
+    def __setstate__(self, state):
+        # settings saved by older versions lack the newer fields, so we start from the defaults
+        self.__init__()
+        self.__dict__.update(state)
+
 
 class Order(Enum):
     LONG_TO_SHORT = "Long lines to short lines"
@@ -32,10 +42,17 @@ class Book:
         return len(game.errors) == 0
 
 
-class BookSettings:
+class BookSettings(SettingsSection):
     def __init__(self) -> None:
         self.order: Order = Order.SHORT_TO_LONG
         self.books_string: str = "Book A\n1. e4 e5\n\nBook B\n1. e4 e5 2. f4"
+        self.stream_lines: bool = False
+        self.sort_run_lines: int = 100000
+        self.chapter_workers: int = 1
+        self.run_report: bool = True
+        self.resume: bool = True
+        self.checkpoint_seconds: int = 30
+        self.polyglot: bool = True
 
     def order_callback(self, _, order_value):
         self.order = Order(order_value)
@@ -43,6 +60,26 @@ class BookSettings:
     def books_string_callback(self, _, books_string):
         self.books_string = books_string
 
+    def stream_lines_callback(self, _, stream_lines):
+        self.stream_lines = stream_lines
+
+    def chapter_workers_callback(self, _, chapter_workers):
+        if chapter_workers > 0:
+            self.chapter_workers = chapter_workers
+
+    def run_report_callback(self, _, run_report):
+        self.run_report = run_report
+
+    def resume_callback(self, _, resume):
+        self.resume = resume
+
+    def checkpoint_seconds_callback(self, _, checkpoint_seconds):
+        if checkpoint_seconds > 0:
+            self.checkpoint_seconds = checkpoint_seconds
+
+    def polyglot_callback(self, _, polyglot):
+        self.polyglot = polyglot
+
     def get_books(self) -> List[Book]:
         books = list()
         lines = self.books_string.splitlines()
@@ -52,6 +89,15 @@ class BookSettings:
         return books
 
 
+EXPLORER_URL = 'https://explorer.lichess.ovh/lichess'
+
+
+class ExplorerSource(Enum):
+    LICHESS = "Lichess opening explorer"
+    LOCAL = "Local index"
+    REPLAY = "Recorded responses"
+
+
 class Variant(Enum):
     STANDARD = "standard"
     CHESS960 = "chess960"
@@ -109,8 +155,17 @@ class DatabaseSettings:
         if moves > 5:
             self.moves = moves
 
+    def fingerprint(self) -> str:
+        return explorer_fingerprint(self.variant.value, [speed.value for speed in self.speeds],
+                                    [rating.value for rating in self.ratings], self.moves)
+
+
+def explorer_fingerprint(variant: str, speeds: List[str], ratings: List[str], moves) -> str:
+    # identifies the explorer query independent of the order speeds and ratings were selected in
+    return f"variant={variant};speeds={','.join(sorted(speeds))};ratings={','.join(sorted(ratings))};moves={moves}"
+
 
-class MoveSelectionSettings:
+class MoveSelectionSettings(SettingsSection):
     def __init__(self):
         self.depth_likelihood: float = 0.01
         self.alpha: float = 0.001
@@ -118,6 +173,7 @@ class MoveSelectionSettings:
         self.min_games: int = 20
         self.continuation_games: int = 10
         self.draws_are_half: bool = False
+        self.interval_method: IntervalMethod = IntervalMethod.NORMAL
 
     def depth_callback(self, _, depth):
         if depth >= 0:
@@ -142,8 +198,116 @@ class MoveSelectionSettings:
     def draws_are_half_callback(self, _, draws_are_half):
         self.draws_are_half = draws_are_half
 
+    def interval_method_callback(self, _, interval_method_value):
+        self.interval_method = IntervalMethod(interval_method_value)
 
-class EngineSettings:
+
+class ExplorerSettings(SettingsSection):
+    def __init__(self):
+        self.cache_enabled: bool = True
+        self.cache_path: str = 'explorer_cache.sqlite'
+        self.cache_ttl_days: int = 30
+        self.cache_max_entries: int = 500000
+        self.memo_max_entries: int = 100000
+        self.concurrency: int = 4
+        self.connect_timeout: float = 5
+        self.read_timeout: float = 30
+        self.max_retries: int = 5
+        self.source: ExplorerSource = ExplorerSource.LICHESS
+        self.local_index_path: str = 'explorer_index.sqlite'
+        self.url: str = EXPLORER_URL
+        self.rate_limit_pause: float = 60
+        self.record_enabled: bool = False
+        self.recording_path: str = 'explorer_recording.jsonl'
+        self.replay_latency: float = 0
+        self.replay_rate_limit_every: int = 0
+
+    def cache_enabled_callback(self, _, cache_enabled):
+        self.cache_enabled = cache_enabled
+
+    def cache_ttl_days_callback(self, _, cache_ttl_days):
+        if cache_ttl_days > 0:
+            self.cache_ttl_days = cache_ttl_days
+
+    def cache_max_entries_callback(self, _, cache_max_entries):
+        if cache_max_entries > 0:
+            self.cache_max_entries = cache_max_entries
+
+    def concurrency_callback(self, _, concurrency):
+        if concurrency > 0:
+            self.concurrency = concurrency
+
+    def read_timeout_callback(self, _, read_timeout):
+        if read_timeout > 0:
+            self.read_timeout = read_timeout
+
+    def max_retries_callback(self, _, max_retries):
+        if max_retries >= 0:
+            self.max_retries = max_retries
+
+    def source_callback(self, _, source_value):
+        self.source = ExplorerSource(source_value)
+
+    def local_index_path_callback(self, _, local_index_path):
+        self.local_index_path = local_index_path
+
+    def url_callback(self, _, url):
+        self.url = url.strip() or EXPLORER_URL
+
+    def record_enabled_callback(self, _, record_enabled):
+        self.record_enabled = record_enabled
+
+    def recording_path_callback(self, _, recording_path):
+        self.recording_path = recording_path
+
+    def replay_latency_callback(self, _, replay_latency):
+        if replay_latency >= 0:
+            self.replay_latency = replay_latency
+
+    def replay_rate_limit_every_callback(self, _, replay_rate_limit_every):
+        if replay_rate_limit_every >= 0:
+            self.replay_rate_limit_every = replay_rate_limit_every
+
+
+class SearchSettings(SettingsSection):
+    def __init__(self):
+        self.frontier_order: FrontierOrder = FrontierOrder.FIFO
+        self.batch_size: int = 64
+        self.max_explorer_calls: int = 0
+        self.max_engine_seconds: int = 0
+        self.max_minutes: int = 0
+        self.incremental: bool = False
+        self.graph_path: str = 'position_graph.sqlite'
+        self.memory_limit_mb: int = 0
+
+    def frontier_order_callback(self, _, frontier_order_value):
+        self.frontier_order = FrontierOrder(frontier_order_value)
+
+    def batch_size_callback(self, _, batch_size):
+        if batch_size > 0:
+            self.batch_size = batch_size
+
+    def max_explorer_calls_callback(self, _, max_explorer_calls):
+        if max_explorer_calls >= 0:
+            self.max_explorer_calls = max_explorer_calls
+
+    def max_engine_seconds_callback(self, _, max_engine_seconds):
+        if max_engine_seconds >= 0:
+            self.max_engine_seconds = max_engine_seconds
+
+    def max_minutes_callback(self, _, max_minutes):
+        if max_minutes >= 0:
+            self.max_minutes = max_minutes
+
+    def incremental_callback(self, _, incremental):
+        self.incremental = incremental
+
+    def memory_limit_mb_callback(self, _, memory_limit_mb):
+        if memory_limit_mb >= 0:
+            self.memory_limit_mb = memory_limit_mb
+
+
+class EngineSettings(SettingsSection):
     NO_FILE_SELECTED = "No engine file selected"
 
     def __init__(self):
@@ -153,9 +317,13 @@ class EngineSettings:
         self.depth: int = 20
         self.threads: int = int(psutil.cpu_count(logical=True) / 2)  # half of logical CPU cores
         self.hash: int = int(psutil.virtual_memory().available / 1024 / 1024 / 2)  # half of available RAM
+        self.processes: int = 1
+        self.multipv: bool = False
         self.soundness_limit: int = -99
         self.move_loss_limit: int = -99
         self.ignore_loss_limit: int = 300
+        self.cache_enabled: bool = True
+        self.cache_path: str = 'engine_cache.sqlite'
 
     def enabled_callback(self, _, enabled):
         self.enabled = enabled
@@ -181,6 +349,13 @@ class EngineSettings:
         if hash > 0:
             self.hash = hash
 
+    def processes_callback(self, _, processes):
+        if processes > 0:
+            self.processes = processes
+
+    def multipv_callback(self, _, multipv):
+        self.multipv = multipv
+
     def soundness_limit_callback(self, _, soundness_limit):
         self.soundness_limit = soundness_limit
 
@@ -190,6 +365,9 @@ class EngineSettings:
     def ignore_loss_limit_callback(self, _, ignore_loss_limit):
         self.ignore_loss_limit = ignore_loss_limit
 
+    def cache_enabled_callback(self, _, cache_enabled):
+        self.cache_enabled = cache_enabled
+
 
 class Settings:
     _settings_file = 'settings.pickle'
@@ -198,6 +376,8 @@ class Settings:
         self.book = BookSettings()
         self.database = DatabaseSettings()
         self.moveSelection = MoveSelectionSettings()
+        self.explorer = ExplorerSettings()
+        self.search = SearchSettings()
         self.engine = EngineSettings()
         self.load_from_file()
 
@@ -217,5 +397,8 @@ class Settings:
             self.book = from_file.book
             self.database = from_file.database
             self.moveSelection = from_file.moveSelection
+            # settings saved before explorer and search settings existed keep the defaults
+            self.explorer = getattr(from_file, 'explorer', self.explorer)
+            self.search = getattr(from_file, 'search', self.search)
             self.engine = from_file.engine
             logging.info(f"Loaded settings from {self._settings_file}")
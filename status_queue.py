@@ -0,0 +1,33 @@
+import queue
+
+
+class QueueStatus:
+    """
+    Stands in for GenerationStatus where the GUI can't be reached, every update is put on a queue for the GUI side to show
+    """
+
+    def __init__(self, updates, source=None):
+        self.updates = updates
+        self.source = source #which chapter or worker the updates come from
+
+    def info(self, line1: str = "", line2: str = ""):
+        self.updates.put((self.source, 'info', line1, line2))
+
+    def info2(self, line2):
+        self.updates.put((self.source, 'info2', None, line2))
+
+    def error(self, line1: str = "", line2: str = ""):
+        self.updates.put((self.source, 'error', line1, line2))
+
+    def metrics(self, line3):
+        self.updates.put((self.source, 'metrics', None, line3))
+
+
+def drain(updates) -> list:
+    # we take whatever is waiting without blocking, so the caller can keep drawing frames
+    drained = []
+    while True:
+        try:
+            drained.append(updates.get_nowait())
+        except queue.Empty:
+            return drained
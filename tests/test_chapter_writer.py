@@ -0,0 +1,70 @@
+import os
+import random
+
+import chess
+import pytest
+
+from BookBuilder import ChapterWriter
+from frontier import LineNode
+from settings import Settings
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) #no saved settings are loaded
+    return Settings()
+
+
+def final_lines(count):
+    # lines of one or two moves with ties in their playrates, so the merge has to keep equal keys in order
+    random.seed(3)
+    board = chess.Board()
+    board.push_san('e4')
+    root = LineNode(None, None, None, 1, 1, 0.5, 100, board)
+    root.prefix = [('e4', 1)]
+    lines = []
+    for index in range(count):
+        node = LineNode(root, 'e5', 'Nf3', random.choice([0.1, 0.2, 0.3]), 0.5, 0.5, index, None)
+        if index % 3:
+            node = LineNode(node, 'Nc6', 'Bb5', random.choice([0.1, 0.2]), 0.25, 0.5, index, None)
+        lines.append((node, 0.4 + index / count / 10, index))
+    return root.board, lines
+
+
+def write_chapter(settings, path, runSize):
+    settings.book.sort_run_lines = runSize
+    rootBoard, lines = final_lines(200)
+    writer = ChapterWriter(settings, path, 'Chapter', '1. e4', rootBoard)
+    for line in lines:
+        writer.add(*line)
+    runs = list(writer.runs)
+    writer.finish()
+    with open(path) as file:
+        return file.read(), runs
+
+
+def test_merged_runs_write_the_same_chapter_as_one_sort(settings, tmp_path):
+    sorted_once, runs = write_chapter(settings, str(tmp_path / 'once.pgn'), 1000)
+    assert not runs
+
+    merged, runs = write_chapter(settings, str(tmp_path / 'merged.pgn'), 7)
+    assert len(runs) == 28
+    assert merged == sorted_once
+    assert all(run.closed for run in runs)
+
+
+def test_streamed_lines_are_replaced_by_the_sorted_chapter(settings, tmp_path):
+    settings.book.stream_lines = True
+    rootBoard, lines = final_lines(10)
+    path = str(tmp_path / 'chapter.pgn')
+    writer = ChapterWriter(settings, path, 'Chapter', '1. e4', rootBoard)
+    for line in lines:
+        writer.add(*line)
+    writer.flush()
+    with open(str(tmp_path / 'chapter_partial.pgn')) as file:
+        assert file.read().count('[Event') == 10
+
+    writer.finish()
+    assert not os.path.exists(str(tmp_path / 'chapter_partial.pgn'))
+    with open(path) as file:
+        assert file.read().count('[Event') == 10
@@ -0,0 +1,92 @@
+import chess
+import chess.engine
+import pytest
+
+from metrics import Metrics
+from uci_engine import CachedEngine, EngineCache
+
+
+class Engine:
+    # a stand-in for the engine that answers every position with the same line and counts its searches
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0
+        self.metrics = Metrics()
+
+    def analyse(self, board, limit, **kwargs):
+        self.calls += 1
+        moves = sorted(board.legal_moves, key=lambda move: move.uci())[:1]
+        if moves:
+            after = board.copy()
+            after.push(moves[0])
+            moves += sorted(after.legal_moves, key=lambda move: move.uci())[:1]
+        return {'depth': limit.depth, 'score': chess.engine.PovScore(chess.engine.Cp(35), board.turn), 'pv': moves}
+
+    def play(self, board, limit, **kwargs):
+        info = self.analyse(board, limit)
+        return chess.engine.PlayResult(info['pv'][0], None, info)
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = EngineCache(str(tmp_path / 'engine.sqlite'))
+    yield cache
+    cache.close()
+
+
+def test_a_deeper_evaluation_answers_a_shallower_request(cache):
+    fen = chess.Board().fen()
+    cache.put(fen, 'Stockfish', 20, chess.engine.Cp(25), ['e2e4', 'e7e5'])
+
+    assert cache.get(fen, 'Stockfish', 18) == (20, chess.engine.Cp(25), ['e2e4', 'e7e5'])
+    assert cache.get(fen.replace(' 0 1', ' 4 9'), 'Stockfish', 20) is not None #the move counters are not part of the key
+    assert cache.get(fen, 'Stockfish', 22) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_evaluations_are_kept_apart_by_engine_identity(cache):
+    fen = chess.Board().fen()
+    cache.put(fen, 'Stockfish 15', 20, chess.engine.Mate(3), ['e2e4'])
+    assert cache.get(fen, 'Stockfish 15', 20) == (20, chess.engine.Mate(3), ['e2e4'])
+    assert cache.get(fen, 'Stockfish 16', 20) is None
+
+
+def test_evaluations_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'engine.sqlite')
+    cache = EngineCache(path)
+    cache.put(chess.Board().fen(), 'Stockfish', 20, chess.engine.Cp(-40), ['d2d4'])
+    cache.close()
+
+    cache = EngineCache(path)
+    assert cache.get(chess.Board().fen(), 'Stockfish', 10) == (20, chess.engine.Cp(-40), ['d2d4'])
+    cache.close()
+
+
+def test_cached_engine_only_searches_on_a_miss(cache):
+    engine = Engine()
+    cached = CachedEngine(engine, cache, 'Stockfish')
+    board = chess.Board()
+    board.push_san('e4')
+
+    first = cached.analyse(board, chess.engine.Limit(depth=12))
+    second = cached.analyse(board, chess.engine.Limit(depth=10))
+    assert engine.calls == 1
+    assert second['depth'] == 12
+    assert second['pv'] == first['pv']
+    assert second['score'] == first['score'] #scores are stored for the side to move and keep their point of view
+
+    played = cached.play(board, chess.engine.Limit(depth=12))
+    assert engine.calls == 1
+    assert (played.move, played.ponder) == (first['pv'][0], first['pv'][1])
+    assert engine.metrics.chapters[0].counters['engine.cache_hits'] == 2
+
+
+def test_searches_without_a_depth_go_to_the_engine(cache):
+    engine = Engine()
+    cached = CachedEngine(engine, cache, 'Stockfish')
+    cached.analyse(chess.Board(), chess.engine.Limit(time=0.1))
+    cached.analyse(chess.Board(), chess.engine.Limit(time=0.1))
+    assert engine.calls == 2
@@ -0,0 +1,84 @@
+import threading
+from types import SimpleNamespace
+
+import chess
+import chess.engine
+import pytest
+
+from BookBuilder import split_engine
+from generation_worker import CancelToken, Cancelled
+from uci_engine import EnginePool
+
+
+class Process:
+    # a stand-in for an engine process that answers every search with the first legal move
+    def __init__(self):
+        self.id = {'name': 'Fake'}
+        self.options = {}
+        self.quits = 0
+
+    def configure(self, options):
+        self.options.update(options)
+
+    def play(self, board, limit, **kwargs):
+        return chess.engine.PlayResult(next(iter(board.legal_moves)), None)
+
+    def quit(self):
+        self.quits += 1
+
+
+@pytest.fixture
+def processes(monkeypatch):
+    processes = []
+
+    def popen_uci(path):
+        processes.append(Process())
+        return processes[-1]
+
+    monkeypatch.setattr(chess.engine.SimpleEngine, 'popen_uci', popen_uci)
+    return processes
+
+
+def test_quitting_twice_quits_every_engine_once(processes):
+    pool = EnginePool('engine', 2, 3, 64)
+    assert [process.options for process in processes] == [{'Hash': 64, 'Threads': 3}] * 2
+    pool.play(chess.Board(), chess.engine.Limit(depth=1))
+    pool.quit()
+    pool.quit()
+    assert [process.quits for process in processes] == [1, 1]
+    with pytest.raises(chess.engine.EngineTerminatedError):
+        pool.play(chess.Board(), chess.engine.Limit(depth=1))
+
+
+def test_a_search_waiting_on_a_busy_pool_stops_with_the_run(processes):
+    token = CancelToken()
+    pool = EnginePool('engine', 1, 1, 16, token)
+    busy = pool._acquire() #a search in flight holds the only engine
+    errors = []
+
+    def search():
+        try:
+            pool.play(chess.Board(), chess.engine.Limit(depth=1))
+        except Cancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=search)
+    thread.start()
+    token.cancel()
+    thread.join(5)
+    assert not thread.is_alive() and len(errors) == 1
+    assert not pool._waiters
+
+    pool._release(busy)
+    pool.quit() #the stopped search left nothing to wait for
+    assert processes[0].quits == 1
+
+
+def test_books_at_once_split_the_engine_settings():
+    engine = SimpleNamespace(processes=4, threads=2, hash=256)
+    split_engine(engine, 3)
+    assert (engine.processes, engine.threads, engine.hash) == (1, 2, 256)
+
+    engine = SimpleNamespace(processes=1, threads=8, hash=1024)
+    split_engine(engine, 4) #one process between four books, each runs its own with a quarter of the threads and hash
+    assert (engine.processes, engine.threads, engine.hash) == (1, 2, 256)
@@ -0,0 +1,86 @@
+import chess
+import pytest
+
+import explorer
+from explorer import ExplorerCache
+
+DAY = 24 * 60 * 60
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(explorer.time, 'time', clock)
+    return clock
+
+
+def fens(count):
+    # distinct positions, one white pawn push after another
+    board = chess.Board()
+    positions = []
+    for move in ['a2a3', 'b2b3', 'c2c3', 'd2d3', 'e2e3', 'f2f3', 'g2g3', 'h2h3', 'a3a4', 'b3b4', 'c3c4', 'd3d4'][:count]:
+        board.push_uci(move)
+        positions.append(board.fen())
+        board.push(chess.Move.null())
+    return positions
+
+
+def test_get_returns_put_response_for_same_position(tmp_path, clock):
+    cache = ExplorerCache(str(tmp_path / 'cache.sqlite'), 30, 100)
+    fen = chess.Board().fen()
+    cache.put(fen, 'lichess', {'moves': [{'san': 'e4'}]})
+
+    # the move counters are not part of the key
+    assert cache.get(fen.replace(' 0 1', ' 5 9'), 'lichess') == {'moves': [{'san': 'e4'}]}
+    assert cache.get(fen, 'masters') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_responses_expire_after_ttl(tmp_path, clock):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = ExplorerCache(path, 1, 100)
+    fen = chess.Board().fen()
+    cache.put(fen, 'lichess', {'white': 1})
+
+    clock.now += DAY - 1
+    assert cache.get(fen, 'lichess') == {'white': 1}
+    clock.now += 2
+    assert cache.get(fen, 'lichess') is None
+    cache.close()
+
+    # opening the cache deletes the expired responses
+    cache = ExplorerCache(path, 1, 100)
+    assert cache.evictions == 1
+    assert cache._entries == 0
+    cache.close()
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path, clock):
+    cache = ExplorerCache(str(tmp_path / 'cache.sqlite'), 30, 10)
+    positions = fens(11)
+    for fen in positions[:10]:
+        clock.now += 1
+        cache.put(fen, 'lichess', {'fen': fen})
+    clock.now += 1
+    assert cache.get(positions[0], 'lichess') is not None #the oldest response is now the most recently used
+
+    clock.now += 1
+    cache.put(positions[10], 'lichess', {'fen': positions[10]})
+
+    # one over the limit evicts the least recently used tenth on top of the excess
+    assert cache.evictions == 2
+    assert cache._entries == 9
+    assert cache.get(positions[1], 'lichess') is None
+    assert cache.get(positions[2], 'lichess') is None
+    for fen in [positions[0]] + positions[3:]:
+        assert cache.get(fen, 'lichess') == {'fen': fen}
+    cache.close()
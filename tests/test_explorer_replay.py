@@ -0,0 +1,138 @@
+import json
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+import chess
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from explorer import Explorer
+from explorer_replay import EMPTY_RESPONSE, Recording, Replayer
+from settings import ExplorerSource, Settings
+
+
+class Status:
+    def info2(self, text):
+        pass
+
+
+class FakeLichess(BaseAdapter):
+    # answers every position with stats made from its FEN, so each position gets a different response
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests += 1
+        fen = parse_qs(urlsplit(request.url).query)['fen'][0]
+        games = len(fen)
+        body = {'white': games, 'black': games // 2, 'draws': 3, 'moves': [
+            {'san': 'e5', 'uci': 'e7e5', 'white': games, 'black': 1, 'draws': 2}]}
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(body).encode('utf-8')
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def positions():
+    board = chess.Board()
+    fens = [board.fen()]
+    for san in ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5']:
+        board.push_san(san)
+        fens.append(board.fen())
+    return fens
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) #no saved settings are loaded
+    settings = Settings()
+    settings.explorer.cache_enabled = False
+    settings.explorer.recording_path = str(tmp_path / 'recording.jsonl')
+    settings.explorer.rate_limit_pause = 0
+    return settings
+
+
+def record(settings):
+    settings.explorer.record_enabled = True
+    explorer = Explorer(settings, Status())
+    explorer.session.mount(settings.explorer.url, FakeLichess())
+    responses = [explorer.get(fen) for fen in positions()]
+    explorer.get(positions()[0]) #a position asked twice is recorded once
+    explorer.close()
+    return responses
+
+
+def test_replay_answers_with_the_recorded_responses(settings):
+    recorded = record(settings)
+    assert len(Recording(settings.explorer.recording_path)) == len(recorded)
+
+    settings.explorer.source = ExplorerSource.REPLAY
+    settings.explorer.replay_rate_limit_every = 3
+    explorer = Explorer(settings, Status())
+    assert [explorer.get(fen) for fen in positions()] == recorded
+    assert explorer.replayer.rateLimited == 2 #the rate limited requests were retried
+    assert explorer.replayer.misses == 0
+    explorer.close()
+
+
+def test_positions_missing_from_the_recording_are_empty(settings):
+    record(settings)
+    replayer = Replayer(Recording(settings.explorer.recording_path))
+    settings.explorer.source = ExplorerSource.REPLAY
+    explorer = Explorer(settings, Status())
+    status, body = replayer.respond(explorer.url('8/8/8/8/8/8/8/k6K w - - 0 1'))
+    assert (status, body, replayer.misses) == (200, EMPTY_RESPONSE, 1)
+
+    settings.database.moves = 30 #another database settings fingerprint
+    status, body = replayer.respond(Explorer(settings, Status()).url(positions()[0]))
+    assert body == EMPTY_RESPONSE
+
+
+def test_responses_of_another_explorer_url_are_cached_apart(settings, tmp_path):
+    settings.explorer.cache_enabled = True
+    settings.explorer.cache_path = str(tmp_path / 'cache.sqlite')
+    fen = positions()[0]
+
+    settings.explorer.url_callback(None, 'http://127.0.0.1:8700/lichess')
+    explorer = Explorer(settings, Status())
+    standIn = FakeLichess()
+    explorer.session.mount(settings.explorer.url, standIn)
+    explorer.get(fen)
+    explorer.get(fen)
+    assert standIn.requests == 1
+    explorer.close()
+
+    settings.explorer.url_callback(None, '')
+    explorer = Explorer(settings, Status())
+    lichess = FakeLichess()
+    explorer.session.mount(settings.explorer.url, lichess)
+    explorer.get(fen)
+    assert lichess.requests == 1 #the stand-in's response was not cached for Lichess
+    explorer.close()
+
+
+def test_concurrent_requests_are_all_counted(settings):
+    settings.explorer.concurrency = 8
+    explorer = Explorer(settings, Status())
+    lichess = FakeLichess()
+    explorer.session.mount(settings.explorer.url, lichess)
+    board = chess.Board()
+    fens = []
+    for move in board.legal_moves:
+        board.push(move)
+        fens.append(board.fen())
+        board.pop()
+    explorer.prefetch(fens)
+    assert explorer.calls == lichess.requests == len(fens)
+    assert explorer.latencies.count == len(fens)
+    assert 'p95 at most' in explorer.stats()
+    explorer.close()
@@ -0,0 +1,168 @@
+import random
+from types import SimpleNamespace
+
+import chess
+
+import frontier
+from frontier import Budget, Frontier, FrontierOrder, LineNode
+
+
+def test_breadth_first_hands_out_whole_generations_in_push_order():
+    queue = Frontier(FrontierOrder.FIFO, 2)
+    for line in ['a', 'b', 'c']:
+        queue.push(line, 0.5)
+    assert queue.next_batch() == ['a', 'b', 'c']
+
+    queue.push('d', 0.1)
+    assert queue.next_batch() == ['d']
+    assert queue.next_batch() == []
+    assert (queue.pushed, queue.expanded, queue.max_depth) == (4, 4, 3)
+
+
+def test_most_likely_first_hands_out_the_top_lines_up_to_the_batch_size():
+    queue = Frontier(FrontierOrder.PRIORITY, 2)
+    for line, likelihood in [('a', 0.1), ('b', 0.5), ('c', 0.3), ('d', 0.5)]:
+        queue.push(line, likelihood)
+    assert queue.next_batch() == ['b', 'd'] #ties are handed out in push order
+    queue.push('e', 0.2)
+    assert queue.next_batch() == ['c', 'e']
+    assert queue.next_batch() == ['a']
+    assert len(queue) == 0
+
+
+def test_drain_returns_the_queued_lines_most_likely_first():
+    queue = Frontier(FrontierOrder.PRIORITY, 2)
+    for line, likelihood in [('a', 0.1), ('b', 0.5), ('c', 0.3)]:
+        queue.push(line, likelihood)
+    assert queue.drain() == ['b', 'c', 'a']
+    assert queue.expanded == 0 #drained lines are kept as final lines, not expanded
+
+
+def test_budget_reports_the_first_limit_reached():
+    search = SimpleNamespace(max_explorer_calls=10, max_engine_seconds=60, max_minutes=0)
+    rateLimit = SimpleNamespace(calls=9) #explorer calls are counted by the rate limit the chapters share
+    explorer = SimpleNamespace(rateLimit=rateLimit)
+    engine = SimpleNamespace(seconds=30)
+    budget = Budget(search, explorer, engine)
+    assert budget.is_limited()
+    assert budget.exhausted() is None
+
+    rateLimit.calls = 10
+    assert budget.exhausted() == "used 10 of 10 explorer calls"
+    rateLimit.calls = 0
+    engine.seconds = 61
+    assert budget.exhausted() == "used 61 of 60 engine seconds"
+
+    unlimited = SimpleNamespace(max_explorer_calls=0, max_engine_seconds=0, max_minutes=0)
+    assert not Budget(unlimited, explorer, None).is_limited()
+    assert Budget(unlimited, explorer, None).exhausted() is None
+
+
+def test_lines_build_their_moves_and_likelihood_path_from_their_parents():
+    board = chess.Board()
+    board.push_san('e4')
+    root = LineNode(None, None, None, 1, 1, 0.5, 100, board)
+    root.prefix = [('e4', 1)]
+    line = LineNode(root, 'e5', 'Nf3', 0.6, 0.6, 0.55, 80, None)
+    line = LineNode(line, 'Nc6', 'Bb5', 0.5, 0.3, 0.57, 40, None)
+
+    assert line.moves() == [('e5', 'Nf3'), ('Nc6', 'Bb5')]
+    assert line.likelihood_path() == [('e4', 1), ('e5', 0.6), ('Nc6', 0.5)]
+    assert root.moves() == []
+    assert root.likelihood_path() == [('e4', 1)]
+
+
+def make_root():
+    board = chess.Board()
+    board.push_san('e4')
+    root = LineNode(None, None, None, 1, 1, 0.5, 100, board)
+    root.prefix = [('e4', 1)]
+    return root
+
+
+def make_line(root, lineId, likelihood):
+    # the board keeps the moves played after the root, the way Leafer hands lines to the frontier
+    board = root.board.copy()
+    board.push_san('e5')
+    board.push_san('Nf3')
+    line = LineNode(root, 'e5', 'Nf3', 0.4, likelihood, 0.55, 50, board)
+    line.lineId = lineId
+    return line
+
+
+def pop_all(queue):
+    lines = []
+    while len(queue):
+        lines.extend(queue.next_batch())
+    return lines
+
+
+def test_fifo_hands_out_lines_in_push_order_across_a_spill():
+    root = make_root()
+    queue = Frontier(FrontierOrder.FIFO, 8, bounded=True)
+    for lineId in range(50):
+        queue.push(make_line(root, lineId, 0.5), 0.5)
+
+    assert queue.spill() == 42
+    assert len(queue) == 50
+    for lineId in range(50, 60): #lines pushed after the spill go behind the ones on disk
+        queue.push(make_line(root, lineId, 0.5), 0.5)
+
+    lines = pop_all(queue)
+    assert [line.lineId for line in lines] == list(range(60))
+    assert queue.spilled == 0
+
+
+def test_restored_lines_keep_their_board_and_moves():
+    root = make_root()
+    queue = Frontier(FrontierOrder.FIFO, 2, bounded=True)
+    for lineId in range(10):
+        queue.push(make_line(root, lineId, 0.5), 0.5)
+    queue.spill()
+
+    line = pop_all(queue)[-1]
+    assert line.parent is root
+    assert line.moves() == [('e5', 'Nf3')]
+    assert line.likelihood_path() == [('e4', 1), ('e5', 0.4)]
+    assert line.board.move_stack == make_line(root, 9, 0.5).board.move_stack
+    assert line.board == make_line(root, 9, 0.5).board
+
+
+def test_small_queues_are_not_spilled():
+    root = make_root()
+    queue = Frontier(FrontierOrder.PRIORITY, 8)
+    for lineId in range(16):
+        queue.push(make_line(root, lineId, 0.5), 0.5)
+    assert queue.spill() == 0
+
+
+def test_priority_order_is_kept_across_spills_and_run_merges():
+    random.seed(7)
+    root = make_root()
+    queue = Frontier(FrontierOrder.PRIORITY, 4)
+    expected = []
+    lineId = 0
+    for _ in range(frontier.MAX_RUNS + 4): #enough spills to merge the smallest runs
+        for _ in range(12):
+            likelihood = random.choice([0.1, 0.2, 0.3, random.random()]) #ties are handed out in push order
+            queue.push(make_line(root, lineId, likelihood), likelihood)
+            expected.append((-likelihood, lineId))
+            lineId += 1
+        assert queue.spill() > 0
+    assert len(queue._runs) <= frontier.MAX_RUNS
+
+    lines = pop_all(queue)
+    assert [line.lineId for line in lines] == [lineId for _, lineId in sorted(expected)]
+    assert queue.spilled == 0
+    assert not queue._runs
+
+
+def test_drain_returns_spilled_lines_most_likely_first_too():
+    root = make_root()
+    queue = Frontier(FrontierOrder.PRIORITY, 2)
+    for lineId, likelihood in enumerate([0.1, 0.5, 0.3, 0.4, 0.2, 0.6]):
+        queue.push(make_line(root, lineId, likelihood), likelihood)
+    queue.spill()
+
+    assert [line.lineId for line in queue.drain()] == [5, 1, 3, 2, 4, 0]
+    assert queue.expanded == 0
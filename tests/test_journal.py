@@ -0,0 +1,109 @@
+import json
+from types import SimpleNamespace
+
+import chess
+import pytest
+
+from frontier import LineNode
+from journal import ChapterJournal, journal_fingerprint
+from settings import Settings
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) #no saved settings are loaded
+    return Settings()
+
+
+def start_chapter(path, fingerprint='abc'):
+    journal = ChapterJournal(path, fingerprint, 30)
+    board = chess.Board()
+    board.push_san('e4')
+    root = LineNode(None, None, None, 1, 0.9, 0.52, 1000, board)
+    root.prefix = [('e4', 1)]
+    journal.record_root(root)
+    return journal, root
+
+
+def expand(journal, node, continuations):
+    # what Leafer hands back for a line: its children and the final lines it found
+    children = []
+    for continuation, reply in continuations:
+        board = node.board.copy(stack=False)
+        board.push_san(continuation)
+        board.push_san(reply)
+        children.append(LineNode(node, continuation, reply, 0.5, node.cumulative * 0.5, 0.55, 100, board))
+    journal.record(node, SimpleNamespace(pgnList=children, finalLines=[(node, 0.6, 40)]))
+    journal.checkpoint()
+    return children
+
+
+def test_resume_replays_the_recorded_expansions(tmp_path):
+    path = str(tmp_path / 'chapter.journal')
+    journal, root = start_chapter(path)
+    children = expand(journal, root, [('e5', 'Nf3'), ('c5', 'Nf3')])
+    expand(journal, children[0], [('Nc6', 'Bb5')])
+    journal.close()
+
+    journal = ChapterJournal(path, 'abc', 30)
+    assert not journal.done
+    assert journal.nextId == 4
+    rootBoard = chess.Board()
+    rootBoard.push_san('e4')
+    node = journal.replay_root(rootBoard)
+    assert (node.cumulative, node.winRate, node.games, node.prefix) == (0.9, 0.52, 1000, [('e4', 1)])
+    assert journal.has(node)
+
+    expansion = journal.replay(node)
+    assert [(line.lineId, line.continuation, line.reply) for line in expansion.pgnList] == [(1, 'e5', 'Nf3'), (2, 'c5', 'Nf3')]
+    assert expansion.pgnList[1].board.fen() == children[1].board.fen()
+    assert expansion.finalLines == [(node, 0.6, 40)]
+    assert [line.lineId for line in journal.replay(expansion.pgnList[0]).pgnList] == [3]
+    assert journal.replay(expansion.pgnList[1]) is None #still has to go through Leafer
+    assert journal.replayed == 2
+    journal.close()
+
+
+def test_a_cut_last_line_is_dropped_on_resume(tmp_path):
+    path = str(tmp_path / 'chapter.journal')
+    journal, root = start_chapter(path)
+    expand(journal, root, [('e5', 'Nf3')])
+    journal.close()
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write('{"type": "expand", "line": 1, "chil') #the process died while writing
+
+    journal = ChapterJournal(path, 'abc', 30)
+    assert list(journal.expansions) == [0]
+    journal.finish()
+    journal.close()
+
+    with open(path, encoding='utf-8') as file:
+        records = [json.loads(text) for text in file]
+    assert [record['type'] for record in records] == ['start', 'root', 'expand', 'done']
+    journal = ChapterJournal(path, 'abc', 30)
+    assert journal.done
+    journal.close()
+
+
+def test_a_journal_of_other_settings_starts_over(tmp_path):
+    path = str(tmp_path / 'chapter.journal')
+    journal, root = start_chapter(path)
+    expand(journal, root, [('e5', 'Nf3')])
+    journal.close()
+
+    journal = ChapterJournal(path, 'other', 30)
+    assert journal.root is None and not journal.expansions
+    journal.close()
+    with open(path, encoding='utf-8') as file:
+        assert [json.loads(text) for text in file] == [{'type': 'start', 'fingerprint': 'other'}]
+
+
+def test_fingerprint_only_changes_with_settings_that_change_the_lines(settings):
+    fingerprint = journal_fingerprint(settings, '1. e4')
+    settings.book.chapter_workers = 4
+    settings.explorer.concurrency = 8
+    assert journal_fingerprint(settings, '1. e4') == fingerprint
+
+    settings.moveSelection.alpha = 0.05
+    assert journal_fingerprint(settings, '1. e4') != fingerprint
+    assert journal_fingerprint(settings, '1. d4') != journal_fingerprint(settings, '1. e4')
@@ -0,0 +1,76 @@
+import chess
+import pytest
+
+from local_explorer import LocalExplorerIndex, build_index, game_rating, game_speed, game_variant
+from settings import DatabaseSettings, Speed
+
+GAMES = [
+    ('600+0', '1900', '1900', '1-0', '1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 4. O-O Nf6'),
+    ('600+5', '2050', '2010', '0-1', '1. e4 c5 2. Nf3'),
+    ('180+2', '1900', '1900', '1-0', '1. e4 e5'), #blitz
+    ('900+10', '1850', '1800', '1/2-1/2', '1. d4 d5'),
+    ('600+0', '1900', '1900', '*', '1. e4 e5'), #unfinished, never indexed
+    ('600+0', '1100', '1150', '0-1', '1. e4 e5'), #below the rating buckets we ask for
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    pgn = tmp_path / 'games.pgn'
+    pgn.write_text(''.join(f'[Event "Rated game"]\n[Result "{result}"]\n[WhiteElo "{white}"]\n[BlackElo "{black}"]\n'
+                           f'[TimeControl "{timeControl}"]\n\n{moves} {result}\n\n'
+                           for timeControl, white, black, result, moves in GAMES))
+    path = str(tmp_path / 'index.sqlite')
+    filters = {'variants': set(), 'speeds': set(), 'ratings': set()}
+    assert build_index(path, [str(pgn)], 1, 40, filters) == 5
+    index = LocalExplorerIndex(path)
+    yield index
+    index.close()
+
+
+def board_after(*sans):
+    board = chess.Board()
+    for san in sans:
+        board.push_san(san)
+    return board
+
+
+def test_games_are_bucketed_like_lichess():
+    assert game_speed('-') == Speed.CORRESPONDENCE.value
+    assert game_speed('15+0') == Speed.ULTRA_BULLET.value
+    assert game_speed('60+0') == Speed.BULLET.value
+    assert game_speed('180+2') == Speed.BLITZ.value
+    assert game_speed('600+0') == Speed.RAPID.value
+    assert game_speed('1800+0') == Speed.CLASSICAL.value
+    assert game_speed('?') is None
+    assert game_rating('1900', '1950') == '1800'
+    assert game_rating('900', '950') == '0'
+    assert game_rating('?', '1500') is None
+    assert game_variant('Standard') == 'standard'
+    assert game_variant('King of the Hill') == 'kingOfTheHill'
+    assert game_variant('Bughouse') is None
+
+
+def test_get_answers_in_the_shape_of_the_lichess_api(index):
+    response = index.get(chess.Board().fen(), DatabaseSettings())
+    assert response == {
+        'white': 1, 'black': 1, 'draws': 1,
+        'moves': [{'uci': 'e2e4', 'san': 'e4', 'white': 1, 'black': 1, 'draws': 0},
+                  {'uci': 'd2d4', 'san': 'd4', 'white': 0, 'black': 0, 'draws': 1}],
+    }
+
+
+def test_castling_is_given_as_the_king_taking_its_rook(index):
+    response = index.get(board_after('e4', 'e5', 'Nf3', 'Nc6', 'Bc4', 'Bc5').fen(), DatabaseSettings())
+    assert response['moves'] == [{'uci': 'e1h1', 'san': 'O-O', 'white': 1, 'black': 0, 'draws': 0}]
+
+
+def test_database_settings_filter_and_limit_the_moves(index):
+    database = DatabaseSettings()
+    database.speeds = [Speed.BLITZ]
+    assert index.get(chess.Board().fen(), database)['white'] == 1
+    assert index.get(board_after('e4', 'c5').fen(), database) == {'white': 0, 'black': 0, 'draws': 0, 'moves': []}
+
+    database = DatabaseSettings()
+    database.moves = 1
+    assert [move['san'] for move in index.get(chess.Board().fen(), database)['moves']] == ['e4']
@@ -0,0 +1,32 @@
+from metrics import Histogram, Metrics
+
+
+def test_histogram_buckets_and_percentiles():
+    histogram = Histogram()
+    for milliseconds in [0.5, 3, 3, 4, 40, 70000]:
+        histogram.add(milliseconds / 1000)
+    report = histogram.report()
+    assert report['count'] == 6
+    assert report['buckets'] == {'<=1ms': 1, '<=5ms': 3, '<=50ms': 1, '>60000ms': 1}
+    assert report['p50_ms_at_most'] == 5
+    assert report['p95_ms_at_most'] == 70000 #the last bucket reports the slowest duration
+
+
+def test_worker_chapter_reports_merge_into_the_totals():
+    worker = Metrics()
+    worker.start_chapter(1, 'Book A')
+    worker.count('leafer.lines', 3)
+    worker.record('explorer.request', 0.004)
+    worker.finish_chapter()
+
+    metrics = Metrics()
+    metrics.count('engine.cache_hits')
+    metrics.merge(1, worker.chapter_report(1))
+    metrics.merge(2, worker.chapter_report(1))
+    report = metrics.report({'chapters_requested': 2})
+
+    assert report['chapters_requested'] == 2
+    assert report['chapters']['1']['name'] == 'Book A'
+    assert report['total']['counters'] == {'engine.cache_hits': 1, 'leafer.lines': 6}
+    assert report['total']['timers']['explorer.request']['count'] == 2
+    assert report['total']['timers']['explorer.request']['buckets'] == {'<=5ms': 2}
@@ -0,0 +1,148 @@
+import hashlib
+
+import chess
+import chess.engine
+import pytest
+
+from explorer import PositionMemo
+from metrics import Metrics
+from settings import Settings
+from uci_engine import CachedEngine, EngineCache
+from workerEngineReduce import WorkerPlay
+
+
+def static_eval(board):
+    # a fixed centipawn value for the side to move, so every way of asking agrees on what a position is worth
+    digest = hashlib.md5(board.fen().encode('utf-8')).digest()
+    return int.from_bytes(digest[:2], 'big') % 400 - 200
+
+
+class Engine:
+    """
+    One ply engine: a move is worth minus the static value of the position after it. Counts the searches it runs
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.metrics = Metrics()
+
+    def _lines(self, board, moves):
+        lines = []
+        for move in moves:
+            board.push(move)
+            lines.append((-static_eval(board), move))
+            board.pop()
+        return sorted(lines, key=lambda line: (-line[0], line[1].uci()))
+
+    def play(self, board, limit, **kwargs):
+        self.calls += 1
+        return chess.engine.PlayResult(self._lines(board, board.legal_moves)[0][1], None)
+
+    def analyse(self, board, limit, multipv=None, root_moves=None, **kwargs):
+        self.calls += 1
+        if multipv is None and root_moves is None:
+            return {'score': chess.engine.PovScore(chess.engine.Cp(static_eval(board)), board.turn), 'pv': []}
+        lines = self._lines(board, root_moves or list(board.legal_moves))
+        infos = [{'score': chess.engine.PovScore(chess.engine.Cp(score), board.turn), 'pv': [move]} for score, move in lines]
+        return infos[:multipv] if multipv else infos[0]
+
+
+class Status:
+    def info2(self, text):
+        pass
+
+
+class Explorer:
+    # stats for the first legal moves of a position, with games and results that differ per move
+    def __init__(self):
+        self.memo = PositionMemo(100)
+
+    def url(self, fen):
+        return fen
+
+    def get(self, fen):
+        board = chess.Board(fen)
+        moves = []
+        for index, move in enumerate(sorted(board.legal_moves, key=lambda move: move.uci())[:8]):
+            games = 4000 // (index + 1)
+            share = hashlib.md5(move.uci().encode('utf-8')).digest()[0] / 255
+            white = int(games * (0.3 + 0.3 * share))
+            black = int(games * (0.6 - 0.3 * share))
+            moves.append({'san': board.san(move), 'uci': move.uci(), 'white': white, 'black': black, 'draws': games - white - black})
+        return {'white': sum(m['white'] for m in moves), 'black': sum(m['black'] for m in moves),
+                'draws': sum(m['draws'] for m in moves), 'moves': moves}
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) #no saved settings are loaded
+    settings = Settings()
+    settings.engine.enabled = True
+    settings.engine.soundness_limit = -100
+    settings.engine.move_loss_limit = -60
+    settings.engine.ignore_loss_limit = 150
+    return settings
+
+
+def pick(settings, fen, multipv):
+    settings.engine.multipv = multipv
+    engine = Engine()
+    worker = WorkerPlay(settings, Status(), engine, Explorer(), fen)
+    return worker.pick_candidate(), engine.calls
+
+
+@pytest.mark.parametrize('sans', [[], ['e4'], ['d4', 'Nf6'], ['e4', 'c5', 'Nf3']])
+def test_multipv_picks_the_same_move_as_separate_searches(settings, sans):
+    board = chess.Board()
+    for san in sans:
+        board.push_san(san)
+    separate, separateCalls = pick(settings, board.fen(), False)
+    single, singleCalls = pick(settings, board.fen(), True)
+
+    assert single == separate
+    assert singleCalls <= separateCalls
+
+
+def test_rejected_candidates_are_scored_from_the_one_search(settings):
+    # positions where the engine turns down the statistically best moves before approving one
+    rejected = 0
+    for sans in [[], ['e4'], ['d4', 'Nf6'], ['e4', 'c5', 'Nf3'], ['c4'], ['Nf3', 'd5']]:
+        board = chess.Board()
+        for san in sans:
+            board.push_san(san)
+        (moves, _, _, _, _), calls = pick(settings, board.fen(), True)
+        failed = sum(1 for move in moves.values() if move['lb_value'] == 0)
+        if failed:
+            rejected += 1
+            assert calls <= 1 + failed #one multipv search, and a restricted search only for candidates outside its lines
+    assert rejected
+
+
+def test_scores_are_from_our_point_of_view_with_mates_as_large_values(settings):
+    worker = WorkerPlay(settings, Status(), Engine(), Explorer(), chess.Board().fen())
+    assert worker.our_score(chess.engine.PovScore(chess.engine.Cp(40), chess.BLACK), chess.WHITE) == -40
+    assert worker.our_score(chess.engine.PovScore(chess.engine.Mate(2), chess.WHITE), chess.WHITE) == 9999999999
+    assert worker.our_score(chess.engine.PovScore(chess.engine.Mate(2), chess.WHITE), chess.BLACK) == -9999999999
+
+
+def test_multipv_and_restricted_searches_are_answered_from_the_engine_cache(settings, tmp_path):
+    settings.engine.multipv = True
+    board = chess.Board()
+    board.push_san('e4')
+    expected, calls = pick(settings, board.fen(), True)
+
+    cache = EngineCache(str(tmp_path / 'engine.sqlite'))
+    engine = Engine()
+    cached = CachedEngine(engine, cache, 'Fake')
+    for _ in range(2):
+        assert WorkerPlay(settings, Status(), cached, Explorer(), board.fen()).pick_candidate() == expected
+    assert engine.calls == calls #the second pick only read the cache
+
+    # the lines are kept per MultiPV count and set of root moves
+    limit = chess.engine.Limit(depth=settings.engine.depth)
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())
+    assert [info['pv'] for info in cached.analyse(board, limit, multipv=3)] == [info['pv'] for info in engine.analyse(board, limit, multipv=3)]
+    assert cached.analyse(board, limit, root_moves=moves[:2])['pv'] == cached.analyse(board, limit, root_moves=moves[1::-1])['pv']
+    assert cached.analyse(board, limit, root_moves=moves[2:4])['pv'] == engine.analyse(board, limit, root_moves=moves[2:4])['pv']
+    assert engine.calls == calls + 5
+    cache.close()
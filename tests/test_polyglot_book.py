@@ -0,0 +1,77 @@
+import chess
+import chess.polyglot
+
+from polyglot_book import ENTRY, MAX_WEIGHT, PolyglotBook, polyglot_move, weight
+
+
+def board_after(*sans):
+    board = chess.Board()
+    for san in sans:
+        board.push_san(san)
+    return board
+
+
+def test_moves_are_encoded_like_polyglot():
+    board = chess.Board()
+    assert polyglot_move(board, chess.Move.from_uci('e2e4')) == chess.E4 | chess.E2 << 6
+
+    # castling is written as the king taking its own rook
+    board = board_after('e4', 'e5', 'Nf3', 'Nc6', 'Bc4', 'Bc5')
+    assert polyglot_move(board, chess.Move.from_uci('e1g1')) == chess.H1 | chess.E1 << 6
+    board = chess.Board('r3k3/8/8/8/8/8/8/4K3 b q - 0 1')
+    assert polyglot_move(board, chess.Move.from_uci('e8c8')) == chess.A8 | chess.E8 << 6
+
+    board = chess.Board('8/P7/8/8/8/8/8/k6K w - - 0 1')
+    assert polyglot_move(board, chess.Move.from_uci('a7a8q')) == chess.A8 | chess.A7 << 6 | 4 << 12
+    assert polyglot_move(board, chess.Move.from_uci('a7a8n')) == chess.A8 | chess.A7 << 6 | 1 << 12
+
+
+def test_weights_are_clamped():
+    assert weight(0) == 1
+    assert weight(0.5) == round(0.5 * MAX_WEIGHT)
+    assert weight(2) == MAX_WEIGHT
+
+
+def test_written_book_reads_back_sorted_with_the_heaviest_move_first(tmp_path):
+    path = str(tmp_path / 'book.bin')
+    book = PolyglotBook(path)
+    start = chess.Board()
+    book.add(start, chess.Move.from_uci('e2e4'), 0.6)
+    book.add(start, chess.Move.from_uci('d2d4'), 0.3)
+    castle = board_after('e4', 'e5', 'Nf3', 'Nc6', 'Bc4', 'Bc5')
+    book.add(castle, chess.Move.from_uci('e1g1'), 0.5)
+    book.spill() #a move in several runs keeps its highest weight
+    book.add(start, chess.Move.from_uci('d2d4'), 0.8)
+    book.add(board_after('e4'), chess.Move.from_uci('c7c5'), 0.4)
+    book.write()
+
+    with open(path, 'rb') as file:
+        keys = [key for key, _, _, _ in ENTRY.iter_unpack(file.read())]
+    assert keys == sorted(keys)
+    assert chess.polyglot.zobrist_hash(start) == 0x463b96181691fc9c
+
+    with chess.polyglot.open_reader(path) as reader:
+        entries = [(entry.move.uci(), entry.weight) for entry in reader.find_all(start)]
+        assert entries == [('d2d4', weight(0.8)), ('e2e4', weight(0.6))]
+        assert reader.find(castle).move == chess.Move.from_uci('e1g1')
+        assert reader.find(board_after('e4')).move == chess.Move.from_uci('c7c5')
+    assert book.runs[0].closed #runs are closed once merged
+
+
+def test_expansions_add_the_continuation_and_our_reply(tmp_path):
+    class Line:
+        continuation = 'e5'
+        reply = 'Nf3'
+        playrate = 0.7
+        winRate = 0.55
+
+    path = str(tmp_path / 'book.bin')
+    book = PolyglotBook(path)
+    board = board_after('e4')
+    book.add_expansion(board, [Line()])
+    book.write()
+
+    with chess.polyglot.open_reader(path) as reader:
+        assert reader.find(board).move == chess.Move.from_uci('e7e5')
+        assert reader.find(board).weight == weight(0.7)
+        assert reader.find(board_after('e4', 'e5')).move == chess.Move.from_uci('g1f3')
@@ -0,0 +1,94 @@
+import chess
+import chess.polyglot
+import numpy as np
+import pytest
+
+import position_graph
+from position_graph import PositionNode, PositionStore, graph_fingerprint
+from settings import ExplorerSource, Settings
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) #no saved settings are loaded
+    return Settings()
+
+
+def test_picks_and_engine_moves_are_kept_between_runs(tmp_path):
+    path = str(tmp_path / 'graph.sqlite')
+    board = chess.Board()
+    board.push_san('e4')
+    key = chess.polyglot.zobrist_hash(board) #keys above 2**63 are stored as negative sqlite integers
+    store = PositionStore(path, 'abc', 30)
+    node = PositionNode(key)
+    node.candidate = ([], 'e5', np.float64(0.54), (np.float64(0.5), 0.58), 120)
+    node.engineMove = chess.Move.from_uci('e7e5')
+    store.put_candidate(node)
+    store.put_engine_move(node)
+    store.close()
+
+    store = PositionStore(path, 'abc', 30)
+    node = PositionNode(key)
+    store.load(node)
+    assert node.candidate == (None, 'e5', 0.54, (0.5, 0.58), 120)
+    assert node.engineMove == chess.Move.from_uci('e7e5')
+    assert store.loaded == 1
+    store.close()
+
+    store = PositionStore(path, 'other settings', 30)
+    node = PositionNode(key)
+    store.load(node)
+    assert node.candidate is None and node.engineMove is None
+    store.close()
+
+
+def test_fingerprint_ignores_the_thresholds_that_only_decide_the_lines(settings):
+    fingerprint = graph_fingerprint(settings)
+    settings.moveSelection.depth_likelihood = 0.001
+    settings.moveSelection.continuation_games = 5
+    assert graph_fingerprint(settings) == fingerprint
+
+    settings.moveSelection.alpha = 0.05
+    assert graph_fingerprint(settings) != fingerprint
+
+
+def test_fingerprint_changes_with_where_the_stats_and_engine_moves_come_from(settings):
+    fingerprint = graph_fingerprint(settings)
+    settings.explorer.url = 'http://127.0.0.1:8700/lichess'
+    assert graph_fingerprint(settings) != fingerprint
+    settings.explorer.source = ExplorerSource.LOCAL
+    local = graph_fingerprint(settings)
+    settings.explorer.local_index_path = 'other_index.sqlite'
+    assert graph_fingerprint(settings) != local
+
+    settings.engine.enabled = True
+    fingerprint = graph_fingerprint(settings)
+    settings.engine.hash *= 2
+    assert graph_fingerprint(settings) != fingerprint
+    settings.engine.threads += 1
+    assert graph_fingerprint(settings) != fingerprint
+
+
+def test_picks_expire_with_the_explorer_stats(tmp_path, monkeypatch):
+    path = str(tmp_path / 'graph.sqlite')
+    now = 1_000_000_000
+    monkeypatch.setattr(position_graph.time, 'time', lambda: now)
+    store = PositionStore(path, 'abc', 30)
+    node = PositionNode(1)
+    node.engineMove = chess.Move.from_uci('e2e4')
+    store.put_engine_move(node)
+    store.close()
+
+    now += 29 * 24 * 60 * 60
+    store = PositionStore(path, 'abc', 30)
+    node = PositionNode(1)
+    store.load(node)
+    assert node.engineMove is not None
+    store.close()
+
+    now += 2 * 24 * 60 * 60
+    store = PositionStore(path, 'abc', 30)
+    node = PositionNode(1)
+    store.load(node)
+    assert node.engineMove is None
+    store.close()
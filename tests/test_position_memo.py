@@ -0,0 +1,70 @@
+import chess
+import pytest
+
+from explorer import PositionMemo
+from settings import Settings
+from workerEngineReduce import WorkerPlay
+
+
+class Status:
+    def info2(self, text):
+        pass
+
+
+class Explorer:
+    # answers every position with the same stats and counts the lookups
+    def __init__(self, max_entries):
+        self.memo = PositionMemo(max_entries)
+        self.gets = 0
+
+    def url(self, fen):
+        return fen
+
+    def get(self, fen):
+        self.gets += 1
+        return {'white': 40, 'black': 30, 'draws': 30, 'moves': [
+            {'san': 'e5', 'uci': 'e7e5', 'white': 20, 'black': 15, 'draws': 15},
+            {'san': 'c5', 'uci': 'c7c5', 'white': 20, 'black': 15, 'draws': 15},
+        ]}
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) #no saved settings are loaded
+    return Settings()
+
+
+def test_memo_keeps_the_most_recently_used_positions():
+    memo = PositionMemo(2)
+    boards = [chess.Board(), chess.Board(), chess.Board()]
+    boards[1].push_san('e4')
+    boards[2].push_san('d4')
+    memo.put(boards[0].fen(), {'position': 0})
+    memo.put(boards[1].fen(), {'position': 1})
+    assert memo.get(boards[0].fen()) == {'position': 0}
+
+    memo.put(boards[2].fen(), {'position': 2})
+    assert memo.get(boards[1].fen()) is None
+    assert memo.get(boards[0].fen()) == {'position': 0}
+    assert memo.get(boards[2].fen()) == {'position': 2}
+    assert (memo.hits, memo.misses) == (3, 1)
+
+
+def test_move_counters_are_not_part_of_the_key():
+    memo = PositionMemo(10)
+    fen = chess.Board().fen()
+    memo.put(fen, {'position': 0})
+    assert memo.get(fen.replace(' 0 1', ' 3 12')) == {'position': 0}
+
+
+def test_workers_fetch_and_parse_a_position_once(settings):
+    explorer = Explorer(10)
+    board = chess.Board()
+    board.push_san('e4')
+    first = WorkerPlay(settings, Status(), None, explorer, board.fen())
+    second = WorkerPlay(settings, Status(), None, explorer, board.fen())
+
+    assert explorer.gets == 1
+    assert second.stats is first.stats
+    assert first.stats['total_games'] == 100
+    assert [move['playrate'] for move in first.stats['moves']] == [0.5, 0.5]
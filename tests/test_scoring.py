@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import scipy.stats as st
+
+import scoring
+from scoring import IntervalMethod
+from settings import MoveSelectionSettings
+
+
+def old_score(white, black, draws, positionGames, whiteToMove, moveSelection):
+    # the per-move calc_percs and calc_value that score_moves replaced
+    n = white + black + draws
+    if n == 0:
+        return 0, 0, 0, 0, 0
+    if moveSelection.draws_are_half:
+        white_perc, black_perc = (white + 0.5 * draws) / n, (black + 0.5 * draws) / n
+    else:
+        white_perc, black_perc = white / n, black / n
+    playrate = n / positionGames
+    winRate = white_perc if whiteToMove else black_perc
+    if n > moveSelection.min_games and playrate > moveSelection.min_play_rate:
+        z = st.norm.ppf(1 - moveSelection.alpha / 2)
+        lb_value = max(0, winRate - z * np.sqrt(winRate * (1 - winRate) / n))
+        ub_value = max(0, winRate + z * np.sqrt(winRate * (1 - winRate) / n))
+        return n, playrate, winRate, lb_value, ub_value
+    return n, playrate, 0, 0, 0
+
+
+def random_position(rng, moves):
+    white = rng.integers(0, 400, moves)
+    black = rng.integers(0, 400, moves)
+    draws = rng.integers(0, 200, moves)
+    white[0] = black[0] = draws[0] = 0 #a move nobody played
+    white[1], black[1], draws[1] = 5, 3, 2 #too few games
+    return white, black, draws, int((white + black + draws).sum()) + 100
+
+
+@pytest.mark.parametrize('draws_are_half', [False, True])
+@pytest.mark.parametrize('whiteToMove', [False, True])
+def test_score_moves_matches_the_per_move_calculation(draws_are_half, whiteToMove):
+    rng = np.random.default_rng(11)
+    moveSelection = MoveSelectionSettings()
+    moveSelection.draws_are_half = draws_are_half
+    moveSelection.min_play_rate = 0.01
+    for _ in range(20):
+        white, black, draws, positionGames = random_position(rng, 12)
+        scores = scoring.score_moves(white, black, draws, positionGames, whiteToMove, moveSelection)
+        expected = [old_score(*counts, positionGames, whiteToMove, moveSelection) for counts in zip(white, black, draws)]
+        for name, column in zip(['total_games', 'playrate', 'value', 'lb_value', 'ub_value'], zip(*expected)):
+            np.testing.assert_allclose(scores[name], column, rtol=1e-12, atol=1e-12)
+
+
+def test_a_whole_frontier_scores_like_its_positions_one_by_one():
+    rng = np.random.default_rng(5)
+    moveSelection = MoveSelectionSettings()
+    positions = [random_position(rng, 6) for _ in range(4)]
+    whiteToMove = [True, False, False, True]
+    counts = [np.concatenate(column) for column in zip(*[position[:3] for position in positions])]
+    positionGames = np.repeat([position[3] for position in positions], 6)
+    together = scoring.score_moves(*counts, positionGames, np.repeat(whiteToMove, 6), moveSelection)
+    for index, position in enumerate(positions):
+        alone = scoring.score_moves(*position, whiteToMove[index], moveSelection)
+        for name, values in alone.items():
+            np.testing.assert_allclose(together[name][index * 6:(index + 1) * 6], values)
+
+
+@pytest.mark.parametrize('method', list(IntervalMethod))
+def test_intervals_contain_the_win_rate(method):
+    winRate = np.array([0.2, 0.5, 0.9, 0.5])
+    games = np.array([50, 1000, 200, 0])
+    lb, ub = scoring.intervals(winRate, games, 0.05, method)
+    assert np.all(lb[:3] < winRate[:3])
+    assert np.all(ub[:3] > winRate[:3])
+    assert (lb[3], ub[3]) == (0, 0) #no games, no bounds
+    assert ub[1] - lb[1] < ub[0] - lb[0] #more games, a tighter interval
+
+
+def test_z_score_is_the_normal_quantile():
+    assert scoring.z_score(0.05) == pytest.approx(1.959964, rel=1e-6)
@@ -0,0 +1,306 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import chess
+import chess.engine
+
+from explorer import normalize_fen
+from generation_worker import CancelToken
+from metrics import Metrics
+
+
+class TimedEngine:
+    """
+    Wraps a UCI engine and keeps count of the searches run and the time spent in them
+    """
+
+    def __init__(self, engine: chess.engine.SimpleEngine, metrics: Metrics = None):
+        self.engine = engine
+        self.metrics = metrics or Metrics()
+        self.calls = 0
+        self.seconds = 0
+
+    def _searched(self, kind: str, started: float):
+        seconds = time.perf_counter() - started
+        self.calls += 1
+        self.seconds += seconds
+        self.metrics.record(f"engine.{kind}", seconds)
+
+    def play(self, board: chess.Board, limit: chess.engine.Limit, **kwargs) -> chess.engine.PlayResult:
+        started = time.perf_counter()
+        try:
+            return self.engine.play(board, limit, **kwargs)
+        finally:
+            self._searched('play', started)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.engine.analyse(board, limit, **kwargs)
+        finally:
+            self._searched('analyse', started)
+
+    def quit(self):
+        self.engine.quit()
+
+
+class EnginePool:
+    """
+    Fixed set of UCI engine processes shared by concurrent searches, handed out to waiting searches in arrival order
+    """
+
+    def __init__(self, path: str, processes: int, threads: int, hash: int, cancelToken: CancelToken = None, metrics: Metrics = None):
+        self.cancelToken = cancelToken or CancelToken() #a stopped run starts no new searches
+        self.metrics = metrics or Metrics()
+        self.engines = []
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(max(1, processes)):
+            engine = chess.engine.SimpleEngine.popen_uci(path)
+            engine.configure({"Hash": hash})
+            engine.configure({"Threads": threads})
+            self.engines.append(TimedEngine(engine, self.metrics))
+        self._idle = list(self.engines)
+        self.id = self.engines[0].engine.id
+
+    @property
+    def calls(self) -> int:
+        return sum(engine.calls for engine in self.engines)
+
+    @property
+    def seconds(self) -> float:
+        return sum(engine.seconds for engine in self.engines)
+
+    def _acquire(self, cancellable: bool = True) -> TimedEngine:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            waiter = [threading.Event(), None]
+            self._waiters.append(waiter)
+        with self.metrics.time('engine.pool_wait'): #searches waiting on a busy pool tell us when more processes would help
+            while not waiter[0].wait(0.25):
+                if cancellable and self.cancelToken.cancelled:
+                    with self._lock:
+                        if not waiter[0].is_set(): #an engine handed over meanwhile is used, and released as usual
+                            self._waiters.remove(waiter)
+                            self.cancelToken.check()
+        return waiter[1]
+
+    def _release(self, engine: TimedEngine):
+        # a released engine goes straight to the longest waiting search, so no search can be overtaken indefinitely
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter[1] = engine
+                waiter[0].set()
+            else:
+                self._idle.append(engine)
+
+    def _check(self):
+        self.cancelToken.check()
+        if self._closed:
+            raise chess.engine.EngineTerminatedError("engine pool was quit")
+
+    def play(self, board: chess.Board, limit: chess.engine.Limit, **kwargs) -> chess.engine.PlayResult:
+        self._check()
+        engine = self._acquire()
+        try:
+            return engine.play(board, limit, **kwargs)
+        finally:
+            self._release(engine)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        self._check()
+        engine = self._acquire()
+        try:
+            return engine.analyse(board, limit, **kwargs)
+        finally:
+            self._release(engine)
+
+    def quit(self):
+        # we wait for the searches in flight to hand their engine back before quitting it, a second quit has nothing to wait for
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for _ in self.engines:
+            engine = self._acquire(cancellable=False)
+            try:
+                engine.quit()
+            except chess.engine.EngineError as e:
+                logging.warning(f"Engine did not quit cleanly: {e}")
+
+
+def _score_text(score: chess.engine.Score) -> str:
+    mate = score.mate()
+    return f"mate:{mate}" if mate is not None else f"cp:{score.score()}"
+
+
+def _score_from_text(text: str) -> chess.engine.Score:
+    kind, value = text.split(':')
+    return chess.engine.Mate(int(value)) if kind == 'mate' else chess.engine.Cp(int(value))
+
+
+class EngineCache:
+    """
+    Persistent SQLite cache of engine evaluations, keyed by normalized FEN, engine identity and search depth.
+    MultiPV searches and searches restricted to root moves keep all their lines, keyed by those options too.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS evaluations ("
+            "fen TEXT NOT NULL, "
+            "engine TEXT NOT NULL, "
+            "depth INTEGER NOT NULL, "
+            "score TEXT NOT NULL, "
+            "pv TEXT NOT NULL, "
+            "PRIMARY KEY (fen, engine, depth))")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS lines ("
+            "fen TEXT NOT NULL, "
+            "engine TEXT NOT NULL, "
+            "search TEXT NOT NULL, "
+            "depth INTEGER NOT NULL, "
+            "lines TEXT NOT NULL, "
+            "PRIMARY KEY (fen, engine, search, depth))")
+        self._connection.commit()
+
+    def get(self, fen: str, engine: str, depth: int):
+        # a deeper evaluation of the same position satisfies a shallower request
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT depth, score, pv FROM evaluations WHERE fen = ? AND engine = ? AND depth >= ? ORDER BY depth DESC LIMIT 1",
+                (normalize_fen(fen), engine, depth)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0], _score_from_text(row[1]), json.loads(row[2])
+
+    def put(self, fen: str, engine: str, depth: int, score: chess.engine.Score, pv: list):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO evaluations (fen, engine, depth, score, pv) VALUES (?, ?, ?, ?, ?)",
+                (normalize_fen(fen), engine, depth, _score_text(score), json.dumps(pv)))
+            self._connection.commit()
+
+    def get_lines(self, fen: str, engine: str, search: str, depth: int):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT depth, lines FROM lines WHERE fen = ? AND engine = ? AND search = ? AND depth >= ? ORDER BY depth DESC LIMIT 1",
+                (normalize_fen(fen), engine, search, depth)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0], [(_score_from_text(score), pv) for score, pv in json.loads(row[1])]
+
+    def put_lines(self, fen: str, engine: str, search: str, depth: int, lines: list):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO lines (fen, engine, search, depth, lines) VALUES (?, ?, ?, ?, ?)",
+                (normalize_fen(fen), engine, search, depth, json.dumps([[_score_text(score), pv] for score, pv in lines])))
+            self._connection.commit()
+
+    def stats(self) -> str:
+        return f"engine cache: {self.hits} hits, {self.misses} misses"
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEngine:
+    """
+    Answers depth limited play and analyse requests from the engine cache, and only runs the engine on a miss.
+    Analyse requests may ask for MultiPV lines and restrict the root moves, other options and play options always run the engine.
+    """
+
+    def __init__(self, engine: EnginePool, cache: EngineCache, identity: str):
+        self.engine = engine
+        self.cache = cache
+        self.identity = identity #engine name and options that change its evaluations
+
+    @property
+    def calls(self) -> int:
+        return self.engine.calls
+
+    @property
+    def seconds(self) -> float:
+        return self.engine.seconds
+
+    def _evaluate(self, board: chess.Board, limit: chess.engine.Limit):
+        fen = board.fen()
+        cached = self.cache.get(fen, self.identity, limit.depth)
+        if cached is not None:
+            self.engine.metrics.count('engine.cache_hits')
+            depth, score, pv = cached
+            return {"depth": depth, "score": chess.engine.PovScore(score, board.turn), "pv": [chess.Move.from_uci(move) for move in pv]}
+
+        info = self.engine.analyse(board, limit)
+        if "score" in info and info.get("pv"):
+            self.cache.put(fen, self.identity, limit.depth, info["score"].relative, [move.uci() for move in info["pv"]])
+        return info
+
+    def _evaluate_lines(self, board: chess.Board, limit: chess.engine.Limit, search: str, kwargs: dict):
+        fen = board.fen()
+        cached = self.cache.get_lines(fen, self.identity, search, limit.depth)
+        if cached is not None:
+            self.engine.metrics.count('engine.cache_hits')
+            depth, lines = cached
+            infos = [{"depth": depth, "score": chess.engine.PovScore(score, board.turn), "pv": [chess.Move.from_uci(move) for move in pv],
+                      "multipv": multipv} for multipv, (score, pv) in enumerate(lines, 1)]
+            return infos if kwargs.get('multipv') is not None else infos[0] #like the engine, a list only when MultiPV was asked for
+
+        result = self.engine.analyse(board, limit, **kwargs)
+        infos = result if isinstance(result, list) else [result]
+        if infos and all("score" in info and info.get("pv") for info in infos):
+            self.cache.put_lines(fen, self.identity, search, limit.depth,
+                                 [(info["score"].relative, [move.uci() for move in info["pv"]]) for info in infos])
+        return result
+
+    @staticmethod
+    def _search(kwargs: dict):
+        # the options that change what a search answers are part of the key, None when there are others we don't cache
+        if set(kwargs) - {'multipv', 'root_moves'}:
+            return None
+        parts = []
+        if kwargs.get('multipv') is not None:
+            parts.append(f"multipv={kwargs['multipv']}")
+        if kwargs.get('root_moves') is not None:
+            parts.append("root_moves=" + ",".join(sorted(move.uci() for move in kwargs['root_moves'])))
+        return " ".join(parts)
+
+    def play(self, board: chess.Board, limit: chess.engine.Limit, **kwargs) -> chess.engine.PlayResult:
+        if limit.depth is None or kwargs:
+            return self.engine.play(board, limit, **kwargs)
+        info = self._evaluate(board, limit)
+        if not info.get("pv"): #no principal variation to take the move from, so the engine plays it
+            return self.engine.play(board, limit)
+        pv = info["pv"]
+        return chess.engine.PlayResult(pv[0], pv[1] if len(pv) > 1 else None, info)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        search = self._search(kwargs)
+        if limit.depth is None or search is None:
+            return self.engine.analyse(board, limit, **kwargs)
+        if not search:
+            return self._evaluate(board, limit)
+        return self._evaluate_lines(board, limit, search, kwargs)
+
+    def quit(self):
+        self.engine.quit()
+        logging.info(self.cache.stats())
+        self.cache.close()
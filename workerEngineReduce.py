@@ -1,8 +1,5 @@
 import chess.svg
-import requests
-import scipy.stats as st
 import numpy as np
-import time
 import copy
 
 import chess
@@ -10,67 +7,48 @@ import chess.engine
 import re
 import logging
 
+import scoring
+
 
 class WorkerPlay:
-    def __init__(self, settings, status, engine, fen):
+    def __init__(self, settings, status, engine, explorer, fen, board=None):
         self.settings = settings
         self.status = status
         self.engine = engine
+        self.explorer = explorer
         self.fen = fen #fen is the game moves format needed to feed lichess api
-        self.short_fen = fen[:-4]
         self.explored = False
         self.best_move = None
         
-        self.board = chess.Board(fen)
+        self.board = board.copy(stack=False) if board else chess.Board(fen) #callers holding a board spare us parsing the fen
         
-        self.stats = self.call_api()
-        self.parse_stats()
+        self.stats = explorer.memo.get(fen) #positions already seen in this run are parsed once and shared
+        if self.stats is None:
+            self.stats = self.call_api()
+            self.parse_stats()
+            explorer.memo.put(fen, self.stats)
        
-    #generate the Lichess API URL from config file
+    #get the opening explorer stats for the position, from the cache if we already have them
     def call_api(self):
-        db = self.settings.database
-        variant = db.variant.value
-        speeds = [speed.value for speed in db.speeds]
-        ratings = [rating.value for rating in db.ratings]
-        moves = db.moves
-        recentGames = 0
-        topGames = 0
-        play = ""
-        
-        url = 'https://explorer.lichess.ovh/lichess?'
-        url += f'variant={variant}&'
-        url += f'speeds={",".join(speeds)}&'
-        url += f'ratings={",".join(ratings)}&'
-        url += f'recentGames={recentGames}&'
-        url += f'topGames={topGames}&'
-        url += f'moves={moves}&'
-        url += f'play={play}&'
-        url += f'fen={self.fen}'
-
         self.status.info2(f"Looking for a move at FEN {self.fen}")
-        self.opening_url = url
-        #logging.debug(f"url of position {url}") #uncomment for debugging
-        while True:
-            r = requests.get(url)
-            if r.status_code == 429:
-                self.status.info2(f"Hit Lichess API rate limit, waiting for 60 seconds")
-                print('Rate limited - waiting 60s...')
-                time.sleep(60)
-            else:
-                response = r.json()
-                break
-
-        return response
+        self.opening_url = self.explorer.url(self.fen)
+        return self.explorer.get(self.fen)
 
     def parse_stats(self, move = None): #parse the stats returned by the API
 
         stats = self.stats #self.stats is what the api call returns
         stats['white_perc'], stats['black_perc'], stats['draw_perc'], stats['total_games'] = self.calc_percs(stats['white'], stats['black'], stats['draws']) # base rate?? sends the whiteWin / blackWin / draw / total games move was played numbers to calculate win percentages function, and define stats
         #print(stats) #uncomment for debugging
-        for m in self.stats['moves']:
-            m['white_perc'], m['black_perc'], m['draw_perc'], m['total_games'] = self.calc_percs(m['white'], m['black'], m['draws']) #each position iterate through all the moves to get win rate stats
-            m['playrate'] = m['total_games'] / stats['total_games']
-            #print(m) #uncomment for debugging
+        moves = stats['moves']
+        if moves: #every move is scored in one vectorized call, including its potency for the side to move
+            scores = scoring.score_moves([m['white'] for m in moves], [m['black'] for m in moves], [m['draws'] for m in moves],
+                                         stats['total_games'], self.board.turn == chess.WHITE, self.settings.moveSelection)
+            scores = {k: v.tolist() for k, v in scores.items()} #plain floats, the stats are shared and printed
+            for i, m in enumerate(moves):
+                m['white_perc'], m['black_perc'], m['draw_perc'] = scores['white_perc'][i], scores['black_perc'][i], scores['draw_perc'][i]
+                m['total_games'] = int(scores['total_games'][i])
+                m['playrate'] = scores['playrate'][i]
+                m['value'], m['lb_value'], m['ub_value'] = scores['value'][i], scores['lb_value'][i], scores['ub_value'][i]
             #TO DO call api for each move to get real percentages and total game numbers for transposition
 
 
@@ -80,21 +58,16 @@ class WorkerPlay:
         moves = {}
         best_lb_value = -np.inf
         best_move = None
-        for move in self.stats['moves']: #array of all moves returned from the API as next moves in a given position.
-            if self.board.turn == chess.WHITE: #if it's white to play
-                value, lb_value, ub_value, n = self.calc_value(move['white_perc'], move['total_games'], move['playrate'], move['san'], self.board) #sends move white win percentage and total games move was played to calculate 'potency' on confidence intervals
-                for_printing= ''.join([str(i) for i in ["candidate move is ", move['san'], ' win rate is ', "{:+.2%}".format(move['white_perc']), ' playrate ', "{:+.2%}".format(move['playrate'])," lb value ", lb_value]])
-                logging.debug(for_printing)
-            else: #if it's not white it's black to play
-                value, lb_value, ub_value, n = self.calc_value(move['black_perc'], move['total_games'], move['playrate'], move['san'], self.board) #sends move black win percentage and total games move was played to calculate 'potency' on confidence intervals
-                for_printing= ''.join([str(i) for i in ["candidate move is ", move['san'], ' win rate is ', "{:+.2%}".format(move['black_perc']), ' playrate' , "{:+.2%}".format(move['playrate']), " lb value ", lb_value]])
-                logging.debug(for_printing)
+        for move in self.stats['moves']: #array of all moves returned from the API as next moves in a given position, scored when the stats were parsed
+            winRate = move['white_perc'] if self.board.turn == chess.WHITE else move['black_perc']
+            for_printing= ''.join([str(i) for i in ["candidate move is ", move['san'], ' win rate is ', "{:+.2%}".format(winRate), ' playrate ', "{:+.2%}".format(move['playrate'])," lb value ", move['lb_value']]])
+            logging.debug(for_printing)
             key = move['san']
             moves[key] = {
-                'value': value #raw winrate
-                , 'lb_value': lb_value #lower bound potency value
-                , 'ub_value': ub_value #upper bound potency value
-                , 'n': n #total games played
+                'value': move['value'] #raw winrate
+                , 'lb_value': move['lb_value'] #lower bound potency value
+                , 'ub_value': move['ub_value'] #upper bound potency value
+                , 'n': move['total_games'] #total games played
             }
         lb_potencies = {k:v['lb_value'] for k,v in moves.items()} #makes a set of lb values from potential moves picked
         #print ('continuation options and winrates - ',lb_potencies)#prints list of continuations with lower bound winrates
@@ -135,10 +108,14 @@ class WorkerPlay:
                         depth = self.settings.engine.depth
                         self.status.info2(f"Looking for best engine move at '{board.fen()}', depth {depth}, this can take a while")
                         logging.debug(f"engine working...")
-                        PlayResult = self.engine.play(board, chess.engine.Limit(depth=depth)) #we get the engine to play
+                        if self.settings.engine.multipv:
+                            engineScores, engineMove = self.engine_scores(board, moves) #one search scores the engine move and our candidates
+                        else:
+                            PlayResult = self.engine.play(board, chess.engine.Limit(depth=depth)) #we get the engine to play
+                            engineMove = PlayResult.move
                         
-                        engineMoveSan = board.san(PlayResult.move)
-                        board.push(PlayResult.move)
+                        engineMoveSan = board.san(engineMove)
+                        board.push(engineMove)
                         
                         engineMoveBoard = copy.copy(board)
                         board.pop () #undo engine move to keep board state                    
@@ -160,8 +137,7 @@ class WorkerPlay:
                     #if our move is the top engine move, we just approve it. Bug note: We can get loss limit / soundness limit slip in some scenarios (eg if move goes out of soundness limits and engine can't see, but unlikely)
                     if ourMoveBoard == engineMoveBoard:
                         logging.debug("our move is top engine move so we approve")
-                        lb_value = max(0, potency - st.norm.ppf(1 - self.settings.moveSelection.alpha/2) * np.sqrt(potency * (1-potency) / gamesPlayed)) #lower bound wr at 95% confidence interval
-                        ub_value = max(0, potency + st.norm.ppf(1 - self.settings.moveSelection.alpha/2) * np.sqrt(potency * (1-potency) / gamesPlayed)) #upper bound wr at
+                        lb_value, ub_value = self.calc_interval(potency, gamesPlayed) #bounds of the wr at our confidence interval
                         engineChecked = 1
                         logging.debug(f"move is top engine move {san}")                    
                     
@@ -169,6 +145,9 @@ class WorkerPlay:
                     else:
                         logging.debug (f"our move is not top engine move. engine working...")
                         
+                        if bestEval == None and self.settings.engine.multipv:
+                            bestEval = engineScores[engineMoveSan] #the top line of the multipv search is the engine move eval
+                        
                         if bestEval == None:
                             #we get engine move eval
                             # engineMoveReply = engine.play(engineMoveBoard, chess.engine.Limit(depth=settings.engine.depth)) #we play one more move after engine move, to avoid slipping out of soundness limits
@@ -215,31 +194,34 @@ class WorkerPlay:
                         #we get our move eval
                         # ourMoveReply = engine.play(ourMoveBoard, chess.engine.Limit(depth=settings.engine.depth)) #we play one more move after our move
                         # ourMoveBoard.push(ourMoveReply.move)
-                        depth = self.settings.engine.depth
-                        self.status.info2(f"Evaluating board after best human move, {ourMoveBoard.fen()}, depth {depth}, this can take a while")
-                        ourMoveScore = self.engine.analyse(ourMoveBoard, chess.engine.Limit(depth=depth)) #we get engine's eval from opponent's perspective
+                        if self.settings.engine.multipv:
+                            afterOurMoveScore = self.engine_score(board, san, engineScores)
+                        else:
+                            depth = self.settings.engine.depth
+                            self.status.info2(f"Evaluating board after best human move, {ourMoveBoard.fen()}, depth {depth}, this can take a while")
+                            ourMoveScore = self.engine.analyse(ourMoveBoard, chess.engine.Limit(depth=depth)) #we get engine's eval from opponent's perspective
                         
-                        logging.debug (f"Eval from perspective after our move {ourMoveScore['score']}") 
+                            logging.debug (f"Eval from perspective after our move {ourMoveScore['score']}") 
                         
-                        #we convert our move score to a string so we can parse it
-                        ourMoveScoreString = str(ourMoveScore["score"])
+                            #we convert our move score to a string so we can parse it
+                            ourMoveScoreString = str(ourMoveScore["score"])
                     
-                        #we switch to our perspective            
-                        goodForThem = not ('-' in ourMoveScoreString) # check if it's good for us
-                        # print("good for them", goodForThem)
-                        mateForThem = (goodForThem) and ('Mate' in ourMoveScoreString) #if it's mate for us
-                        # print("mate for us", mateForUs)
-                        mateForUs = (not goodForThem) and ('Mate' in ourMoveScoreString) #if it's mate for them
-                        # print("mate for them", mateForThem)
-                        afterOurMoveScore = [int(s) for s in re.findall(r'\b\d+\b',ourMoveScoreString)]
-                        afterOurMoveScore = afterOurMoveScore[0]
-                        # print("raw centipawn score", afterEngineReply)
-                        if goodForThem:
-                            afterOurMoveScore = -afterOurMoveScore
-                        if mateForThem:
-                            afterOurMoveScore = -9999999999
-                        if mateForUs:
-                            afterOurMoveScore = 9999999999    
+                            #we switch to our perspective            
+                            goodForThem = not ('-' in ourMoveScoreString) # check if it's good for us
+                            # print("good for them", goodForThem)
+                            mateForThem = (goodForThem) and ('Mate' in ourMoveScoreString) #if it's mate for us
+                            # print("mate for us", mateForUs)
+                            mateForUs = (not goodForThem) and ('Mate' in ourMoveScoreString) #if it's mate for them
+                            # print("mate for them", mateForThem)
+                            afterOurMoveScore = [int(s) for s in re.findall(r'\b\d+\b',ourMoveScoreString)]
+                            afterOurMoveScore = afterOurMoveScore[0]
+                            # print("raw centipawn score", afterEngineReply)
+                            if goodForThem:
+                                afterOurMoveScore = -afterOurMoveScore
+                            if mateForThem:
+                                afterOurMoveScore = -9999999999
+                            if mateForUs:
+                                afterOurMoveScore = 9999999999    
                         logging.debug (f"centipawn eval from our perspective after our move {san} {afterOurMoveScore}")                      
 
                         if (afterOurMoveScore == 9999999999): #if move is mate we give lb winrate as 1 and approve the move
@@ -266,8 +248,7 @@ class WorkerPlay:
                     
                             #we approve the move if it meets soundness limits + loss limits, or passes our ignorelosslimit, or is evaluated stronger than top engine move after playing
                             if ( (afterOurMoveScore > self.settings.engine.soundness_limit)  and  (moveLoss > self.settings.engine.move_loss_limit)) or (afterOurMoveScore > (self.settings.engine.ignore_loss_limit)) or (moveLoss >= 0):
-                                lb_value = max(0, potency - st.norm.ppf(1 - self.settings.moveSelection.alpha/2) * np.sqrt(potency * (1-potency) / gamesPlayed)) #lower bound wr at 95% confidence interval
-                                ub_value = max(0, potency + st.norm.ppf(1 - self.settings.moveSelection.alpha/2) * np.sqrt(potency * (1-potency) / gamesPlayed)) #upper bound wr at
+                                lb_value, ub_value = self.calc_interval(potency, gamesPlayed) #bounds of the wr at our confidence interval
                                 engineChecked = 1
                                 logging.debug([str(i) for i in ["move is engine checked and passes soundness + moveloss limits, passes the ignoreloss limit or is better than engine move", best_move, moves[san], "eval:", afterOurMoveScore, "loss:", moveLoss]])
 
@@ -284,6 +265,32 @@ class WorkerPlay:
         logging.debug(f'best move is - {best_move} & win rate is - {potency} & lower bound win rate is - {lb_potency}')
         return moves, best_move, potency, (lb_potency, ub_potency), n
 
+    def engine_scores(self, board, moves): #one multipv search from our position instead of a search per candidate
+        depth = self.settings.engine.depth
+        candidates = [san for san, move in moves.items() if move['lb_value'] > 0] #only moves passing the statistics are ever checked by the engine
+        self.status.info2(f"Looking for best engine moves at '{board.fen()}', depth {depth}, {len(candidates)} lines, this can take a while")
+        infos = self.engine.analyse(board, chess.engine.Limit(depth=depth), multipv=max(1, len(candidates)))
+        
+        engineScores = {}
+        for info in infos:
+            if info.get('pv') and 'score' in info:
+                engineScores[board.san(info['pv'][0])] = self.our_score(info['score'], board.turn)
+        return engineScores, infos[0]['pv'][0]
+
+    def engine_score(self, board, san, engineScores): #candidates outside the multipv lines get a search restricted to them
+        if san not in engineScores:
+            depth = self.settings.engine.depth
+            self.status.info2(f"Evaluating best human move {san} at '{board.fen()}', depth {depth}, this can take a while")
+            info = self.engine.analyse(board, chess.engine.Limit(depth=depth), root_moves=[board.parse_san(san)])
+            engineScores[san] = self.our_score(info['score'], board.turn)
+        return engineScores[san]
+
+    def our_score(self, score, turn): #centipawns from our perspective, with mates as the same large values as the string parsing
+        score = score.pov(turn)
+        if score.is_mate():
+            return 9999999999 if score > chess.engine.Cp(0) else -9999999999
+        return score.score()
+
     def find_opponent_move(self, move):
         if move.uci() == 'e8g8': #Change the values for castling in Universal Chess Interface codes, can ignore
             move_uci = 'e8h8'
@@ -337,21 +344,7 @@ class WorkerPlay:
             else:
                 return None, None, None, 0
 
-    # p = white/black win rate and n = total games p was played, this function calculates values used in the potentcy score of each potential move. It do
-    def calc_value(self, winRate, gamesPlayed, playRate, san, board):
-
-        if (gamesPlayed > self.settings.moveSelection.min_games) and (
-                playRate > self.settings.moveSelection.min_play_rate):  # total games move was played must be more than min games and min perc play rate (otherwise data is bad)
-            # print("check this", np.sqrt(winRate * (1-winRate) / gamesPlayed))
-            # print ("check this",st.norm.ppf(1 - settings.moveSelection.alpha/2))
-            # print ("check this",winRate - st.norm.ppf(1 - settings.moveSelection.alpha/2) * np.sqrt(winRate * (1-winRate) / gamesPlayed))
-            lb_value = max(0, winRate - st.norm.ppf(1 - self.settings.moveSelection.alpha / 2) * np.sqrt(
-                winRate * (1 - winRate) / gamesPlayed))  # lower bound wr at 95% confidence interval
-            ub_value = max(0, winRate + st.norm.ppf(1 - self.settings.moveSelection.alpha / 2) * np.sqrt(
-                winRate * (1 - winRate) / gamesPlayed))  # upper bound wr at
-        else:
-            winRate = 0
-            lb_value = 0
-            ub_value = 0
-
-        return winRate, lb_value, ub_value, gamesPlayed
\ No newline at end of file
+    def calc_interval(self, winRate, gamesPlayed): #lower and upper bound wr, with the z-quantile cached per alpha
+        moveSelection = self.settings.moveSelection
+        lb_value, ub_value = scoring.intervals(winRate, gamesPlayed, moveSelection.alpha, moveSelection.interval_method)
+        return float(lb_value), float(ub_value)